@@ -0,0 +1,64 @@
+import threading
+from collections import Counter, OrderedDict
+from typing import Callable, Optional
+
+from allocation.domain import model
+
+
+class AggregateCache:
+    """
+    Recently committed products, kept between units of work in this process
+    and bounded to maxsize by evicting the least recently used.
+
+    A product is taken out of the cache while a unit of work uses it and put
+    back once that unit of work has committed and finished, so no two
+    sessions ever share one. take() only hands it out if current_version()
+    (a query for the product's version_number) still matches the version we
+    committed; otherwise another process has changed it and it is dropped.
+    Commits still check the version in the database, so a change that lands
+    between the probe and our commit is a ConcurrencyConflict as usual.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._products = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+        self._counts = Counter()  # type: Counter
+
+    def take(
+        self, sku: str, current_version: Callable[[], Optional[int]]
+    ) -> Optional[model.Product]:
+        with self._lock:
+            product = self._products.pop(sku, None)
+        if product is None:
+            self._count("misses")
+            return None
+        if current_version() != product.version_number:
+            self._count("stale")
+            return None
+        self._count("hits")
+        return product
+
+    def put(self, product: model.Product):
+        with self._lock:
+            self._products[product.sku] = product
+            self._products.move_to_end(product.sku)
+            while len(self._products) > self.maxsize:
+                self._products.popitem(last=False)
+                self._counts["evictions"] += 1
+
+    def discard(self, sku: str):
+        with self._lock:
+            self._products.pop(sku, None)
+
+    def clear(self):
+        with self._lock:
+            self._products.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counts, size=len(self._products))
+
+    def _count(self, outcome):
+        with self._lock:
+            self._counts[outcome] += 1
@@ -0,0 +1,188 @@
+import csv
+import io
+import itertools
+import json
+import logging
+from datetime import datetime
+from typing import (
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+from allocation.adapters import orm, outbox
+from allocation.domain import commands, events
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 5000
+
+
+class InvalidFeed(Exception):
+    # what was committed before the bad row, set by ingest()
+    counts = None  # type: Optional[Dict[str, int]]
+
+
+def read_csv(lines: Iterable[str]) -> Iterator[commands.CreateBatch]:
+    """A header row of ref,sku,qty,eta then one batch per row; eta may be empty."""
+    for number, row in enumerate(csv.DictReader(lines), start=2):
+        yield _create_batch(row, f"line {number}")
+
+
+def read_ndjson(lines: Iterable[str]) -> Iterator[commands.CreateBatch]:
+    """One {"ref", "sku", "qty", "eta"} object per line."""
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            fields = json.loads(line)
+        except ValueError as e:
+            raise InvalidFeed(f"line {number}: {e}") from e
+        yield _create_batch(fields, f"line {number}")
+
+
+READERS = {"csv": read_csv, "ndjson": read_ndjson}
+
+
+def _create_batch(fields: Dict, where: str) -> commands.CreateBatch:
+    try:
+        eta = fields.get("eta") or None
+        return commands.CreateBatch(
+            fields["ref"],
+            fields["sku"],
+            int(fields["qty"]),
+            datetime.fromisoformat(eta).date() if eta else None,
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise InvalidFeed(f"{where}: {e!r}") from e
+
+
+def ingest(
+    engine: Engine,
+    feed: Iterable[commands.CreateBatch],
+    chunk_size: int = CHUNK_SIZE,
+    held_skus: Collection[str] = (),
+    hand_over: Optional[Callable[[commands.CreateBatch], object]] = None,
+) -> Dict[str, int]:
+    """
+    Add the batches in feed straight to the batches table, chunk_size at a
+    time, each chunk in its own transaction. Only one chunk is held in
+    memory, so feed can be a reader over a file of any size.
+
+    A chunk creates the products it needs, bumps the version of every
+    product it adds batches to, so writers and caches holding the old
+    version find out, inserts the batches with one executemany (COPY on
+    Postgres) and writes a BatchCreated per batch to the outbox. Batches
+    whose reference is already there are skipped, so a feed that failed
+    halfway is finished by sending it again. An InvalidFeed carries the
+    counts of what was committed before it.
+
+    Batches for held_skus, the skus an AllocationEngine keeps resident,
+    must not be written behind its back: once their chunk has committed
+    they go one by one to hand_over, the engine's handle(), or without
+    one are counted as rejected.
+
+    This writes the tables store of the home database: not the event
+    store or the shards.
+    """
+    counts = dict(batches=0, skipped=0, handed_over=0, rejected=0, chunks=0)
+    feed = iter(feed)
+    while True:
+        try:
+            chunk = list(itertools.islice(feed, chunk_size))
+        except InvalidFeed as e:
+            e.counts = dict(counts)
+            raise
+        if not chunk:
+            return counts
+        with engine.begin() as connection:
+            added, held = _ingest_chunk(connection, chunk, held_skus)
+        for command in held:
+            if hand_over is None:
+                counts["rejected"] += 1
+                continue
+            hand_over(command)
+            counts["handed_over"] += 1
+        counts["batches"] += added
+        counts["skipped"] += len(chunk) - added - len(held)
+        counts["chunks"] += 1
+        logger.debug("ingested %d of %d batches", added, len(chunk))
+
+
+def _ingest_chunk(
+    connection, chunk: List[commands.CreateBatch], held_skus: Collection[str]
+) -> Tuple[int, List[commands.CreateBatch]]:
+    by_ref = {command.ref: command for command in chunk}
+    present = connection.execute(
+        select(orm.batches.c.reference).where(
+            orm.batches.c.reference.in_(list(by_ref))
+        )
+    ).scalars()
+    for ref in present:
+        del by_ref[ref]
+    held = [c for c in by_ref.values() if c.sku in held_skus]
+    new = [c for c in by_ref.values() if c.sku not in held_skus]
+    if not new:
+        return 0, held
+
+    skus = sorted({command.sku for command in new})
+    insert = _insert_for(connection.dialect.name)
+    connection.execute(
+        insert(orm.products).on_conflict_do_nothing(),
+        [dict(sku=sku, version_number=0) for sku in skus],
+    )
+    connection.execute(
+        orm.products.update()
+        .where(orm.products.c.sku.in_(skus))
+        .values(version_number=orm.products.c.version_number + 1)
+    )
+    if connection.dialect.name == "postgresql":
+        _copy_batches(connection, new)
+    else:
+        connection.execute(
+            orm.batches.insert(),
+            [
+                dict(
+                    reference=c.ref, sku=c.sku, _purchased_quantity=c.qty, eta=c.eta
+                )
+                for c in new
+            ],
+        )
+    outbox.add(
+        connection, [events.BatchCreated(c.ref, c.sku, c.qty, c.eta) for c in new]
+    )
+    return len(new), held
+
+
+def _insert_for(dialect_name: str):
+    if dialect_name == "postgresql":
+        return postgresql.insert
+    if dialect_name == "sqlite":
+        return sqlite.insert
+    raise NotImplementedError(f"bulk ingest does not support {dialect_name}")
+
+
+def _copy_batches(connection, new: List[commands.CreateBatch]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for c in new:
+        writer.writerow([c.ref, c.sku, c.qty, c.eta.isoformat() if c.eta else ""])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            "COPY batches (reference, sku, _purchased_quantity, eta)"
+            " FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+    finally:
+        cursor.close()
@@ -0,0 +1,34 @@
+import dataclasses
+from datetime import date
+
+from allocation.domain import events
+
+EVENT_TYPES = {
+    event_class.__name__: event_class
+    for event_class in [
+        events.BatchCreated,
+        events.Allocated,
+        events.Deallocated,
+        events.BatchQuantityChanged,
+        events.OutOfStock,
+    ]
+}
+
+
+def to_dict(event: events.Event) -> dict:
+    """An event as JSON-ready data, tagged with its type."""
+    data = dataclasses.asdict(event)
+    if isinstance(event, events.BatchCreated) and event.eta is not None:
+        data["eta"] = event.eta.isoformat()
+    data["type"] = type(event).__name__
+    return data
+
+
+def from_dict(data: dict) -> events.Event:
+    data = dict(data)
+    event_class = EVENT_TYPES[data.pop("type")]
+    if event_class is events.BatchQuantityChanged:
+        data["deallocated"] = [events.Deallocated(**d) for d in data["deallocated"]]
+    elif event_class is events.BatchCreated and data["eta"] is not None:
+        data["eta"] = date.fromisoformat(data["eta"])
+    return event_class(**data)
@@ -0,0 +1,129 @@
+import json
+from typing import Dict, Iterator, List, Set, Tuple
+
+from sqlalchemy import select
+
+from allocation.adapters import event_codec, orm, repository
+from allocation.domain import events, model
+
+
+class EventSourcedRepository(repository.AbstractProductRepository):
+    """
+    Products kept as the events they raised, in product_events, instead of
+    in the batches and allocations tables.
+
+    A product is rebuilt from its snapshot in product_snapshots plus the
+    events after it, so a load is one snapshot read and at most
+    snapshot_every events to replay. append_new_events() writes what the
+    products we handed out have raised since, in one INSERT, and a new
+    snapshot whenever a product passes a multiple of snapshot_every events.
+
+    Events are numbered per sku and (sku, seq) is the primary key, so two
+    writers that loaded the same product can't both append: the second
+    INSERT fails.
+    """
+
+    def __init__(self, session, snapshot_every: int = 100):
+        super().__init__()
+        self.session = session
+        self.snapshot_every = snapshot_every
+        self._seq = {}  # type: Dict[str, int]
+        self._appended = set()  # type: Set[int]
+        self._identity_map = {}  # type: Dict[str, model.Product]
+
+    def _add(self, product):
+        self._seq[product.sku] = 0
+        self._identity_map[product.sku] = product
+
+    def _get(self, sku):
+        if sku in self._identity_map:
+            return self._identity_map[sku]
+        product, seq = self._load(sku)
+        if seq == 0:
+            return None
+        self._seq[sku] = seq
+        self._identity_map[sku] = product
+        return product
+
+    def each_product(self) -> Iterator[model.Product]:
+        """Every stored product, one at a time, for reading only."""
+        sku = orm.product_events.c.sku
+        skus = self.session.execute(select(sku).distinct().order_by(sku)).scalars()
+        for sku in list(skus):
+            product, _ = self._load(sku)
+            yield product
+
+    def _load(self, sku) -> Tuple[model.Product, int]:
+        snapshot = self.session.execute(
+            select(
+                orm.product_snapshots.c.seq,
+                orm.product_snapshots.c.version_number,
+                orm.product_snapshots.c.state,
+            ).where(orm.product_snapshots.c.sku == sku)
+        ).first()
+        product = model.Product(sku, batches=[])
+        seq = 0
+        if snapshot is not None:
+            for data in json.loads(snapshot.state):
+                product.replay(event_codec.from_dict(data))
+            product.version_number = snapshot.version_number
+            seq = snapshot.seq
+        tail = self.session.execute(
+            select(orm.product_events.c.seq, orm.product_events.c.data)
+            .where(orm.product_events.c.sku == sku)
+            .where(orm.product_events.c.seq > seq)
+            .order_by(orm.product_events.c.seq)
+        )
+        for row in tail:
+            product.replay(event_codec.from_dict(json.loads(row.data)))
+            seq = row.seq
+        return product, seq
+
+    def _get_by_batchref(self, batchref):
+        sku = self.session.execute(
+            select(orm.product_events.c.sku)
+            .where(orm.product_events.c.batchref == batchref)
+            .limit(1)
+        ).scalar()
+        return self._get(sku) if sku is not None else None
+
+    def append_new_events(self):
+        rows = []
+        to_snapshot = []  # type: List[model.Product]
+        for product in self.seen:
+            seq = first_seq = self._seq[product.sku]
+            for event in product.events:
+                if id(event) in self._appended:
+                    continue  # a handler that commits twice
+                self._appended.add(id(event))
+                seq += 1
+                created = isinstance(event, events.BatchCreated)
+                rows.append(
+                    dict(
+                        sku=product.sku,
+                        seq=seq,
+                        type=type(event).__name__,
+                        batchref=event.ref if created else None,
+                        data=json.dumps(event_codec.to_dict(event)),
+                    )
+                )
+            if seq // self.snapshot_every > first_seq // self.snapshot_every:
+                to_snapshot.append(product)
+            self._seq[product.sku] = seq
+        if rows:
+            self.session.execute(orm.product_events.insert(), rows)
+        for product in to_snapshot:
+            self._save_snapshot(product)
+
+    def _save_snapshot(self, product: model.Product):
+        snapshots = orm.product_snapshots
+        values = dict(
+            seq=self._seq[product.sku],
+            version_number=product.version_number,
+            state=json.dumps([event_codec.to_dict(e) for e in product.as_events()]),
+        )
+        updated = self.session.execute(
+            snapshots.update().where(snapshots.c.sku == product.sku).values(**values)
+        ).rowcount
+        if not updated:
+            self.session.execute(snapshots.insert().values(sku=product.sku, **values))
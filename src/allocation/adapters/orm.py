@@ -1,4 +1,16 @@
-from sqlalchemy import Table, MetaData, Column, Integer, String, Date, ForeignKey, event
+from sqlalchemy import (
+    Table,
+    MetaData,
+    Column,
+    Integer,
+    String,
+    Text,
+    Date,
+    DateTime,
+    ForeignKey,
+    Index,
+    event,
+)
 from sqlalchemy.orm import mapper, relationship
 
 from allocation.domain import model
@@ -13,6 +25,7 @@ order_lines = Table(
     Column("qty", Integer, nullable=False),
     Column("orderid", String(255)),
 )
+Index("ix_order_lines_orderid_sku", order_lines.c.orderid, order_lines.c.sku)
 
 products = Table(
     "products",
@@ -30,6 +43,8 @@ batches = Table(
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
 )
+Index("ix_batches_reference", batches.c.reference, unique=True)
+Index("ix_batches_sku", batches.c.sku)
 
 allocations = Table(
     "allocations",
@@ -38,6 +53,83 @@ allocations = Table(
     Column("orderline_id", ForeignKey("order_lines.id")),
     Column("batch_id", ForeignKey("batches.id")),
 )
+# a line is allocated to at most one batch; (batch_id, orderline_id) covers
+# loading a batch's lines
+Index("ix_allocations_orderline_id", allocations.c.orderline_id, unique=True)
+Index("ix_allocations_batch_id", allocations.c.batch_id, allocations.c.orderline_id)
+
+allocations_view = Table(
+    "allocations_view",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("orderid", String(255), nullable=False),
+    Column("sku", String(255), nullable=False),
+    Column("qty", Integer, nullable=False),
+    Column("batchref", String(255), nullable=False),
+    # the product's version when the row was written; see read_replicas
+    Column("version_number", Integer, nullable=True),
+)
+Index(
+    "ix_allocations_view_orderid",
+    allocations_view.c.orderid,
+    allocations_view.c.sku,
+    allocations_view.c.batchref,
+)
+
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("sent_at", DateTime, nullable=True),
+)
+Index(
+    "ix_outbox_unsent",
+    outbox.c.id,
+    postgresql_where=outbox.c.sent_at.is_(None),
+)
+
+# where each batch lives when products are sharded; see adapters/sharding.py
+batch_shards = Table(
+    "batch_shards",
+    metadata,
+    Column("reference", String(255), primary_key=True),
+    Column("sku", String(255), nullable=False),
+    Column("shard", String(255), nullable=False),
+)
+Index("ix_batch_shards_sku", batch_shards.c.sku)
+
+# how far into its write-ahead log each allocation engine has flushed; see
+# service_layer/allocation_engine.py
+engine_checkpoints = Table(
+    "engine_checkpoints",
+    metadata,
+    Column("name", String(255), primary_key=True),
+    Column("lsn", Integer, nullable=False),
+)
+
+# the event-sourced store, see adapters/event_store.py: every event a product
+# raised, numbered per sku, and the latest snapshot of each product
+product_events = Table(
+    "product_events",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("seq", Integer, primary_key=True),
+    Column("type", String(255), nullable=False),
+    Column("batchref", String(255), nullable=True),
+    Column("data", Text, nullable=False),
+)
+Index("ix_product_events_batchref", product_events.c.batchref)
+
+product_snapshots = Table(
+    "product_snapshots",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("seq", Integer, nullable=False),
+    Column("version_number", Integer, nullable=False),
+    Column("state", Text, nullable=False),
+)
 
 
 def start_mappers():
@@ -54,10 +146,31 @@ def start_mappers():
         },
     )
     mapper(
-        model.Product, products, properties={"batches": relationship(batches_mapper)}
+        model.Product,
+        products,
+        properties={"batches": relationship(batches_mapper)},
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
 
 
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
     product.events = []
+    product._index = None
+
+
+@event.listens_for(model.Batch, "load")
+def receive_batch_load(batch, _):
+    batch._allocated_quantity = None
+
+
+@event.listens_for(model.Batch, "refresh")
+def receive_batch_refresh(batch, _, attrs):
+    batch._allocated_quantity = None
+
+
+@event.listens_for(model.Batch, "expire")
+def receive_batch_expire(batch, attrs):
+    if batch is not None:  # state may outlive its instance during commit
+        batch._allocated_quantity = None
@@ -0,0 +1,51 @@
+from datetime import datetime
+from typing import Iterable, List
+
+from sqlalchemy import select
+
+from allocation.adapters import orm, redis_eventpublisher
+from allocation.domain import events
+
+CHANNELS = {
+    events.Allocated: "line_allocated",
+    events.BatchCreated: "batch_created",
+}
+
+
+def add(session, new_events: Iterable[events.Event]):
+    rows = [
+        dict(
+            channel=CHANNELS[type(event)],
+            payload=redis_eventpublisher.encode(event),
+        )
+        for event in new_events
+        if type(event) in CHANNELS
+    ]
+    if rows:
+        session.execute(orm.outbox.insert(), rows)
+
+
+def fetch_pending(connection, limit: int) -> List:
+    # SKIP LOCKED lets several relays drain the table without double-sending
+    return connection.execute(
+        select(orm.outbox.c.id, orm.outbox.c.channel, orm.outbox.c.payload)
+        .where(orm.outbox.c.sent_at.is_(None))
+        .order_by(orm.outbox.c.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).fetchall()
+
+
+def mark_sent(connection, ids: List[int]):
+    connection.execute(
+        orm.outbox.update()
+        .where(orm.outbox.c.id.in_(ids))
+        .values(sent_at=datetime.utcnow())
+    )
+
+
+def prune(connection, sent_before: datetime) -> int:
+    """Delete rows sent before sent_before; unsent rows are never touched."""
+    return connection.execute(
+        orm.outbox.delete().where(orm.outbox.c.sent_at < sent_before)
+    ).rowcount
@@ -0,0 +1,100 @@
+import itertools
+import logging
+import threading
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = "primary"
+REPLICA = "replica"
+READ_YOUR_WRITES = "read_your_writes"
+POLICIES = (PRIMARY, REPLICA, READ_YOUR_WRITES)
+
+
+class ReadRouter:
+    """
+    Chooses where a read-only query runs.
+
+    "primary" sends every read to the primary. "replica" sends them to the
+    replicas in turn and accepts whatever lag they have. "read_your_writes"
+    does the same, except for orders this process has changed: for those we
+    remember the sku and the product version we committed, and only use a
+    replica whose allocations_view rows for the order carry that version or
+    a later one. The rows are written by the event handler after the
+    product commits, so checking the product itself would let a replica
+    through that doesn't have them yet. An order whose line was
+    deallocated and not reallocated has no row to check, and is read from
+    the primary until it is forgotten.
+
+    A replica we cannot query falls back to the primary. Every decision is
+    counted in stats().
+    """
+
+    def __init__(
+        self,
+        primary: Callable,
+        replicas: List[Callable] = (),
+        policy: str = READ_YOUR_WRITES,
+        max_remembered: int = 100_000,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown staleness policy {policy!r}")
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.policy = policy
+        self.max_remembered = max_remembered
+        self._next_replica = itertools.cycle(self.replicas)
+        self._written = {}  # type: Dict[str, Tuple[str, int]]
+        self._lock = threading.Lock()
+        self._counts = Counter()  # type: Counter
+
+    def note_write(self, orderid: str, sku: str, version: int):
+        with self._lock:
+            if len(self._written) >= self.max_remembered:
+                self._written.pop(next(iter(self._written)))
+            self._written.pop(orderid, None)
+            self._written[orderid] = (sku, version)
+
+    def session(self, orderid: str = None):
+        if self.policy == PRIMARY or not self.replicas:
+            return self._use_primary("primary")
+        with self._lock:
+            replica = next(self._next_replica)
+            written = self._written.get(orderid)
+        session = replica()
+        session.info["replica"] = True
+        try:
+            session.connection()
+            if self.policy == READ_YOUR_WRITES and written is not None:
+                sku, version = written
+                seen = session.execute(
+                    "SELECT MAX(version_number) FROM allocations_view"
+                    " WHERE orderid = :orderid AND sku = :sku",
+                    dict(orderid=orderid, sku=sku),
+                ).scalar()
+                if seen is None or seen < version:
+                    session.close()
+                    return self._use_primary("fallback_stale")
+                self._count("replica_checked")
+            else:
+                self._count("replica")
+            return session
+        except DBAPIError:
+            logger.warning("read replica unavailable, using primary", exc_info=True)
+            session.close()
+            return self._use_primary("fallback_error")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counts)
+
+    def _use_primary(self, reason):
+        self._count(reason)
+        return self.primary()
+
+    def _count(self, decision):
+        with self._lock:
+            self._counts[decision] += 1
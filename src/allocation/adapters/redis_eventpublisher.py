@@ -1,6 +1,9 @@
 import json
 import logging
-from dataclasses import asdict
+import threading
+import time
+from dataclasses import fields
+from typing import Callable, Dict, List, Optional, Tuple, Type
 import redis
 
 from allocation import config
@@ -8,9 +11,126 @@ from allocation.domain import events
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+SETTINGS = config.get_redis_publisher_settings()
 
+pool = redis.ConnectionPool(
+    max_connections=SETTINGS["max_connections"], **config.get_redis_host_and_port()
+)
+r = redis.Redis(connection_pool=pool)
 
-def publish(channel, event: events.Event):
-    logging.debug("publishing: channel=%s, event=%s", channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+_encoders = {}  # type: Dict[Type[events.Event], Callable[[events.Event], str]]
+
+
+def encode(event: events.Event) -> str:
+    """JSON for an event, without the deep copy that dataclasses.asdict makes."""
+    try:
+        encoder = _encoders[type(event)]
+    except KeyError:
+        encoder = _encoders[type(event)] = _make_encoder(type(event))
+    return encoder(event)
+
+
+def _make_encoder(event_class: Type[events.Event]) -> Callable[[events.Event], str]:
+    names = tuple(field.name for field in fields(event_class))
+    dumps = json.JSONEncoder(default=str).encode
+
+    def encoder(event):
+        return dumps({name: getattr(event, name) for name in names})
+
+    return encoder
+
+
+class BufferedPublisher:
+    """
+    Buffers (channel, payload) pairs and sends them through one pipeline
+    round trip, once max_batch are waiting, once the oldest has waited
+    max_delay seconds, or when flush() is called. A daemon thread, started
+    by the first publish(), sends what has waited max_delay even if nothing
+    else is published; close() stops it after a last flush.
+
+    The buffer is swapped out before the pipeline runs. If it fails, those
+    messages are dropped, not requeued: the caller that flushes (the outbox
+    relay) sees the error and does not mark the rows sent, so they are
+    published again from the outbox. A failure on the flusher thread is
+    raised from the next flush() for the same reason.
+    """
+
+    def __init__(
+        self,
+        client=r,
+        max_batch=SETTINGS["max_batch"],
+        max_delay=SETTINGS["max_delay"],
+    ):
+        self.client = client
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._buffer = []  # type: List[Tuple[str, str]]
+        self._oldest = 0.0
+        self._lock = threading.Lock()
+        self._due = threading.Condition(self._lock)
+        self._sending = threading.Lock()  # keeps round trips in publish order
+        self._failure = None  # type: Optional[Exception]
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_forever, daemon=True)
+
+    def publish(self, channel: str, payload: str):
+        with self._lock:
+            if not self._flusher.is_alive() and not self._closed:
+                self._flusher.start()
+            if not self._buffer:
+                self._oldest = time.monotonic()
+                self._due.notify()
+            self._buffer.append((channel, payload))
+            full = len(self._buffer) >= self.max_batch
+            due = time.monotonic() - self._oldest >= self.max_delay
+        if full or due:
+            self._send()
+
+    def flush(self):
+        self._send()
+        # a failure the flusher recorded while we waited for _sending
+        with self._sending:
+            failure, self._failure = self._failure, None
+        if failure is not None:
+            raise failure
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._due.notify()
+        if self._flusher.is_alive():
+            self._flusher.join()
+        self.flush()
+
+    def _send(self, record_failure=False):
+        with self._sending:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+            logger.debug("publishing %s messages", len(batch))
+            pipe = self.client.pipeline(transaction=False)
+            for channel, payload in batch:
+                pipe.publish(channel, payload)
+            try:
+                pipe.execute()
+            except Exception as e:
+                if record_failure:
+                    self._failure = e
+                raise
+
+    def _flush_forever(self):
+        while True:
+            with self._lock:
+                while not self._buffer and not self._closed:
+                    self._due.wait()
+                if self._closed:
+                    return
+                wait = self._oldest + self.max_delay - time.monotonic()
+                if wait > 0:
+                    self._due.wait(wait)
+                    continue
+            try:
+                self._send(record_failure=True)
+            except Exception:
+                logger.exception("dropped a batch of messages")
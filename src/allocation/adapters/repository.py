@@ -1,6 +1,11 @@
 import abc
 
-from allocation.adapters import orm
+from sqlalchemy import select
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+from sqlalchemy.orm.util import identity_key
+
+from allocation import instrumentation
+from allocation.adapters import aggregate_cache, orm
 from allocation.domain import model
 from typing import Set
 
@@ -14,13 +19,15 @@ class AbstractProductRepository(abc.ABC):
         self.seen.add(product)
 
     def get(self, sku) -> model.Product:
-        product = self._get(sku)
+        with instrumentation.span("repository_get", by="sku"):
+            product = self._get(sku)
         if product:
             self.seen.add(product)
         return product
 
     def get_by_batchref(self, batchref) -> model.Product:
-        product = self._get_by_batchref(batchref)
+        with instrumentation.span("repository_get", by="batchref"):
+            product = self._get_by_batchref(batchref)
         if product:
             self.seen.add(product)
         return product
@@ -38,21 +45,86 @@ class AbstractProductRepository(abc.ABC):
         raise NotImplementedError
 
 
+LOADING_STRATEGIES = ("lazy", "selectin", "joined", "single_query")
+
+
 class SqlAlchemyRepository(AbstractProductRepository):
-    def __init__(self, session):
+    """
+    loading decides how a product's batches and their allocations are fetched:
+    "lazy" on first access (1 + 1 + N queries), "selectin" in one extra query
+    per level, "joined" via LEFT OUTER JOINs on the product query, or
+    "single_query", a hand-written join that populates the whole aggregate.
+
+    With a cache, get() first tries the product the cache holds for the sku,
+    at the cost of one query for its version, and loads it only on a miss.
+    """
+
+    def __init__(
+        self,
+        session,
+        loading="selectin",
+        cache: aggregate_cache.AggregateCache = None,
+    ):
         super().__init__()
+        if loading not in LOADING_STRATEGIES:
+            raise ValueError(f"Unknown loading strategy {loading!r}")
         self.session = session
+        self.loading = loading
+        self.cache = cache
 
     def _add(self, product):
         self.session.add(product)
 
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        if self.cache is not None:
+            product = self._get_cached(sku)
+            if product is not None:
+                return product
+        return self._load(orm.products.c.sku == sku)
+
+    def _get_cached(self, sku):
+        if identity_key(model.Product, sku) in self.session.identity_map:
+            return None  # already loaded in this session
+        product = self.cache.take(sku, lambda: self._version_of(sku))
+        if product is not None:
+            self.session.add(product)
+            product.events = []
+        return product
+
+    def _version_of(self, sku):
+        return self.session.execute(
+            select(orm.products.c.version_number).where(orm.products.c.sku == sku)
+        ).scalar()
 
     def _get_by_batchref(self, batchref):
-        return (
-            self.session.query(model.Product)
-            .join(model.Batch)
-            .filter(orm.batches.c.reference == batchref)
-            .first()
+        sku_for_batch = (
+            select(orm.batches.c.sku)
+            .where(orm.batches.c.reference == batchref)
+            .scalar_subquery()
         )
+        return self._load(orm.products.c.sku == sku_for_batch)
+
+    def _load(self, criterion):
+        query = self.session.query(model.Product)
+        if self.loading == "single_query":
+            products = (
+                query.outerjoin(model.Product.batches)
+                .outerjoin(model.Batch._allocations)
+                .options(
+                    contains_eager(model.Product.batches).contains_eager(
+                        model.Batch._allocations
+                    )
+                )
+                .filter(criterion)
+                .all()
+            )
+            return products[0] if products else None
+        if self.loading == "selectin":
+            query = query.options(
+                selectinload(model.Product.batches).selectinload(model.Batch._allocations)
+            )
+        elif self.loading == "joined":
+            query = query.options(
+                joinedload(model.Product.batches).joinedload(model.Batch._allocations)
+            )
+        return query.filter(criterion).first()
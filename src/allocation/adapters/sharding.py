@@ -0,0 +1,191 @@
+import bisect
+import hashlib
+import logging
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+
+from allocation.adapters import orm
+from allocation.adapters.repository import AbstractProductRepository
+
+logger = logging.getLogger(__name__)
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of skus onto shard names. Each shard owns `replicas`
+    points on the ring and a sku belongs to the first point at or after its
+    own hash, so adding or removing a shard only moves the skus next to that
+    shard's points.
+    """
+
+    def __init__(self, shards: Iterable[str], replicas: int = 100):
+        self.shards = sorted(shards)
+        if not self.shards:
+            raise ValueError("A ring needs at least one shard")
+        points = sorted(
+            (_point(f"{shard}#{i}"), shard)
+            for shard in self.shards
+            for i in range(replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_for(self, sku: str) -> str:
+        i = bisect.bisect_left(self._points, _point(sku)) % len(self._points)
+        return self._owners[i]
+
+
+class ShardedRepository(AbstractProductRepository):
+    """
+    Sends each product to the repository for the shard its sku hashes to.
+    Lookups by batchref go through the batch_shards directory, read with the
+    home session.
+    """
+
+    def __init__(
+        self,
+        ring: HashRing,
+        repository_for: Callable[[str], AbstractProductRepository],
+        home_session,
+    ):
+        super().__init__()
+        self.ring = ring
+        self._repository_for = repository_for
+        self.home_session = home_session
+
+    def _add(self, product):
+        self._repository_for(self.ring.shard_for(product.sku)).add(product)
+
+    def _get(self, sku):
+        return self._repository_for(self.ring.shard_for(sku)).get(sku)
+
+    def _get_by_batchref(self, batchref):
+        shard = self.home_session.execute(
+            select(orm.batch_shards.c.shard).where(
+                orm.batch_shards.c.reference == batchref
+            )
+        ).scalar()
+        if shard is None:
+            return None
+        return self._repository_for(shard).get_by_batchref(batchref)
+
+
+def add_to_directory(home_session, placements: List[Tuple[str, str, str]]):
+    """
+    Record (batchref, sku, shard) for newly created batches. A row left by
+    a batch whose shard failed to commit is overwritten.
+    """
+    directory = orm.batch_shards
+    for ref, sku, shard in placements:
+        updated = home_session.execute(
+            directory.update()
+            .where(directory.c.reference == ref)
+            .values(sku=sku, shard=shard)
+        ).rowcount
+        if not updated:
+            home_session.execute(
+                directory.insert().values(reference=ref, sku=sku, shard=shard)
+            )
+
+
+def rebalance(
+    ring: HashRing, engines: Dict[str, Engine], home: Engine
+) -> List[Tuple[str, str, str]]:
+    """
+    Move every product that is not on the shard the ring assigns it to, and
+    return the (sku, from, to) moves made.
+
+    The ring already sends new writes for a moved sku to its new shard, so
+    run this with writers stopped. A move interrupted halfway is finished
+    by running it again.
+    """
+    moves = []
+    for shard, engine in engines.items():
+        with engine.connect() as connection:
+            skus = list(connection.execute(select(orm.products.c.sku)).scalars())
+        for sku in skus:
+            owner = ring.shard_for(sku)
+            if owner != shard:
+                move_product(sku, engine, engines[owner], home, owner)
+                moves.append((sku, shard, owner))
+    return moves
+
+
+def move_product(sku: str, source: Engine, target: Engine, home: Engine, shard: str):
+    """
+    Copy a product, its batches and their allocations to another shard,
+    point its batches at that shard in the directory, then delete the
+    original. Each step is its own transaction and safe to repeat.
+    """
+    logger.info("moving product %s to shard %s", sku, shard)
+    with target.begin() as dst:
+        present = dst.execute(
+            select(orm.products.c.sku).where(orm.products.c.sku == sku)
+        ).first()
+        if present is None:
+            with source.connect() as src:
+                _copy_product(sku, src, dst)
+    with home.begin() as connection:
+        connection.execute(
+            orm.batch_shards.update()
+            .where(orm.batch_shards.c.sku == sku)
+            .values(shard=shard)
+        )
+    with source.begin() as src:
+        _delete_product(sku, src)
+
+
+def _copy_product(sku, src, dst):
+    product = src.execute(
+        select(orm.products).where(orm.products.c.sku == sku)
+    ).one()
+    dst.execute(orm.products.insert(), dict(product._mapping))
+
+    batch_ids = {}  # type: Dict[int, int]
+    for batch in src.execute(select(orm.batches).where(orm.batches.c.sku == sku)):
+        row = dict(batch._mapping)
+        old_id = row.pop("id")
+        batch_ids[old_id] = dst.execute(
+            orm.batches.insert(), row
+        ).inserted_primary_key[0]
+
+    allocated = src.execute(
+        select(
+            orm.order_lines.c.orderid,
+            orm.order_lines.c.sku,
+            orm.order_lines.c.qty,
+            orm.allocations.c.batch_id,
+        )
+        .select_from(
+            orm.allocations.join(
+                orm.order_lines,
+                orm.allocations.c.orderline_id == orm.order_lines.c.id,
+            )
+        )
+        .where(orm.allocations.c.batch_id.in_(list(batch_ids)))
+    )
+    for line in allocated:
+        orderline_id = dst.execute(
+            orm.order_lines.insert(),
+            dict(orderid=line.orderid, sku=line.sku, qty=line.qty),
+        ).inserted_primary_key[0]
+        dst.execute(
+            orm.allocations.insert(),
+            dict(orderline_id=orderline_id, batch_id=batch_ids[line.batch_id]),
+        )
+
+
+def _delete_product(sku, src):
+    batch_ids = select(orm.batches.c.id).where(orm.batches.c.sku == sku)
+    src.execute(
+        orm.allocations.delete().where(orm.allocations.c.batch_id.in_(batch_ids))
+    )
+    src.execute(orm.order_lines.delete().where(orm.order_lines.c.sku == sku))
+    src.execute(orm.batches.delete().where(orm.batches.c.sku == sku))
+    src.execute(orm.products.delete().where(orm.products.c.sku == sku))
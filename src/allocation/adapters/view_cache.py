@@ -0,0 +1,162 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import redis
+
+from allocation import config
+
+GENERATION_STRIPES = 4096
+
+
+class LocalViewCache:
+    """
+    A bounded LRU cache with a time-to-live, private to this process.
+
+    Entries are invalidated by the message bus when an order's allocations
+    change. An update made by another process (the redis consumer, say) is
+    not seen here until the entry expires, so keep ttl short or use
+    RedisViewCache when that matters.
+
+    A reader takes generation(key) before it queries, and passes it to set(),
+    which stores nothing if the key was invalidated in between: otherwise
+    the value read before the change would be cached for the whole ttl.
+    Generations are kept per stripe of keys, so they take fixed space and
+    an invalidation occasionally costs an unrelated key one set().
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._generations = [0] * GENERATION_STRIPES
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[list]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, key: str) -> int:
+        with self._lock:
+            return self._generations[hash(key) % GENERATION_STRIPES]
+
+    def set(self, key: str, value: list, generation: int = None):
+        with self._lock:
+            stripe = hash(key) % GENERATION_STRIPES
+            if generation is not None and generation != self._generations[stripe]:
+                return
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generations[hash(key) % GENERATION_STRIPES] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations = [g + 1 for g in self._generations]
+
+    def stats(self) -> dict:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._entries),
+        )
+
+
+class RedisViewCache:
+    """
+    The same interface kept in Redis, so every worker sees an invalidation.
+    Redis expires entries itself; evictions are not counted here. A key's
+    generation is a counter next to it plus an epoch that clear() bumps,
+    and set() checks both under WATCH.
+    """
+
+    def __init__(self, client, ttl=60.0, prefix="allocations_view:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = self.misses = self.evictions = 0
+        self._epoch_key = prefix + "epoch"
+
+    def get(self, key: str) -> Optional[list]:
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def generation(self, key: str) -> Tuple[int, int]:
+        return self._generation(self.client, key)
+
+    def set(self, key: str, value: list, generation: Tuple[int, int] = None):
+        ttl_ms = int(self.ttl * 1000)
+        if generation is None:
+            self.client.set(self.prefix + key, json.dumps(value), px=ttl_ms)
+            return
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self._epoch_key, self.prefix + "generation:" + key)
+                if self._generation(pipe, key) != generation:
+                    return
+                pipe.multi()
+                pipe.set(self.prefix + key, json.dumps(value), px=ttl_ms)
+                pipe.execute()
+            except redis.WatchError:
+                pass  # invalidated while we were setting
+
+    def invalidate(self, key: str):
+        generation_key = self.prefix + "generation:" + key
+        with self.client.pipeline() as pipe:
+            pipe.delete(self.prefix + key)
+            pipe.incr(generation_key)
+            # outlives any read that could have started before this
+            pipe.pexpire(generation_key, int(self.ttl * 1000))
+            pipe.execute()
+
+    def clear(self):
+        # a read that started before this must not store its rows after it
+        self.client.incr(self._epoch_key)
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            if key not in (self._epoch_key, self._epoch_key.encode()):
+                self.client.delete(key)
+
+    def _generation(self, client, key: str) -> Tuple[int, int]:
+        epoch, generation = client.mget(
+            self._epoch_key, self.prefix + "generation:" + key
+        )
+        return int(epoch or 0), int(generation or 0)
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+def from_config():
+    settings = config.get_view_cache_settings()
+    if settings["backend"] == "redis":
+        from allocation.adapters import redis_eventpublisher
+
+        return RedisViewCache(redis_eventpublisher.r, ttl=settings["ttl"])
+    return LocalViewCache(maxsize=settings["maxsize"], ttl=settings["ttl"])
+
+
+allocations_cache = from_config()
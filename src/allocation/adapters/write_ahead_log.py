@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+from typing import Iterable, Iterator, List, Tuple
+
+from allocation.adapters import event_codec
+from allocation.domain import events
+
+SEGMENT_PREFIX = "segment-"
+
+
+class WriteAheadLog:
+    """
+    An append-only log of events, kept in a directory as segment files of
+    one JSON object per line, each with its log sequence number (LSN).
+
+    append() writes a group of events and fsyncs once for all of them.
+    roll() starts a new segment, so that once everything up to some LSN is
+    stored elsewhere, discard_through() deletes whole files instead of
+    rewriting one. Each process appends to a fresh segment, so a line torn
+    by a crash is always the last in its file and replay() stops there: it
+    was never acknowledged.
+
+    Once every segment has been discarded the directory no longer knows
+    where numbering got to, so whoever checkpoints must call
+    continue_from() with the checkpointed LSN before the first append.
+
+    One thread appends and rolls; discard_through() may run on another.
+    """
+
+    def __init__(self, directory: str, fsync: bool = True):
+        self.directory = directory
+        self.fsync = fsync
+        self.syncs = 0
+        self._file = None
+        self._first_lsn = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.last_lsn = self._last_lsn_on_disk()
+        # (last LSN, path) of each segment no longer appended to
+        segments = self._segments()
+        ends = [first_lsn - 1 for first_lsn, _ in segments[1:]] + [self.last_lsn]
+        self._closed = [(end, path) for end, (_, path) in zip(ends, segments)]
+
+    def continue_from(self, lsn: int):
+        """Number new events after lsn, if the segments on disk end before it."""
+        self.last_lsn = max(self.last_lsn, lsn)
+
+    def append(self, new_events: Iterable[events.Event]) -> int:
+        lines = []
+        for event in new_events:
+            self.last_lsn += 1
+            record = dict(lsn=self.last_lsn, event=event_codec.to_dict(event))
+            lines.append(json.dumps(record) + "\n")
+        if not lines:
+            return self.last_lsn
+        if self._file is None:
+            self._first_lsn = self.last_lsn - len(lines) + 1
+            self._file = open(self._path(self._first_lsn), "x")
+            self._sync_directory()
+        self._file.write("".join(lines))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.syncs += 1
+        return self.last_lsn
+
+    def replay(self, after_lsn: int = 0) -> Iterator[Tuple[int, events.Event]]:
+        for _, path in self._segments():
+            for lsn, data in _read_segment(path):
+                if lsn > after_lsn:
+                    yield lsn, event_codec.from_dict(data)
+
+    def roll(self):
+        if self._file is not None:
+            with self._lock:
+                self._closed.append((self.last_lsn, self._path(self._first_lsn)))
+        self.close()
+
+    def discard_through(self, lsn: int):
+        """Delete the segments that hold nothing after lsn."""
+        with self._lock:
+            discarded = [path for end, path in self._closed if end <= lsn]
+            self._closed = [(end, path) for end, path in self._closed if end > lsn]
+        for path in discarded:
+            os.remove(path)
+        if discarded:
+            self._sync_directory()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _sync_directory(self):
+        # a new or removed file name is only durable once its directory is
+        if not self.fsync:
+            return
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _path(self, first_lsn: int) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{first_lsn:020d}.jsonl")
+
+    def _segments(self) -> List[Tuple[int, str]]:
+        return sorted(
+            (
+                int(name[len(SEGMENT_PREFIX) : -len(".jsonl")]),
+                os.path.join(self.directory, name),
+            )
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX)
+        )
+
+    def _last_lsn_on_disk(self) -> int:
+        segments = self._segments()
+        if not segments:
+            return 0
+        first_lsn, path = segments[-1]
+        last_lsn = first_lsn - 1
+        for last_lsn, _ in _read_segment(path):
+            pass
+        if last_lsn < first_lsn:
+            # nothing but a torn line; we'll want its name for the next append
+            os.remove(path)
+            self._sync_directory()
+        return last_lsn
+
+
+def _read_segment(path: str) -> Iterator[Tuple[int, dict]]:
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return  # torn by a crash mid-append
+            yield record["lsn"], record["event"]
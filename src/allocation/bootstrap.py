@@ -0,0 +1,67 @@
+import functools
+import inspect
+from typing import Callable, Dict, List, Type
+
+from allocation import config
+from allocation.adapters import email, orm, view_cache
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, messagebus, unit_of_work
+
+
+def bootstrap(
+    start_orm: bool = True,
+    uow_factory: Callable = unit_of_work.SqlAlchemyUnitOfWork,
+    send_mail: Callable = email.send_mail,
+    cache=None,
+    evict: str = None,
+    event_handlers: Dict[Type[events.Event], List[Callable]] = None,
+    command_handlers: Dict[Type[commands.Command], Callable] = None,
+    retry_policy: dict = None,
+) -> messagebus.MessageBus:
+    if start_orm:
+        orm.start_mappers()
+
+    if event_handlers is None:
+        event_handlers = handlers.EVENT_HANDLERS
+    if command_handlers is None:
+        command_handlers = handlers.COMMAND_HANDLERS
+    dependencies = dict(
+        send_mail=send_mail,
+        cache=cache if cache is not None else view_cache.allocations_cache,
+        evict=evict or config.get_eviction_policy(),
+    )
+    injected_event_handlers = {
+        event_type: [inject_dependencies(h, dependencies) for h in handler_list]
+        for event_type, handler_list in event_handlers.items()
+    }
+    injected_command_handlers = {
+        command_type: inject_dependencies(handler, dependencies)
+        for command_type, handler in command_handlers.items()
+    }
+    return messagebus.MessageBus(
+        uow_factory=uow_factory,
+        event_handlers=injected_event_handlers,
+        command_handlers=injected_command_handlers,
+        retry_policy=retry_policy,
+    )
+
+
+def inject_dependencies(handler, dependencies):
+    params = inspect.signature(handler).parameters
+    deps = {
+        name: dependency
+        for name, dependency in dependencies.items()
+        if name in params
+    }
+    if "uow" in params:
+        # the bus passes (message, uow) positionally, which every handler
+        # taking a uow accepts: a partial adds no Python frame per call
+        if not deps:
+            return handler
+        return functools.update_wrapper(functools.partial(handler, **deps), handler)
+
+    @functools.wraps(handler)
+    def without_uow(message, uow):
+        return handler(message, **deps)
+
+    return without_uow
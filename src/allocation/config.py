@@ -9,6 +9,56 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_isolation_level():
+    return os.environ.get("DB_ISOLATION_LEVEL", "REPEATABLE READ")
+
+
+def get_shard_uris():
+    shards = os.environ.get("DB_SHARDS", "")  # name=uri,name=uri
+    return dict(entry.split("=", 1) for entry in shards.split(",") if entry)
+
+
+def get_read_replica_uris():
+    replicas = os.environ.get("DB_READ_REPLICAS", "")
+    return [uri for uri in replicas.split(",") if uri]
+
+
+def get_read_staleness_policy():
+    return os.environ.get("READ_STALENESS", "read_your_writes")
+
+
+def get_eviction_policy():
+    return os.environ.get("EVICTION_POLICY", "largest-first")
+
+
+def get_command_retry_policy():
+    attempts = int(os.environ.get("COMMAND_RETRY_ATTEMPTS", 5))
+    base_delay = float(os.environ.get("COMMAND_RETRY_BASE_DELAY", 0.01))
+    return dict(attempts=attempts, base_delay=base_delay)
+
+
+def get_message_bus_settings():
+    return dict(
+        concurrent=os.environ.get("MESSAGE_BUS", "serial") == "concurrent",
+        lanes=int(os.environ.get("MESSAGE_BUS_LANES", 8)),
+        event_workers=int(os.environ.get("MESSAGE_BUS_EVENT_WORKERS", 4)),
+        max_pending_events=int(os.environ.get("MESSAGE_BUS_MAX_PENDING_EVENTS", 1000)),
+    )
+
+
+def get_view_cache_settings():
+    return dict(
+        backend=os.environ.get("VIEW_CACHE_BACKEND", "local"),
+        maxsize=int(os.environ.get("VIEW_CACHE_MAXSIZE", 10000)),
+        ttl=float(os.environ.get("VIEW_CACHE_TTL", 30)),
+    )
+
+
+def get_instrumentation_exporters():
+    exporters = os.environ.get("INSTRUMENTATION", "")  # prometheus,spans
+    return [name for name in exporters.split(",") if name]
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
@@ -19,3 +69,57 @@ def get_redis_host_and_port():
     host = os.environ.get("REDIS_HOST", "localhost")
     port = 63791 if host == "localhost" else 6379
     return dict(host=host, port=port)
+
+
+def get_redis_consumer_settings():
+    return dict(
+        mode=os.environ.get("REDIS_CONSUMER_MODE", "pubsub"),
+        consumer=os.environ.get("REDIS_CONSUMER_NAME", "allocation-1"),
+        batch_size=int(os.environ.get("REDIS_CONSUMER_BATCH_SIZE", 100)),
+        block_ms=int(os.environ.get("REDIS_CONSUMER_BLOCK_MS", 1000)),
+        workers=int(os.environ.get("REDIS_CONSUMER_WORKERS", 4)),
+    )
+
+
+def get_redis_publisher_settings():
+    return dict(
+        max_connections=int(os.environ.get("REDIS_MAX_CONNECTIONS", 10)),
+        max_batch=int(os.environ.get("REDIS_PUBLISH_MAX_BATCH", 500)),
+        max_delay=float(os.environ.get("REDIS_PUBLISH_MAX_DELAY", 0.05)),
+    )
+
+
+def get_db_pool_settings():
+    return dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "0") == "1",
+        query_cache_size=int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 500)),
+    )
+
+
+def get_db_reuse_connection():
+    return os.environ.get("DB_REUSE_CONNECTION", "1") == "1"
+
+
+def get_allocation_engine_settings():
+    skus = os.environ.get("ENGINE_SKUS", "")  # hot skus held in memory
+    return dict(
+        skus={sku for sku in skus.split(",") if sku},
+        log_dir=os.environ.get("ENGINE_LOG_DIR", "/var/lib/allocation/wal"),
+        max_group=int(os.environ.get("ENGINE_MAX_GROUP", 256)),
+        flush_interval=float(os.environ.get("ENGINE_FLUSH_INTERVAL", 1.0)),
+    )
+
+
+def get_product_store_settings():
+    return dict(
+        events=os.environ.get("PRODUCT_STORE", "tables") == "events",
+        snapshot_every=int(os.environ.get("PRODUCT_SNAPSHOT_EVERY", 100)),
+    )
+
+
+def get_aggregate_cache_size():
+    # products kept between requests; 0 turns the cache off
+    return int(os.environ.get("AGGREGATE_CACHE_SIZE", 0))
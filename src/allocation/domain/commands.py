@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional
 from datetime import date
 
 
@@ -22,7 +22,17 @@ class Allocate(Command):
     qty: int
 
 
+@dataclass
+class AllocateMany(Command):
+    lines: List[Allocate]
+
+
 @dataclass
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
+
+
+@dataclass
+class RebuildAllocationsView(Command):
+    pass
@@ -1,4 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from datetime import date
+from typing import List, Optional
 
 
 class Event:
@@ -10,9 +12,33 @@ class OutOfStock(Event):
     sku: str
 
 
+@dataclass
+class BatchCreated(Event):
+    ref: str
+    sku: str
+    qty: int
+    eta: Optional[date] = None
+
+
 @dataclass
 class Allocated(Event):
     orderid: str
     sku: str
     qty: int
     batchref: str
+
+
+@dataclass
+class Deallocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass
+class BatchQuantityChanged(Event):
+    batchref: str
+    sku: str
+    qty: int
+    deallocated: List[Deallocated] = field(default_factory=list)
@@ -1,12 +1,16 @@
+import bisect
 from dataclasses import dataclass
 from datetime import date
-from allocation.domain import events, commands
-from typing import Optional, NewType, List
+from allocation.domain import events
+from typing import Iterator, Optional, NewType, List
 
 Quantity = NewType("Quantity", int)
 Sku = NewType("Sku", str)
 Reference = NewType("Reference", str)
 
+LARGEST_FIRST = "largest-first"
+SMALLEST_FIRST = "smallest-first"
+
 
 @dataclass(unsafe_hash=True)
 class OrderLine:
@@ -24,9 +28,11 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            self._allocated_quantity = self.allocated_quantity + line.qty
             self._allocations.add(line)
 
     def can_allocate(self, line: OrderLine) -> bool:
@@ -34,14 +40,40 @@ class Batch:
 
     def deallocate(self, line: OrderLine) -> bool:
         if line in self._allocations:
+            self._allocated_quantity = self.allocated_quantity - line.qty
             self._allocations.remove(line)
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated - line.qty
+        return line
+
+    def deallocate_to_fit(self, evict: str = LARGEST_FIRST) -> List[OrderLine]:
+        """
+        Deallocate lines until the batch is no longer over-allocated and
+        return them. Evicting the largest lines first frees the shortfall
+        with the fewest evictions; smallest-first disturbs the fewest units.
+        """
+        if self.available_quantity >= 0:
+            return []
+        evicted = []
+        for line in sorted(
+            self._allocations, key=lambda l: l.qty, reverse=evict == LARGEST_FIRST
+        ):
+            if self.available_quantity >= 0:
+                break
+            self.deallocate(line)
+            evicted.append(line)
+        return evicted
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # running total; reset to None by the ORM whenever _allocations is
+        # (re)loaded from the database, and recomputed once on next access
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -66,21 +98,101 @@ class Batch:
         return self.eta > other.eta
 
 
+def allocation_order(batch: Batch):
+    # warehouse stock (no eta) first, then shipments by eta
+    return (batch.eta is not None, batch.eta or date.min)
+
+
+class BatchIndex:
+    """
+    A product's batches in allocation order, plus a max-tree over their
+    available quantities so allocation can skip whole runs of batches that
+    are too small for a line instead of testing each one.
+    """
+
+    _EMPTY = float("-inf")
+
+    def __init__(self, batches: List[Batch]):
+        self._batches = sorted(batches, key=allocation_order)
+        self._keys = [allocation_order(b) for b in self._batches]
+        self._rebuild()
+
+    def __len__(self):
+        return len(self._batches)
+
+    def add(self, batch: Batch):
+        key = allocation_order(batch)
+        position = bisect.bisect_right(self._keys, key)
+        self._keys.insert(position, key)
+        self._batches.insert(position, batch)
+        self._rebuild()
+
+    def update(self, batch: Batch):
+        node = self._leaves + self._positions[batch.reference]
+        self._tree[node] = batch.available_quantity
+        node //= 2
+        while node:
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+            node //= 2
+
+    def candidates(self, qty: int) -> Iterator[Batch]:
+        """Batches with at least qty available, in allocation order."""
+        stack = [1]
+        while stack:
+            node = stack.pop()
+            if self._tree[node] < qty:
+                continue
+            if node >= self._leaves:
+                yield self._batches[node - self._leaves]
+            else:
+                stack.append(2 * node + 1)
+                stack.append(2 * node)
+
+    def _rebuild(self):
+        self._positions = {b.reference: i for i, b in enumerate(self._batches)}
+        self._leaves = 1
+        while self._leaves < len(self._batches):
+            self._leaves *= 2
+        self._tree = [self._EMPTY] * (2 * self._leaves)
+        for i, batch in enumerate(self._batches):
+            self._tree[self._leaves + i] = batch.available_quantity
+        for node in range(self._leaves - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+
 class OutOfStock(Exception):
     pass
 
 
+class CannotReplay(Exception):
+    """An event doesn't fit the product it is replayed onto."""
+
+
 class Product:
     def __init__(self, sku: str, batches: List[Batch], version_number: int = 0):
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
         self.events = []  # type: List[events.Event]
+        self._index = None  # type: Optional[BatchIndex]
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        self.version_number += 1
+        if self._index is not None:
+            self._index.add(batch)
+        self.events.append(
+            events.BatchCreated(
+                batch.reference, self.sku, batch._purchased_quantity, batch.eta
+            )
+        )
 
     def allocate(self, line: OrderLine) -> str:
+        index = self._batch_index()
         try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
+            batch = next(b for b in index.candidates(line.qty) if b.can_allocate(line))
             batch.allocate(line)
+            index.update(batch)
             self.version_number += 1
             self.events.append(
                 events.Allocated(
@@ -95,9 +207,73 @@ class Product:
             self.events.append(events.OutOfStock(line.sku))
             return None
 
-    def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
+    def change_batch_quantity(self, ref: str, qty: int, evict: str = LARGEST_FIRST):
+        batch = self._batch(ref)
         batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(commands.Allocate(line.orderid, line.sku, line.qty))
+        self.version_number += 1
+        evicted = batch.deallocate_to_fit(evict)
+        self._batch_index().update(batch)
+        self.events.append(
+            events.BatchQuantityChanged(
+                batchref=ref,
+                sku=self.sku,
+                qty=qty,
+                deallocated=[
+                    events.Deallocated(line.orderid, line.sku, line.qty, ref)
+                    for line in evicted
+                ],
+            )
+        )
+        for line in evicted:
+            self.allocate(line)
+
+    def replay(self, event: events.Event):
+        """
+        Redo the change an event recorded, without deciding anything again:
+        the line goes to the batch the event names. Nothing is appended to
+        self.events. Raises CannotReplay if that batch can no longer take
+        the line, since someone else has changed the product in between.
+        """
+        if isinstance(event, events.BatchCreated):
+            self.add_batch(Batch(event.ref, event.sku, event.qty, event.eta))
+            self.events.pop()
+        elif isinstance(event, events.Allocated):
+            batch = self._batch(event.batchref)
+            line = OrderLine(event.orderid, event.sku, event.qty)
+            if line not in batch._allocations and not batch.can_allocate(line):
+                raise CannotReplay(f"{batch} can't take {line} again")
+            batch.allocate(line)
+            self._batch_index().update(batch)
+            self.version_number += 1
+        elif isinstance(event, events.BatchQuantityChanged):
+            batch = self._batch(event.batchref)
+            batch._purchased_quantity = event.qty
+            for line in event.deallocated:
+                batch.deallocate(OrderLine(line.orderid, line.sku, line.qty))
+            self._batch_index().update(batch)
+            self.version_number += 1
+
+    def as_events(self) -> List[events.Event]:
+        """Events that replay() turns into a copy of this product as it is now."""
+        recreated = []  # type: List[events.Event]
+        for batch in self.batches:
+            recreated.append(
+                events.BatchCreated(
+                    batch.reference, self.sku, batch._purchased_quantity, batch.eta
+                )
+            )
+            recreated.extend(
+                events.Allocated(line.orderid, line.sku, line.qty, batch.reference)
+                for line in batch._allocations
+            )
+        return recreated
+
+    def _batch(self, ref: str) -> Batch:
+        return next(b for b in self.batches if b.reference == ref)
+
+    def _batch_index(self) -> BatchIndex:
+        # built lazily, and rebuilt if batches were appended behind our back
+        # (e.g. by the ORM loading the collection)
+        if self._index is None or len(self._index) != len(self.batches):
+            self._index = BatchIndex(self.batches)
+        return self._index
@@ -1,13 +1,33 @@
-from flask import Flask, jsonify, request
+import io
+import itertools
+import json
 
+from flask import Flask, Response, jsonify, request
+
+from allocation.adapters import batch_ingest
 from allocation.domain import model, commands
-from allocation.adapters import orm
-from allocation.service_layer import messagebus, unit_of_work, handlers
-from allocation import views
+from allocation.entrypoints import ingest_batches
+from allocation.service_layer import (
+    allocation_engine,
+    concurrent_messagebus,
+    unit_of_work,
+    handlers,
+)
+from allocation import bootstrap, config, instrumentation, views
 from datetime import datetime
 
 
-orm.start_mappers()
+REUSE_CONNECTION = config.get_db_reuse_connection()
+instrumentation.configure(instrumentation.from_config())
+bus = allocation_engine.configured_engine(
+    concurrent_messagebus.configured_bus(
+        bootstrap.bootstrap(
+            uow_factory=lambda: unit_of_work.configured_uow(
+                reuse_connection=REUSE_CONNECTION
+            )
+        )
+    )
+)
 app = Flask(__name__)
 
 
@@ -17,7 +37,7 @@ def allocate_endpoint():
         command = commands.Allocate(
             request.json["orderid"], request.json["sku"], request.json["qty"]
         )
-        results = messagebus.handle(command, unit_of_work.SqlAlchemyUnitOfWork())
+        results = bus.handle(command)
         batchref = results.pop(0)
     except (model.OutOfStock, handlers.InvalidSku) as e:
         return jsonify({"message": str(e)}), 400
@@ -25,6 +45,28 @@ def allocate_endpoint():
     return jsonify({"batchref": batchref}), 202
 
 
+@app.route("/allocate_many", methods=["POST"])
+def allocate_many_endpoint():
+    command = commands.AllocateMany(
+        [
+            commands.Allocate(line["orderid"], line["sku"], line["qty"])
+            for line in request.json["lines"]
+        ]
+    )
+    results = bus.handle(command).pop(0)
+    return (
+        jsonify(
+            [
+                {"message": str(result)}
+                if isinstance(result, Exception)
+                else {"batchref": result}
+                for result in results
+            ]
+        ),
+        202,
+    )
+
+
 @app.route("/add_batch", methods=["POST"])
 def add_batch():
     eta = request.json["eta"]
@@ -33,14 +75,88 @@ def add_batch():
     command = commands.CreateBatch(
         request.json["ref"], request.json["sku"], request.json["qty"], eta
     )
-    messagebus.handle(command, unit_of_work.SqlAlchemyUnitOfWork())
+    bus.handle(command)
     return "OK", 201
 
 
+@app.route("/ingest_batches", methods=["POST"])
+def ingest_batches_endpoint():
+    """Stream a CSV (text/csv) or JSON lines feed of batches into the tables."""
+    reason = ingest_batches.unsupported_reason()
+    if reason:
+        return jsonify({"message": reason}), 409
+    feed_format = "csv" if request.mimetype == "text/csv" else "ndjson"
+    lines = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+    engine = unit_of_work.DEFAULT_SESSION_FACTORY.kw["bind"]
+    try:
+        counts = batch_ingest.ingest(
+            engine,
+            batch_ingest.READERS[feed_format](lines),
+            held_skus=config.get_allocation_engine_settings()["skus"],
+            hand_over=bus.handle,
+        )
+    except batch_ingest.InvalidFeed as e:
+        return jsonify(dict(e.counts, message=str(e))), 400
+    return jsonify(counts), 201
+
+
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
-    uow = unit_of_work.SqlAlchemyUnitOfWork()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        read_router=unit_of_work.DEFAULT_READ_ROUTER
+    )
     result = views.allocations(orderid, uow)
     if not result:
         return "not found", 404
     return jsonify(result), 200
+
+
+@app.route("/allocations", methods=["GET"])
+def allocations_export_endpoint():
+    """Allocations filtered by sku, batchref and orderid_prefix, as JSON lines."""
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        read_router=unit_of_work.DEFAULT_READ_ROUTER
+    )
+    rows = views.export_allocations(
+        uow,
+        sku=request.args.get("sku"),
+        batchref=request.args.get("batchref"),
+        orderid_prefix=request.args.get("orderid_prefix"),
+    )
+    return Response(_ndjson(rows), mimetype="application/x-ndjson")
+
+
+def _ndjson(rows, rows_per_write=views.EXPORT_CHUNK_SIZE):
+    # no Content-Length, so the body goes out with chunked transfer encoding
+    while True:
+        chunk = itertools.islice(rows, rows_per_write)
+        lines = [json.dumps(row) + "\n" for row in chunk]
+        if not lines:
+            return
+        yield "".join(lines)
+
+
+@app.route("/metrics/pool", methods=["GET"])
+def pool_metrics_endpoint():
+    engine = unit_of_work.DEFAULT_SESSION_FACTORY.kw["bind"]
+    return jsonify(engine.pool.metrics()), 200
+
+
+@app.route("/metrics/reads", methods=["GET"])
+def read_routing_metrics_endpoint():
+    return jsonify(unit_of_work.DEFAULT_READ_ROUTER.stats()), 200
+
+
+@app.route("/metrics/aggregates", methods=["GET"])
+def aggregate_cache_metrics_endpoint():
+    if unit_of_work.DEFAULT_AGGREGATE_CACHE is None:
+        return jsonify({}), 200
+    return jsonify(unit_of_work.DEFAULT_AGGREGATE_CACHE.stats()), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(
+        instrumentation.active().prometheus_text(),
+        mimetype="text/plain; version=0.0.4",
+    )
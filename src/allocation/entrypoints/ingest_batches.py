@@ -0,0 +1,56 @@
+import argparse
+import logging
+import sys
+
+from sqlalchemy import create_engine
+
+from allocation import config
+from allocation.adapters import batch_ingest
+
+
+def main():
+    """
+    Load a purchasing feed of batches, CSV or JSON lines, straight into the
+    batches table:
+
+        python -m allocation.entrypoints.ingest_batches feed.csv
+    """
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=sorted(batch_ingest.READERS))
+    parser.add_argument("--chunk-size", type=int, default=batch_ingest.CHUNK_SIZE)
+    args = parser.parse_args()
+    reason = unsupported_reason()
+    if reason:
+        sys.exit(reason)
+    feed_format = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+
+    engine = create_engine(config.get_postgres_uri())
+    with open(args.path, newline="") as lines:
+        try:
+            counts = batch_ingest.ingest(
+                engine,
+                batch_ingest.READERS[feed_format](lines),
+                args.chunk_size,
+                # the engine runs in the API process; we can't hand it these
+                held_skus=config.get_allocation_engine_settings()["skus"],
+            )
+        except batch_ingest.InvalidFeed as e:
+            sys.exit(f"{args.path}: {e}; ingested {e.counts['batches']} before it")
+    print(f"ingested {counts['batches']} batches, skipped {counts['skipped']}")
+    if counts["rejected"]:
+        print(f"rejected {counts['rejected']} for ENGINE_SKUS; POST them to the API")
+
+
+def unsupported_reason():
+    """Why this deployment keeps batches somewhere bulk ingest does not write."""
+    if config.get_shard_uris():
+        return "DB_SHARDS is set: bulk ingest only writes the home database"
+    if config.get_product_store_settings()["events"]:
+        return "PRODUCT_STORE=events: bulk ingest only writes the batches table"
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+import redis
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from allocation import config, instrumentation
+from allocation.adapters import outbox, redis_eventpublisher
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+POLL_INTERVAL = 0.1
+MAX_BACKOFF = 10.0
+PRUNE_INTERVAL = 60.0
+KEEP_SENT_FOR = timedelta(hours=1)
+
+
+def main():
+    instrumentation.configure(instrumentation.from_config())
+    # sharded products write their outbox rows on their shard
+    uris = [config.get_postgres_uri()] + list(config.get_shard_uris().values())
+    engines = [create_engine(uri) for uri in uris]
+    publisher = redis_eventpublisher.BufferedPublisher()
+    backoff = POLL_INTERVAL
+    pruned_at = 0.0
+    while True:
+        if time.monotonic() - pruned_at >= PRUNE_INTERVAL:
+            if try_relay(prune_all, engines) is not None:
+                pruned_at = time.monotonic()
+        relayed = try_relay(relay_all, engines, publisher)
+        if relayed is None:
+            # postgres not up or its tables not created yet, or redis down
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+            continue
+        backoff = POLL_INTERVAL
+        if not relayed:
+            time.sleep(POLL_INTERVAL)
+
+
+def try_relay(job, *args) -> Optional[int]:
+    """Run job, or log why it failed and return None so the caller backs off."""
+    try:
+        return job(*args)
+    except (OperationalError, ProgrammingError, redis.RedisError):
+        logger.warning("outbox relay failed, will retry", exc_info=True)
+        return None
+
+
+def relay_all(engines, publisher, batch_size=BATCH_SIZE) -> int:
+    """Relay a batch from each database in turn."""
+    return sum(relay_batch(engine, publisher, batch_size) for engine in engines)
+
+
+def prune_all(engines, keep_sent_for=KEEP_SENT_FOR) -> int:
+    """Delete the rows sent more than keep_sent_for ago from each outbox."""
+    sent_before = datetime.utcnow() - keep_sent_for
+    pruned = 0
+    for engine in engines:
+        with engine.begin() as connection:
+            pruned += outbox.prune(connection, sent_before)
+    return pruned
+
+
+def relay_batch(engine, publisher, batch_size=BATCH_SIZE) -> int:
+    """
+    Publish the oldest unsent outbox rows and mark them sent, in one
+    transaction. The publisher is flushed before the transaction commits.
+    If we die after publishing but before committing, the rows are sent
+    again: delivery is at-least-once.
+    """
+    with engine.begin() as connection:
+        rows = outbox.fetch_pending(connection, batch_size)
+        if rows:
+            logger.debug("relaying %s outbox messages", len(rows))
+            with instrumentation.span("redis_publish"):
+                for row in rows:
+                    publisher.publish(row.channel, row.payload)
+                publisher.flush()
+            instrumentation.increment("events_published", len(rows))
+            outbox.mark_sent(connection, [row.id for row in rows])
+    return len(rows)
+
+
+if __name__ == "__main__":
+    main()
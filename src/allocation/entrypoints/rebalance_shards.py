@@ -0,0 +1,26 @@
+import logging
+import sys
+
+from sqlalchemy import create_engine
+
+from allocation import config
+from allocation.adapters import sharding
+
+
+def main():
+    """
+    Move products onto the shards the ring assigns them to, e.g. after
+    adding a database to DB_SHARDS. Stop the writers first.
+    """
+    logging.basicConfig(level=logging.INFO)
+    uris = config.get_shard_uris()
+    if not uris:
+        sys.exit("DB_SHARDS is not set")
+    engines = {name: create_engine(uri) for name, uri in uris.items()}
+    home = create_engine(config.get_postgres_uri())
+    moves = sharding.rebalance(sharding.HashRing(engines), engines, home)
+    print(f"moved {len(moves)} products")
+
+
+if __name__ == "__main__":
+    main()
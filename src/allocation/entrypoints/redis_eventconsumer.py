@@ -1,31 +1,207 @@
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 import redis
+from sqlalchemy import select
 
-from allocation import config
-from allocation.domain import commands
+from allocation import bootstrap, config, instrumentation
 from allocation.adapters import orm
-from allocation.service_layer import messagebus, unit_of_work
+from allocation.domain import commands
+from allocation.service_layer import concurrent_messagebus, unit_of_work
 
 logger = logging.getLogger(__name__)
 
 r = redis.Redis(**config.get_redis_host_and_port())
+REUSE_CONNECTION = config.get_db_reuse_connection()
+
+STREAM = "change_batch_quantity"
+GROUP = "allocation"
+# APPLIED + batchref -> id of the newest entry applied to it, kept for twice
+# as long as entries are kept in the stream; see consume_stream
+APPLIED = "change_batch_quantity:applied:"
+RETENTION = 24 * 60 * 60
+LAG_REPORT_INTERVAL = 10
+RETRY_INTERVAL = 5
+# held by the AllocationEngine in the API process; see held_by_engine
+ENGINE_SKUS = config.get_allocation_engine_settings()["skus"]
 
 
 def main():
-    orm.start_mappers()
+    instrumentation.configure(instrumentation.from_config())
+    bus = concurrent_messagebus.configured_bus(
+        bootstrap.bootstrap(
+            uow_factory=lambda: unit_of_work.configured_uow(
+                reuse_connection=REUSE_CONNECTION
+            )
+        )
+    )
+    settings = config.get_redis_consumer_settings()
+    if settings.pop("mode") == "streams":
+        consume_stream(
+            redis.Redis(decode_responses=True, **config.get_redis_host_and_port()),
+            bus,
+            **settings,
+        )
+        return
+
     pubsub = r.pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe("change_batch_quantity")
 
     for m in pubsub.listen():
-        handle_change_batch_quantity(m)
+        handle_change_batch_quantity(m, bus)
 
 
-def handle_change_batch_quantity(m):
+def handle_change_batch_quantity(m, bus):
     logging.debug("handling %s", m)
     data = json.loads(m["data"])
+    if held_by_engine(data["batchref"]):
+        logger.error("rejected quantity change for engine batch %s", data["batchref"])
+        return
     cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
-    messagebus.handle(cmd, uow=unit_of_work.SqlAlchemyUnitOfWork())
+    bus.handle(cmd)
+
+
+def held_by_engine(batchref: str) -> bool:
+    """
+    Whether batchref is for one of ENGINE_SKUS. The engine that keeps them
+    resident runs in the API process, so we can't hand it the change, and
+    writing the batch behind its back would corrupt its next flush. A
+    batch the engine hasn't flushed yet is not found here, so its change
+    fails with InvalidBatchref and is rejected on a later retry.
+    """
+    if not ENGINE_SKUS:
+        return False
+    session = unit_of_work.DEFAULT_SESSION_FACTORY()
+    try:
+        sku = session.execute(
+            select(orm.batches.c.sku).where(orm.batches.c.reference == batchref)
+        ).scalar()
+    finally:
+        session.close()
+    return sku in ENGINE_SKUS
+
+
+def consume_stream(client, bus, consumer, batch_size, block_ms, workers):
+    """
+    Read quantity changes from a stream through a consumer group, batch_size
+    entries at a time. We start by re-reading our own unacknowledged entries
+    from a previous run, then move on to new ones, and go back to re-read
+    them every RETRY_INTERVAL seconds while any failed.
+
+    Entries older than RETENTION seconds are trimmed from the stream on
+    startup and whenever we report lag. APPLIED records are kept for twice
+    that, so a retried entry can't outlive the record it is checked against.
+    """
+    try:
+        client.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    trim_stream(client)
+    backlog, last_id = True, "0"
+    retry_at = None
+    last_report = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            if retry_at is not None and time.monotonic() >= retry_at and not backlog:
+                backlog, last_id, retry_at = True, "0", None
+            response = client.xreadgroup(
+                GROUP,
+                consumer,
+                {STREAM: last_id if backlog else ">"},
+                count=batch_size,
+                block=block_ms,
+            )
+            entries = response[0][1] if response else []
+            if backlog:
+                if entries:
+                    last_id = entries[-1][0]
+                else:
+                    backlog = False
+            if entries and handle_stream_entries(client, entries, executor, bus):
+                retry_at = retry_at or time.monotonic() + RETRY_INTERVAL
+            if time.monotonic() - last_report >= LAG_REPORT_INTERVAL:
+                logger.info("change_batch_quantity stream: %s", stream_lag(client))
+                trim_stream(client)
+                last_report = time.monotonic()
+
+
+def coalesce(entries) -> Dict[str, Tuple[int, List[str]]]:
+    """
+    Latest quantity per batchref, with the ids of every entry it supersedes,
+    since applying the earlier ones would only be overwritten.
+    """
+    latest = {}  # type: Dict[str, Tuple[int, List[str]]]
+    for entry_id, fields in entries:
+        batchref = fields["batchref"]
+        _, ids = latest.get(batchref, (None, []))
+        latest[batchref] = (int(fields["qty"]), ids + [entry_id])
+    return latest
+
+
+def handle_stream_entries(client, entries, executor, bus) -> int:
+    """
+    Apply one command per batchref in parallel, each in its own unit of work,
+    and acknowledge a batchref's entries only once its command has committed.
+    Failed ones stay pending for consume_stream to retry; returns how many
+    batchrefs failed.
+
+    A retried entry may be older than one already applied to its batchref,
+    so we record the newest id applied per batchref in APPLIED and only
+    acknowledge entries that aren't newer than it. Changes to batches
+    held_by_engine are acknowledged without being applied, as are pending
+    entries that were trimmed from the stream before they could be.
+    """
+    trimmed = [entry_id for entry_id, fields in entries if not fields]
+    if trimmed:
+        logger.error("dropping quantity changes %s trimmed from the stream", trimmed)
+        client.xack(STREAM, GROUP, *trimmed)
+    changes = coalesce(entry for entry in entries if entry[1])
+    batchrefs = list(changes)
+    if not batchrefs:
+        return 0
+    applied = dict(zip(batchrefs, client.mget([APPLIED + b for b in batchrefs])))
+    futures = {}
+    for batchref, (qty, ids) in changes.items():
+        if applied[batchref] and _id_key(applied[batchref]) >= _id_key(ids[-1]):
+            logger.info("dropping stale quantity changes %s for %s", ids, batchref)
+            client.xack(STREAM, GROUP, *ids)
+            continue
+        if held_by_engine(batchref):
+            logger.error("rejected quantity changes %s for %s", ids, batchref)
+            client.xack(STREAM, GROUP, *ids)
+            continue
+        command = commands.ChangeBatchQuantity(ref=batchref, qty=qty)
+        futures[executor.submit(bus.handle, command)] = (batchref, ids)
+    failed = 0
+    for future, (batchref, ids) in futures.items():
+        try:
+            future.result()
+        except Exception:
+            logger.exception("Exception changing batch quantity, entries %s", ids)
+            failed += 1
+            continue
+        client.set(APPLIED + batchref, ids[-1], ex=2 * RETENTION)
+        client.xack(STREAM, GROUP, *ids)
+    return failed
+
+
+def _id_key(entry_id: str) -> Tuple[int, int]:
+    milliseconds, sequence = entry_id.split("-")
+    return int(milliseconds), int(sequence)
+
+
+def trim_stream(client):
+    oldest = int(time.time() - RETENTION) * 1000
+    client.xtrim(STREAM, minid=f"{oldest}-0", approximate=False)
+
+
+def stream_lag(client) -> dict:
+    group = next(g for g in client.xinfo_groups(STREAM) if g["name"] == GROUP)
+    # "lag" (entries not yet delivered) needs Redis 7
+    return dict(lag=group.get("lag"), pending=group["pending"])
 
 
 if __name__ == "__main__":
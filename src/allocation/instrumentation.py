@@ -0,0 +1,288 @@
+"""
+Timers and counters around the hot path: handlers, unit of work enter,
+commit and rollback, repository loads, bus queue depth and Redis publishes.
+
+Code under measurement calls the module-level span(), increment() and
+gauge(), which forward to whatever configure() installed. The default
+Instrumentation does nothing, at about a microsecond per span.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+from typing import Callable, Dict, List, Tuple
+
+from allocation import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Instrumentation:
+    def span(self, name: str, **attributes):
+        return NULL_SPAN
+
+    def increment(self, name: str, value: float = 1, **labels):
+        pass
+
+    def gauge(self, name: str, value: float, **labels):
+        pass
+
+    def prometheus_text(self) -> str:
+        return ""
+
+
+class _TimedSpan:
+    __slots__ = ("_record", "_key", "_start")
+
+    def __init__(self, record, key):
+        self._record = record
+        self._key = key
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._record(self._key, time.perf_counter() - self._start)
+        return False
+
+
+def _labels_key(labels) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class PrometheusInstrumentation(Instrumentation):
+    """
+    Keeps spans as histograms (allocation_<name>_seconds), and counters and
+    gauges as allocation_<name>, and renders them in the Prometheus text
+    exposition format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix="allocation_"):
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms = {}  # type: Dict[Tuple, List]
+        self._counters = defaultdict(float)  # type: Dict[Tuple, float]
+        self._gauges = {}  # type: Dict[Tuple, float]
+
+    def span(self, name, **attributes):
+        return _TimedSpan(self._observe, (name, _labels_key(attributes)))
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, _labels_key(labels))] += value
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, _labels_key(labels))] = value
+
+    def _observe(self, key, seconds):
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # a count per bucket and one past the last, then count and sum
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 3)
+            histogram[bisect_left(self.buckets, seconds)] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def prometheus_text(self):
+        lines = []
+        typed = set()
+
+        def declare(metric, kind):
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} {kind}")
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f"{self.prefix}{name}_total"
+                declare(metric, "counter")
+                lines.append(f"{metric}{_render(labels)} {value}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                declare(f"{self.prefix}{name}", "gauge")
+                lines.append(f"{self.prefix}{name}{_render(labels)} {value}")
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                metric = f"{self.prefix}{name}_seconds"
+                declare(metric, "histogram")
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram):
+                    cumulative += count
+                    lines.append(
+                        f"{metric}_bucket{_render(labels + (('le', str(bound)),))}"
+                        f" {cumulative}"
+                    )
+                lines.append(
+                    f"{metric}_bucket{_render(labels + (('le', '+Inf'),))}"
+                    f" {histogram[-2]}"
+                )
+                lines.append(f"{metric}_count{_render(labels)} {histogram[-2]}")
+                lines.append(f"{metric}_sum{_render(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _render(labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + pairs + "}"
+
+
+class _RecordedSpan:
+    __slots__ = ("_recorder", "name", "attributes", "_span")
+
+    def __init__(self, recorder, name, attributes):
+        self._recorder = recorder
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self._span = self._recorder._start(self.name, self.attributes)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._recorder._finish(self._span, exc)
+        return False
+
+
+class SpanRecorder(Instrumentation):
+    """
+    Records spans shaped like OpenTelemetry's: trace and span ids, the
+    parent span, start and end times in nanoseconds, attributes and an
+    OK/ERROR status. Spans nest per thread. Each finished span is passed to
+    export, and the last max_spans are kept in finished.
+    """
+
+    def __init__(self, export: Callable[[dict], None] = None, max_spans=10000):
+        self.export = export
+        self.finished = deque(maxlen=max_spans)  # type: deque
+        self._local = threading.local()
+
+    def span(self, name, **attributes):
+        return _RecordedSpan(self, name, attributes)
+
+    def _start(self, name, attributes):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1] if stack else None
+        span = dict(
+            trace_id=parent["trace_id"] if parent else os.urandom(16).hex(),
+            span_id=os.urandom(8).hex(),
+            parent_span_id=parent["span_id"] if parent else None,
+            name=name,
+            start_time_unix_nano=time.time_ns(),
+            end_time_unix_nano=None,
+            attributes=attributes,
+            status="OK",
+        )
+        stack.append(span)
+        return span
+
+    def _finish(self, span, exc):
+        span["end_time_unix_nano"] = time.time_ns()
+        if exc is not None:
+            span["status"] = "ERROR"
+            span["attributes"] = dict(span["attributes"], exception=repr(exc))
+        self._local.stack.pop()
+        self.finished.append(span)
+        if self.export is not None:
+            self.export(span)
+
+
+def log_span(span: dict):
+    logger.info("span %s", json.dumps(span))
+
+
+class Fanout(Instrumentation):
+    def __init__(self, *targets: Instrumentation):
+        self.targets = targets
+
+    def span(self, name, **attributes):
+        return _FanoutSpan([t.span(name, **attributes) for t in self.targets])
+
+    def increment(self, name, value=1, **labels):
+        for target in self.targets:
+            target.increment(name, value, **labels)
+
+    def gauge(self, name, value, **labels):
+        for target in self.targets:
+            target.gauge(name, value, **labels)
+
+    def prometheus_text(self):
+        return "".join(target.prometheus_text() for target in self.targets)
+
+
+class _FanoutSpan:
+    __slots__ = ("spans",)
+
+    def __init__(self, spans):
+        self.spans = spans
+
+    def __enter__(self):
+        for span in self.spans:
+            span.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        for span in reversed(self.spans):
+            span.__exit__(*exc_info)
+        return False
+
+
+_active = Instrumentation()  # type: Instrumentation
+
+
+def configure(instrumentation: Instrumentation):
+    global _active  # pylint: disable=global-statement
+    _active = instrumentation
+
+
+def active() -> Instrumentation:
+    return _active
+
+
+def from_config() -> Instrumentation:
+    exporters = {
+        "prometheus": PrometheusInstrumentation,
+        "spans": lambda: SpanRecorder(export=log_span),
+    }
+    targets = [exporters[name]() for name in config.get_instrumentation_exporters()]
+    if not targets:
+        return Instrumentation()
+    return targets[0] if len(targets) == 1 else Fanout(*targets)
+
+
+def span(name: str, **attributes):
+    return _active.span(name, **attributes)
+
+
+def increment(name: str, value: float = 1, **labels):
+    _active.increment(name, value, **labels)
+
+
+def gauge(name: str, value: float, **labels):
+    _active.gauge(name, value, **labels)
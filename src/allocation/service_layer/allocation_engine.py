@@ -0,0 +1,422 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Set
+
+from sqlalchemy import select
+
+from allocation import config
+from allocation.adapters import orm, outbox, repository, view_cache, write_ahead_log
+from allocation.domain import commands, events, model
+from allocation.service_layer import handlers, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+# the events that change a product; replaying them rebuilds it
+LOGGED_EVENTS = (events.BatchCreated, events.Allocated, events.BatchQuantityChanged)
+
+_STOP = object()
+
+
+class EngineStopped(Exception):
+    """The log could not be written. Restart the process to recover from it."""
+
+
+class _Checkpoint:
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class AllocationEngine:
+    """
+    Keeps the products for a set of skus resident in this process, and
+    applies CreateBatch, Allocate and ChangeBatchQuantity to them one at a
+    time on a single writer thread, without going to the database. The
+    lines of an AllocateMany are split: ours are applied here, the rest go
+    to fallback as one AllocateMany.
+
+    The writer takes whatever commands are waiting, up to max_group, applies
+    them, and appends the events they raised to the write-ahead log with one
+    fsync before answering any of their callers. Every flush_interval
+    seconds it hands the events since the last checkpoint to a flusher
+    thread. The flusher replays them onto the products in the database,
+    writes the read model and the outbox, and records the log position in
+    engine_checkpoints, all in one transaction. Then it invalidates the
+    cached views of the orders it touched and deletes the log segments
+    that hold nothing past that position.
+
+    start() loads the products from the database, as of the last
+    checkpoint, and replays the log after it. handle() takes messages like
+    MessageBus.handle. Messages for other skus go to fallback, and so do
+    OutOfStock events, on a thread of their own. The engine has to be the
+    only writer to its skus: a flush that finds one of them changed behind
+    its back fails with CannotReplay, and keeps failing, rather than lose
+    or oversell an allocation it has already answered.
+    """
+
+    def __init__(
+        self,
+        skus: Iterable[str],
+        log: write_ahead_log.WriteAheadLog,
+        session_factory=unit_of_work.DEFAULT_SESSION_FACTORY,
+        fallback=None,
+        name: str = "allocation",
+        evict: str = model.LARGEST_FIRST,
+        max_group: int = 256,
+        flush_interval: float = 1.0,
+        cache=None,
+    ):
+        self.skus = set(skus)
+        self.log = log
+        self.session_factory = session_factory
+        self.fallback = fallback
+        self.name = name
+        self.evict = evict
+        self.max_group = max_group
+        self.flush_interval = flush_interval
+        self.cache = cache if cache is not None else view_cache.allocations_cache
+        self._products = {}  # type: Dict[str, model.Product]
+        self._skus_by_batchref = {}  # type: Dict[str, str]
+        self._unflushed = []  # type: List[events.Event]
+        self._queue = queue.Queue()  # type: queue.Queue
+        self._flushes = queue.Queue()  # type: queue.Queue
+        self._notifier = ThreadPoolExecutor(max_workers=1)
+        self._failure = None  # type: Exception
+        self._counts = dict(commands=0, groups=0, flushes=0, flushed_lsn=0)
+        self._writer = threading.Thread(target=self._write_forever, daemon=True)
+        self._flusher = threading.Thread(target=self._flush_forever, daemon=True)
+
+    def start(self):
+        flushed_lsn = self._load_products()
+        self.log.continue_from(flushed_lsn)
+        for _, event in self.log.replay(after_lsn=flushed_lsn):
+            self._product(event.sku).replay(event)
+            self._unflushed.append(event)
+        for product in self._products.values():
+            for batch in product.batches:
+                self._skus_by_batchref[batch.reference] = product.sku
+        self._counts["flushed_lsn"] = flushed_lsn
+        logger.info(
+            "engine %s holds %d products, replayed %d events after LSN %d",
+            self.name,
+            len(self._products),
+            len(self._unflushed),
+            flushed_lsn,
+        )
+        self._writer.start()
+        self._flusher.start()
+
+    def stop(self):
+        """Apply what is queued, flush everything and stop."""
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._flushes.put(_STOP)
+        self._flusher.join()
+        self._notifier.shutdown()
+        self.log.close()
+
+    def handle(self, message, uow: unit_of_work.AbstractUnitOfWork = None):
+        if not self._owns(message):
+            return self.fallback.handle(message, uow)
+        if self._failure is not None:
+            raise EngineStopped(str(self._failure)) from self._failure
+        if isinstance(message, commands.AllocateMany):
+            return [self._allocate_many(message, uow)]
+        if isinstance(message, commands.CreateBatch):
+            self._skus_by_batchref[message.ref] = message.sku
+        future = Future()  # type: Future
+        self._queue.put((message, future))
+        return [future.result()]
+
+    def checkpoint(self):
+        """Flush everything applied so far to the database, and wait for it."""
+        checkpoint = _Checkpoint()
+        self._queue.put(checkpoint)
+        checkpoint.done.wait()
+
+    def stats(self) -> dict:
+        return dict(
+            self._counts,
+            queued=self._queue.qsize(),
+            last_lsn=self.log.last_lsn,
+            syncs=self.log.syncs,
+        )
+
+    def _owns(self, message) -> bool:
+        if isinstance(message, (commands.Allocate, commands.CreateBatch)):
+            return message.sku in self.skus
+        if isinstance(message, commands.AllocateMany):
+            return any(line.sku in self.skus for line in message.lines)
+        if isinstance(message, commands.ChangeBatchQuantity):
+            return message.ref in self._skus_by_batchref
+        return False
+
+    def _allocate_many(self, command: commands.AllocateMany, uow):
+        results = [None] * len(command.lines)  # type: List
+        ours, others = [], []  # type: List[int], List[int]
+        for position, line in enumerate(command.lines):
+            (ours if line.sku in self.skus else others).append(position)
+        futures = []
+        for position in ours:
+            future = Future()  # type: Future
+            self._queue.put((command.lines[position], future))
+            futures.append((position, future))
+        if others:
+            lines = [command.lines[position] for position in others]
+            other_results = self.fallback.handle(commands.AllocateMany(lines), uow)[0]
+            for position, result in zip(others, other_results):
+                results[position] = result
+        for position, future in futures:
+            sku = command.lines[position].sku
+            try:
+                results[position] = future.result() or model.OutOfStock(
+                    f"Out of stock for sku {sku}"
+                )
+            except handlers.InvalidSku as e:
+                results[position] = e
+        return results
+
+    def _write_forever(self):
+        last_checkpoint = time.monotonic()
+        while True:
+            try:
+                group = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                group = []
+            while group and len(group) < self.max_group:
+                try:
+                    group.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            requests = [item for item in group if isinstance(item, tuple)]
+            if requests:
+                try:
+                    self._apply_group(requests)
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.exception("engine %s could not write its log", self.name)
+                    self._fail(e)
+                    return
+            checkpoints = [item for item in group if isinstance(item, _Checkpoint)]
+            stopping = _STOP in group
+            if (
+                checkpoints
+                or stopping
+                or time.monotonic() - last_checkpoint >= self.flush_interval
+            ):
+                self._checkpoint(checkpoints)
+                last_checkpoint = time.monotonic()
+            if stopping:
+                return
+
+    def _apply_group(self, requests):
+        outcomes = []
+        raised = []  # type: List[events.Event]
+        for message, future in requests:
+            try:
+                result, new_events = self._apply(message)
+            except Exception as e:  # pylint: disable=broad-except
+                outcomes.append((future, None, e))
+                continue
+            outcomes.append((future, result, None))
+            raised.extend(new_events)
+        logged = [event for event in raised if isinstance(event, LOGGED_EVENTS)]
+        try:
+            self.log.append(logged)
+        except Exception as e:
+            for future, _, _ in outcomes:
+                future.set_exception(EngineStopped(str(e)))
+            raise
+        self._unflushed.extend(logged)
+        self._counts["commands"] += len(requests)
+        self._counts["groups"] += 1
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        for event in raised:
+            if isinstance(event, events.OutOfStock) and self.fallback is not None:
+                self._notifier.submit(self._notify, event)
+
+    def _apply(self, message):
+        if isinstance(message, commands.CreateBatch):
+            product = self._product(message.sku)
+            product.add_batch(
+                model.Batch(message.ref, message.sku, message.qty, message.eta)
+            )
+            result = None
+        elif isinstance(message, commands.Allocate):
+            product = self._products.get(message.sku)
+            if product is None:
+                raise handlers.InvalidSku(f"Invalid sku {message.sku}")
+            result = product.allocate(
+                model.OrderLine(message.orderid, message.sku, message.qty)
+            )
+        else:
+            product = self._products[self._skus_by_batchref[message.ref]]
+            product.change_batch_quantity(message.ref, message.qty, self.evict)
+            result = None
+        new_events, product.events = product.events, []
+        return result, new_events
+
+    def _product(self, sku: str) -> model.Product:
+        product = self._products.get(sku)
+        if product is None:
+            product = self._products[sku] = model.Product(sku, batches=[])
+        return product
+
+    def _notify(self, event):
+        try:
+            self.fallback.handle(event)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("engine %s could not pass on %s", self.name, event)
+
+    def _fail(self, error):
+        self._failure = error
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple):
+                item[1].set_exception(EngineStopped(str(error)))
+            elif isinstance(item, _Checkpoint):
+                item.done.set()
+
+    def _checkpoint(self, checkpoints: List[_Checkpoint]):
+        if not self._unflushed:
+            for checkpoint in checkpoints:
+                checkpoint.done.set()
+            return
+        self.log.roll()
+        self._flushes.put((self.log.last_lsn, self._unflushed, checkpoints))
+        self._unflushed = []
+
+    def _flush_forever(self):
+        pending = []  # type: List[events.Event]
+        while True:
+            item = self._flushes.get()
+            if item is _STOP:
+                return
+            lsn, flushed_events, checkpoints = item
+            pending.extend(flushed_events)
+            try:
+                self._flush(lsn, pending)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception(
+                    "engine %s could not flush to LSN %d, will retry", self.name, lsn
+                )
+            else:
+                pending = []
+                self._counts["flushes"] += 1
+                self._counts["flushed_lsn"] = lsn
+                self.log.discard_through(lsn)
+            for checkpoint in checkpoints:
+                checkpoint.done.set()
+
+    def _flush(self, lsn: int, flushed_events: List[events.Event]):
+        uow = unit_of_work.SqlAlchemyUnitOfWork(self.session_factory)
+        with uow:
+            products = {}  # type: Dict[str, model.Product]
+            for event in flushed_events:
+                if event.sku not in products:
+                    product = uow.products.get(sku=event.sku)
+                    if product is None:
+                        product = model.Product(event.sku, batches=[])
+                        uow.products.add(product)
+                    products[event.sku] = product
+                products[event.sku].replay(event)
+            _update_read_model(uow.session, flushed_events, products)
+            outbox.add(uow.session, flushed_events)
+            _save_checkpoint(uow.session, self.name, lsn)
+            uow.commit()
+        for orderid in _orders_touched(flushed_events):
+            self.cache.invalidate(orderid)
+
+    def _load_products(self) -> int:
+        session = self.session_factory()
+        try:
+            flushed_lsn = session.execute(
+                select(orm.engine_checkpoints.c.lsn).where(
+                    orm.engine_checkpoints.c.name == self.name
+                )
+            ).scalar()
+            products = repository.SqlAlchemyRepository(session)
+            for sku in self.skus:
+                product = products.get(sku)
+                if product is not None:
+                    self._products[sku] = product
+            # from here on they are plain objects that only this engine touches
+            session.expunge_all()
+        finally:
+            session.close()
+        return flushed_lsn or 0
+
+
+def _update_read_model(
+    session, flushed_events: List[events.Event], products: Dict[str, model.Product]
+):
+    view = orm.allocations_view
+    for event in flushed_events:
+        if isinstance(event, events.Allocated):
+            session.execute(
+                view.insert().values(
+                    orderid=event.orderid,
+                    sku=event.sku,
+                    qty=event.qty,
+                    batchref=event.batchref,
+                    version_number=products[event.sku].version_number,
+                )
+            )
+        elif isinstance(event, events.BatchQuantityChanged):
+            for line in event.deallocated:
+                session.execute(
+                    view.delete().where(
+                        (view.c.orderid == line.orderid)
+                        & (view.c.sku == line.sku)
+                        & (view.c.qty == line.qty)
+                        & (view.c.batchref == line.batchref)
+                    )
+                )
+
+
+def _orders_touched(flushed_events: List[events.Event]) -> Set[str]:
+    orderids = set()  # type: Set[str]
+    for event in flushed_events:
+        if isinstance(event, events.Allocated):
+            orderids.add(event.orderid)
+        elif isinstance(event, events.BatchQuantityChanged):
+            orderids.update(line.orderid for line in event.deallocated)
+    return orderids
+
+
+def _save_checkpoint(session, name: str, lsn: int):
+    checkpoints = orm.engine_checkpoints
+    updated = session.execute(
+        checkpoints.update().where(checkpoints.c.name == name).values(lsn=lsn)
+    ).rowcount
+    if not updated:
+        session.execute(checkpoints.insert().values(name=name, lsn=lsn))
+
+
+def configured_engine(bus):
+    """An engine for the configured skus in front of bus, or bus if there are none."""
+    settings = config.get_allocation_engine_settings()
+    if not settings["skus"]:
+        return bus
+    if config.get_shard_uris() or config.get_product_store_settings()["events"]:
+        # it loads and flushes its products through the tables store
+        raise ValueError(
+            "ENGINE_SKUS can't be combined with DB_SHARDS or PRODUCT_STORE=events"
+        )
+    engine = AllocationEngine(
+        settings["skus"],
+        write_ahead_log.WriteAheadLog(settings["log_dir"]),
+        fallback=bus,
+        max_group=settings["max_group"],
+        flush_interval=settings["flush_interval"],
+    )
+    engine.start()
+    return engine
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, List, Tuple
+
+from allocation import config
+from allocation.domain import commands, events
+from allocation.service_layer import messagebus, unit_of_work
+from allocation.service_layer.messagebus import Message
+
+logger = logging.getLogger(__name__)
+
+
+def aggregate_key(command: commands.Command) -> str:
+    return getattr(command, "sku", None) or getattr(command, "ref", None) or ""
+
+
+class ConcurrentMessageBus:
+    """
+    Wraps a MessageBus so that several callers can make progress at once.
+
+    Commands run on one of a fixed set of single-threaded lanes, picked by
+    hashing the sku (or batchref) they address, so commands for one aggregate
+    are serialized while different aggregates proceed in parallel. The caller
+    waits for its command and any follow-up commands, and gets their results
+    back as before. Events are handed to event_workers, each with a fresh
+    unit of work. Once max_pending_events are queued, the next caller
+    blocks until a worker catches up.
+
+    Each event worker is single-threaded too, picked by the event's sku, so
+    the events for one product are handled in the order they were raised.
+    The read model depends on that: when a batch shrinks, the
+    BatchQuantityChanged handler deletes an order's row and the Allocated
+    that follows it inserts the new one, and run in parallel the delete
+    could land second and remove the new row.
+
+    Lanes only reduce contention: a ChangeBatchQuantity addressed by batchref
+    may land on a different lane from Allocates for the same sku, and the
+    version check on products keeps that safe.
+    """
+
+    def __init__(
+        self,
+        bus: messagebus.MessageBus,
+        lanes: int = 8,
+        event_workers: int = 4,
+        max_pending_events: int = 1000,
+    ):
+        self.bus = bus
+        self._lanes = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bus-lane-{i}")
+            for i in range(lanes)
+        ]
+        self._event_workers = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bus-events-{i}")
+            for i in range(event_workers)
+        ]
+        self._event_slots = threading.BoundedSemaphore(max_pending_events)
+
+    def handle(self, message: Message, uow: unit_of_work.AbstractUnitOfWork = None):
+        if uow is None:
+            uow = self.bus.uow_factory()
+        results = []
+        queue = deque([message])  # type: Deque[Message]
+        try:
+            while queue:
+                message = queue.popleft()
+                if isinstance(message, events.Event):
+                    self._dispatch_event(message)
+                elif isinstance(message, commands.Command):
+                    lane = self._lane_for(message)
+                    result, new_messages = lane.submit(
+                        self._run_command, message, uow
+                    ).result()
+                    results.append(result)
+                    queue.extend(new_messages)
+                else:
+                    raise Exception(f"{message} was not an Event or Command")
+        finally:
+            uow.close()
+        return results
+
+    def close(self):
+        for lane in self._lanes:
+            lane.shutdown(wait=True)
+        for worker in self._event_workers:
+            worker.shutdown(wait=True)
+
+    def _lane_for(self, command: commands.Command) -> ThreadPoolExecutor:
+        return self._lanes[hash(aggregate_key(command)) % len(self._lanes)]
+
+    def _run_command(
+        self, command: commands.Command, uow: unit_of_work.AbstractUnitOfWork
+    ) -> Tuple[object, List[Message]]:
+        new_messages = deque()  # type: Deque[Message]
+        result = self.bus.handle_command(command, new_messages, uow)
+        return result, list(new_messages)
+
+    def _dispatch_event(self, event: events.Event):
+        self._event_slots.acquire()
+        sku = getattr(event, "sku", "")
+        worker = self._event_workers[hash(sku) % len(self._event_workers)]
+        future = worker.submit(self._run_event, event)
+        future.add_done_callback(lambda _: self._event_slots.release())
+
+    def _run_event(self, event: events.Event):
+        try:
+            self.bus.handle(event)
+        except Exception:
+            logger.exception("Exception handling event %s in worker", event)
+
+
+def configured_bus(bus: messagebus.MessageBus):
+    """The bus selected by config: bus itself, or bus behind lanes."""
+    settings = config.get_message_bus_settings()
+    if not settings.pop("concurrent"):
+        return bus
+    return ConcurrentMessageBus(bus, **settings)
@@ -1,12 +1,18 @@
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Type, Union
+
 from allocation.domain import model, events, commands
 from allocation.service_layer import unit_of_work
-from allocation.adapters import email, redis_eventpublisher
 
 
 class InvalidSku(Exception):
     pass
 
 
+class InvalidBatchref(Exception):
+    pass
+
+
 def add_batch(
     cmd: commands.CreateBatch,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -16,7 +22,7 @@ def add_batch(
         if product is None:
             product = model.Product(cmd.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        product.add_batch(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
         uow.commit()
 
 
@@ -31,22 +37,180 @@ def allocate(cmd: commands.Allocate, uow: unit_of_work.AbstractUnitOfWork) -> st
     return batchref
 
 
-def send_out_of_stock_notification(
-    event: events.OutOfStock, uow: unit_of_work.AbstractUnitOfWork
-):
-    email.send_email("stock@made.com", f"Out of stock for {event.sku}")
+def allocate_many(
+    cmd: commands.AllocateMany, uow: unit_of_work.AbstractUnitOfWork
+) -> List[Union[str, Exception]]:
+    """
+    Allocate a whole import of order lines, loading each product once and
+    committing them all together, so that a conflict on any of them makes
+    the bus retry the command from scratch rather than allocate lines of
+    already committed products again. Returns one result per line, in
+    input order: the batchref it was allocated to, or an OutOfStock /
+    InvalidSku instance.
+    """
+    results = [None] * len(cmd.lines)  # type: List[Optional[Union[str, Exception]]]
+    positions_by_sku = defaultdict(list)  # type: Dict[str, List[int]]
+    for position, line in enumerate(cmd.lines):
+        positions_by_sku[line.sku].append(position)
+
+    with uow:
+        for sku, positions in positions_by_sku.items():
+            product = uow.products.get(sku=sku)
+            if product is None:
+                for position in positions:
+                    results[position] = InvalidSku(f"Invalid sku {sku}")
+                continue
+            for position in positions:
+                line = cmd.lines[position]
+                batchref = product.allocate(
+                    model.OrderLine(line.orderid, line.sku, line.qty)
+                )
+                results[position] = batchref or model.OutOfStock(
+                    f"Out of stock for sku {sku}"
+                )
+        uow.commit()
+    return results
+
+
+def send_out_of_stock_notification(event: events.OutOfStock, send_mail: Callable):
+    send_mail("stock@made.com", f"Out of stock for {event.sku}")
 
 
 def change_batch_quantity(
-    cmd: commands.ChangeBatchQuantity, uow: unit_of_work.AbstractUnitOfWork
+    cmd: commands.ChangeBatchQuantity,
+    uow: unit_of_work.AbstractUnitOfWork,
+    evict: str = model.LARGEST_FIRST,
 ):
     with uow:
         product = uow.products.get_by_batchref(batchref=cmd.ref)
-        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
+        if product is None:
+            raise InvalidBatchref(f"Invalid batch reference {cmd.ref}")
+        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty, evict=evict)
+        uow.commit()
+
+
+def add_allocation_to_read_model(
+    event: events.Allocated, uow: unit_of_work.SqlAlchemyUnitOfWork
+):
+    with uow:
+        uow.session.execute(
+            "INSERT INTO allocations_view"
+            " (orderid, sku, qty, batchref, version_number)"
+            " VALUES (:orderid, :sku, :qty, :batchref,"
+            " (SELECT version_number FROM products WHERE sku = :sku))",
+            dict(
+                orderid=event.orderid,
+                sku=event.sku,
+                qty=event.qty,
+                batchref=event.batchref,
+            ),
+        )
         uow.commit()
 
 
-def publish_allocated_event(
-    event: events.Allocated, uow: unit_of_work.AbstractUnitOfWork
+def remove_deallocations_from_read_model(
+    event: events.BatchQuantityChanged, uow: unit_of_work.SqlAlchemyUnitOfWork
 ):
-    redis_eventpublisher.publish("line_allocated", event)
+    if not event.deallocated:
+        return
+    with uow:
+        uow.session.execute(
+            "DELETE FROM allocations_view"
+            " WHERE orderid = :orderid AND sku = :sku AND qty = :qty"
+            " AND batchref = :batchref",
+            [
+                dict(
+                    orderid=line.orderid,
+                    sku=line.sku,
+                    qty=line.qty,
+                    batchref=line.batchref,
+                )
+                for line in event.deallocated
+            ],
+        )
+        uow.commit()
+
+
+def invalidate_cached_allocations(event: events.Allocated, cache):
+    cache.invalidate(event.orderid)
+
+
+def invalidate_cached_deallocations(event: events.BatchQuantityChanged, cache):
+    for line in event.deallocated:
+        cache.invalidate(line.orderid)
+
+
+INSERT_VIEW_ROW = (
+    "INSERT INTO allocations_view (orderid, sku, qty, batchref, version_number)"
+    " VALUES (:orderid, :sku, :qty, :batchref, :version_number)"
+)
+SELECT_VIEW_ROWS = (
+    "SELECT ol.orderid, ol.sku, ol.qty, b.reference AS batchref, p.version_number"
+    " FROM allocations AS a"
+    " JOIN batches AS b ON a.batch_id = b.id"
+    " JOIN order_lines AS ol ON a.orderline_id = ol.id"
+    " JOIN products AS p ON p.sku = b.sku"
+)
+
+
+def rebuild_allocations_view(
+    cmd: commands.RebuildAllocationsView,
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    cache,
+):
+    with uow:
+        uow.session.execute("DELETE FROM allocations_view")
+        if isinstance(uow, unit_of_work.EventSourcedUnitOfWork):
+            # the batches and allocations tables are empty in this mode
+            for product in uow.products.each_product():
+                rows = [
+                    dict(
+                        orderid=e.orderid,
+                        sku=e.sku,
+                        qty=e.qty,
+                        batchref=e.batchref,
+                        version_number=product.version_number,
+                    )
+                    for e in product.as_events()
+                    if isinstance(e, events.Allocated)
+                ]
+                if rows:
+                    uow.session.execute(INSERT_VIEW_ROW, rows)
+        elif isinstance(uow, unit_of_work.ShardedUnitOfWork):
+            # the view is in the home database, the allocations on the shards
+            for session_factory in uow.shard_session_factories.values():
+                shard = session_factory()
+                try:
+                    rows = shard.execute(SELECT_VIEW_ROWS).mappings().all()
+                finally:
+                    shard.close()
+                if rows:
+                    uow.session.execute(INSERT_VIEW_ROW, rows)
+        else:
+            uow.session.execute(
+                "INSERT INTO allocations_view"
+                " (orderid, sku, qty, batchref, version_number) " + SELECT_VIEW_ROWS
+            )
+        uow.commit()
+    cache.clear()
+
+
+EVENT_HANDLERS = {
+    events.BatchCreated: [],
+    # Allocated is also published through the outbox, see unit_of_work
+    events.Allocated: [add_allocation_to_read_model, invalidate_cached_allocations],
+    events.BatchQuantityChanged: [
+        remove_deallocations_from_read_model,
+        invalidate_cached_deallocations,
+    ],
+    events.OutOfStock: [send_out_of_stock_notification],
+}  # type: Dict[Type[events.Event], List[Callable]]
+
+
+COMMAND_HANDLERS = {
+    commands.CreateBatch: add_batch,
+    commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
+    commands.ChangeBatchQuantity: change_batch_quantity,
+    commands.RebuildAllocationsView: rebuild_allocations_view,
+}  # type: Dict[Type[commands.Command], Callable]
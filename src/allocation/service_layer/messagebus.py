@@ -1,67 +1,146 @@
 from __future__ import annotations
 
 import logging
+import random
+import time
+from allocation import config, instrumentation
 from allocation.domain import commands, events
-from typing import List, Dict, Type, Callable, Union
-from allocation.service_layer import handlers
+from typing import Deque, List, Dict, Tuple, Type, Callable, Union
 from allocation.service_layer import unit_of_work
 
 logger = logging.getLogger(__name__)
 Message = Union[commands.Command, events.Event]
 
 
-def handle(message: Message, uow: unit_of_work.AbstractUnitOfWork):
-    results = []
-    queue = [message]
-    while queue:
-        message = queue.pop(0)
-        if isinstance(message, events.Event):
-            handle_event(message, queue, uow)
-        elif isinstance(message, commands.Command):
-            cmd_result = handle_command(message, queue, uow)
-            results.append(cmd_result)
-        else:
-            raise Exception(f"{message} was not an Event or Command")
-    return results
+class MessageBus:
+    """
+    Routes each message to its handlers by type. The handlers come from
+    bootstrap with their dependencies bound, and take the message and the
+    unit of work.
 
+    Each handle() call gets a fresh unit of work from uow_factory unless it
+    is given one, so one bus can serve several threads.
+    """
 
-def handle_event(
-    event: events.Event, queue: List[Message], uow: unit_of_work.AbstractUnitOfWork
-):
-    for handler in EVENT_HANDLERS[type(event)]:
+    def __init__(
+        self,
+        uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+        retry_policy: dict = None,
+    ):
+        self.uow_factory = uow_factory
+        self.event_handlers = event_handlers
+        self.command_handlers = command_handlers
+        self.retry_policy = retry_policy or config.get_command_retry_policy()
+        # one dict lookup per message, instead of isinstance checks and then
+        # a lookup in the handler map for its kind
+        self._routes = {}  # type: Dict[type, Tuple[bool, object]]
+        for event_type, handlers in event_handlers.items():
+            self._routes[event_type] = (False, tuple(handlers))
+        for command_type, handler in command_handlers.items():
+            self._routes[command_type] = (True, handler)
+
+    def handle(self, message: Message, uow: unit_of_work.AbstractUnitOfWork = None):
+        if uow is None:
+            uow = self.uow_factory()
+        results = []
+        # a list we append to while iterating it: cheaper than a deque for
+        # the one or two messages a call usually handles
+        queue = [message]  # type: List[Message]
+        # the active instrumentation's own methods: the module-level ones
+        # cost a call and a repack of their kwargs on every message
+        routes, gauge = self._routes, instrumentation.active().gauge
         try:
-            logger.debug("handling event %s with handler %s", event, handler)
-            handler(event, uow=uow)
-            queue.extend(uow.collect_new_events())
-        except Exception:
-            logger.exception("Exception handling event %s", event)
-            continue
+            for position, message in enumerate(queue, start=1):
+                gauge("bus_queue_depth", len(queue) - position)
+                route = routes.get(type(message))
+                if route is None:
+                    raise Exception(f"{message} was not an Event or Command")
+                is_command, handlers = route
+                if is_command:
+                    results.append(
+                        self._run_command_handler(handlers, message, queue, uow)
+                    )
+                else:
+                    self._run_event_handlers(handlers, message, queue, uow)
+        finally:
+            uow.close()
+        return results
+
+    def handle_event(
+        self,
+        event: events.Event,
+        queue: Deque[Message],
+        uow: unit_of_work.AbstractUnitOfWork,
+    ):
+        self._run_event_handlers(self.event_handlers[type(event)], event, queue, uow)
+
+    def handle_command(
+        self,
+        command: commands.Command,
+        queue: Deque[Message],
+        uow: unit_of_work.AbstractUnitOfWork,
+    ):
+        handler = self.command_handlers[type(command)]
+        return self._run_command_handler(handler, command, queue, uow)
 
+    @staticmethod
+    def _run_event_handlers(handlers, event, queue, uow):
+        span, message = instrumentation.active().span, type(event).__name__
+        for handler in handlers:
+            try:
+                logger.debug("handling event %s with handler %s", event, handler)
+                with span("handler", handler=handler.__name__, message=message):
+                    handler(event, uow)
+                queue.extend(uow.collect_new_events())
+            except Exception:
+                logger.exception("Exception handling event %s", event)
+                continue
 
-def handle_command(
-    command: commands.Command,
-    queue: List[Message],
-    uow: unit_of_work.AbstractUnitOfWork,
-):
-    logger.debug("handling command %s", command)
-    try:
-        handler = COMMAND_HANDLERS[type(command)]
-        result = handler(command, uow=uow)
+    def _run_command_handler(self, handler, command, queue, uow):
+        logger.debug("handling command %s", command)
+        try:
+            with instrumentation.active().span(
+                "handler", handler=handler.__name__, message=type(command).__name__
+            ):
+                result = handler(command, uow)
+        except unit_of_work.ConcurrencyConflict as e:
+            result = self._retry_command_handler(handler, command, uow, e)
+        except Exception:
+            logger.exception("Exception handling command %s", command)
+            raise
         queue.extend(uow.collect_new_events())
         return result
-    except Exception:
-        logger.exception("Exception handling command %s", command)
-        raise
-
 
-EVENT_HANDLERS = {
-    events.Allocated: [handlers.publish_allocated_event],
-    events.OutOfStock: [handlers.send_out_of_stock_notification],
-}  # type: Dict[Type[events.Event], List[Callable]]
+    def _retry_command_handler(self, handler, command, uow, conflict):
+        # kept off the common path, which then costs no more than a plain call
+        attempt = 1
+        while attempt < self.retry_policy["attempts"]:
+            logger.info("Conflict handling command %s, retrying", command)
+            instrumentation.increment(
+                "command_retries", message=type(command).__name__
+            )
+            time.sleep(retry_delay(attempt, self.retry_policy["base_delay"]))
+            attempt += 1
+            try:
+                with instrumentation.span(
+                    "handler",
+                    handler=handler.__name__,
+                    message=type(command).__name__,
+                ):
+                    return handler(command, uow)
+            except unit_of_work.ConcurrencyConflict as e:
+                conflict = e
+            except Exception:
+                logger.exception("Exception handling command %s", command)
+                raise
+        logger.error(
+            "Giving up on command %s after conflicts", command, exc_info=conflict
+        )
+        raise conflict
 
 
-COMMAND_HANDLERS = {
-    commands.CreateBatch: handlers.add_batch,
-    commands.Allocate: handlers.allocate,
-    commands.ChangeBatchQuantity: handlers.change_batch_quantity,
-}  # type: Dict[Type[commands.Command], Callable]
+def retry_delay(attempt: int, base_delay: float) -> float:
+    # exponential backoff with full jitter, so losers don't collide again
+    return random.uniform(0, base_delay * 2 ** (attempt - 1))
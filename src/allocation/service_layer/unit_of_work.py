@@ -2,16 +2,64 @@
 from __future__ import annotations
 
 import abc
-from allocation.adapters import repository
-from sqlalchemy import create_engine
+import contextlib
+from typing import Dict, List, Set
+from allocation.adapters import (
+    aggregate_cache,
+    db_pool,
+    event_store,
+    outbox,
+    read_replicas,
+    repository,
+    sharding,
+)
+from allocation.domain import events, model
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import sessionmaker
-from allocation import config
+from sqlalchemy.orm.exc import StaleDataError
+from allocation import config, instrumentation
+
 
+def make_session_factory(uri):
+    return sessionmaker(
+        bind=create_engine(
+            uri,
+            isolation_level=config.get_isolation_level(),
+            poolclass=db_pool.InstrumentedQueuePool,
+            **config.get_db_pool_settings(),
+        )
+    )
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(config.get_postgres_uri(), isolation_level="REPEATABLE READ")
+
+DEFAULT_SESSION_FACTORY = make_session_factory(config.get_postgres_uri())
+SHARD_SESSION_FACTORIES = {
+    name: make_session_factory(uri) for name, uri in config.get_shard_uris().items()
+}
+DEFAULT_READ_ROUTER = read_replicas.ReadRouter(
+    DEFAULT_SESSION_FACTORY,
+    [make_session_factory(uri) for uri in config.get_read_replica_uris()],
+    policy=config.get_read_staleness_policy(),
+)
+DEFAULT_AGGREGATE_CACHE = (
+    aggregate_cache.AggregateCache(config.get_aggregate_cache_size())
+    if config.get_aggregate_cache_size()
+    else None
 )
 
+SERIALIZATION_FAILURE = "40001"
+
+
+class ConcurrencyConflict(Exception):
+    """Another transaction changed the aggregate since we read it."""
+
+
+class PartiallyCommitted(Exception):
+    """
+    Some shards committed before another failed. Not a ConcurrencyConflict,
+    so the bus doesn't retry it and apply the committed part twice.
+    """
+
 
 class AbstractUnitOfWork(abc.ABC):
     products = repository.AbstractProductRepository
@@ -20,10 +68,15 @@ class AbstractUnitOfWork(abc.ABC):
         return self
 
     def __exit__(self, *args):
-        self.rollback()
+        with instrumentation.span("uow_rollback"):
+            self.rollback()
 
     def commit(self):
-        self._commit()
+        with instrumentation.span("uow_commit"):
+            self._commit()
+
+    def close(self):
+        pass
 
     def collect_new_events(self):
         for product in self.products.seen:
@@ -40,20 +93,302 @@ class AbstractUnitOfWork(abc.ABC):
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    """
+    With reuse_connection, the first __enter__ checks a connection out of the
+    pool and every later session is bound to it, until close() hands it back.
+    messagebus.handle closes the unit of work once the command and its
+    follow-up events are done, so one bus run costs one checkout.
+
+    Read-only queries go through reading(), which asks read_router for a
+    session. Without a router they use session_factory like everything else.
+    Commits report the orders they changed to the router.
+
+    With a product_cache, sessions don't expire what they commit, and the
+    products committed are handed to the cache when the next __enter__ or
+    close() comes around, by which time the bus has collected their events.
+    """
+
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        loading="selectin",
+        reuse_connection=False,
+        read_router: read_replicas.ReadRouter = None,
+        product_cache: aggregate_cache.AggregateCache = None,
+    ):
         self.session_factory = session_factory
+        self.loading = loading
+        self.reuse_connection = reuse_connection
+        self.read_router = read_router
+        self.product_cache = product_cache
+        self.statement_count = 0
+        self._connection = None
+        self._committed = []  # type: List[model.Product]
+        self._to_cache = []  # type: List[model.Product]
+
+    def __enter__(self):
+        with instrumentation.span("uow_enter"):
+            self._hand_to_cache()
+            options = {}
+            if self.product_cache is not None:
+                options["expire_on_commit"] = False
+            if self.reuse_connection:
+                if self._connection is None:
+                    self._connection = self.session_factory.kw["bind"].connect()
+                options["bind"] = self._connection
+            self.session = self.session_factory(**options)
+            event.listen(self.session, "after_begin", self._count_statements_on)
+            self.products = repository.SqlAlchemyRepository(
+                session=self.session, loading=self.loading, cache=self.product_cache
+            )
+            self._outboxed = set()  # type: Set[int]
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        self.session.close()
+        # a rollback after the commit, or a failed commit, expires them
+        self._to_cache.extend(p for p in self._committed if not _expired(p))
+        self._committed = []
+
+    def _commit(self):
+        new_events = list(self._events_not_yet_in_outbox())
+        # read before commit() expires the products' versions
+        writes = list(self._orders_written(new_events)) if self.read_router else []
+        try:
+            outbox.add(self.session, new_events)
+            self.session.commit()
+        except StaleDataError as e:
+            raise ConcurrencyConflict(str(e)) from e
+        except OperationalError as e:
+            if getattr(e.orig, "pgcode", None) != SERIALIZATION_FAILURE:
+                raise
+            raise ConcurrencyConflict(str(e)) from e
+        for orderid, sku, version in writes:
+            self.read_router.note_write(orderid, sku, version)
+        if self.product_cache is not None:
+            self._committed = list(self.products.seen)
+
+    @contextlib.contextmanager
+    def reading(self, orderid: str = None):
+        if self.read_router is None:
+            session = self.session_factory()
+        else:
+            session = self.read_router.session(orderid=orderid)
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def rollback(self):
+        self.session.rollback()
+
+    def close(self):
+        self._hand_to_cache()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _hand_to_cache(self):
+        for product in self._to_cache:
+            self.product_cache.put(product)
+        self._to_cache = []
+
+    def _events_not_yet_in_outbox(self):
+        # events stay on the product until the bus collects them, so a
+        # handler that commits more than once must not write them twice
+        for product in self.products.seen:
+            for event in product.events:
+                if id(event) not in self._outboxed:
+                    self._outboxed.add(id(event))
+                    yield event
+
+    def _orders_written(self, new_events):
+        products = {product.sku: product for product in self.products.seen}
+        for event in new_events:
+            if isinstance(event, events.Allocated):
+                orderids = [event.orderid]
+            elif isinstance(event, events.BatchQuantityChanged):
+                orderids = [line.orderid for line in event.deallocated]
+            else:
+                continue
+            version = products[event.sku].version_number
+            for orderid in orderids:
+                yield orderid, event.sku, version
+
+    def _count_statements_on(self, session, transaction, connection):
+        if event.contains(
+            connection, "before_cursor_execute", self._statement_executed
+        ):
+            return  # a reused connection already reports to us
+        event.listen(connection, "before_cursor_execute", self._statement_executed)
+
+    def _statement_executed(self, *_):
+        self.statement_count += 1
+
+
+def _expired(product: model.Product) -> bool:
+    return bool(inspect(product).expired_attributes)
+
+
+class EventSourcedUnitOfWork(SqlAlchemyUnitOfWork):
+    """
+    Products come from and go to the event store rather than the batches
+    and allocations tables. Everything else, the read model and the outbox
+    included, is as in SqlAlchemyUnitOfWork. The products table isn't kept
+    either, so read-model rows carry no version and a read_router can't see
+    a replica catch up with a write: it sends reads of recently written
+    orders to the primary.
+    """
+
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        snapshot_every=100,
+        read_router: read_replicas.ReadRouter = None,
+    ):
+        super().__init__(session_factory, read_router=read_router)
+        self.snapshot_every = snapshot_every
+
+    def __enter__(self):
+        super().__enter__()
+        self.products = event_store.EventSourcedRepository(
+            self.session, snapshot_every=self.snapshot_every
+        )
+        return self
+
+    def _commit(self):
+        try:
+            self.products.append_new_events()
+        except IntegrityError as e:
+            raise ConcurrencyConflict(str(e)) from e
+        super()._commit()
+
+
+class ShardedUnitOfWork(AbstractUnitOfWork):
+    """
+    Products spread over several databases by sku. Each shard gets its own
+    SqlAlchemyUnitOfWork, opened the first time a product on it is touched,
+    and commit() commits the touched shards one after another: a handler
+    that changes products on two shards is not atomic across them. A
+    failure after the first shard has committed is raised as
+    PartiallyCommitted, which is not retried.
+
+    The home database holds the batch_shards directory and the read model,
+    and self.session is a session on it, so view handlers work unchanged.
+    New batches go into the directory, in a commit of their own, before
+    the shards commit. If a shard then fails, the directory is left with a
+    row for a batch that isn't there, which lookups treat as unknown and a
+    retry overwrites; the other way round a batch would be unreachable.
+
+    Outbox rows are written with the change they describe, so on its
+    shard: outbox_relay drains every shard as well as the home database.
+    With reuse_connection, the home database and each shard keep one
+    connection until close().
+    """
+
+    def __init__(
+        self,
+        shard_session_factories: Dict[str, sessionmaker],
+        home_session_factory=DEFAULT_SESSION_FACTORY,
+        ring: sharding.HashRing = None,
+        loading="selectin",
+        reuse_connection=False,
+    ):
+        self.shard_session_factories = shard_session_factories
+        self.home_session_factory = home_session_factory
+        self.ring = ring or sharding.HashRing(shard_session_factories)
+        self.loading = loading
+        self.reuse_connection = reuse_connection
+        self._connection = None
+        # kept across __enter__s, so their reused connections are too
+        self._shard_uows = {}  # type: Dict[str, SqlAlchemyUnitOfWork]
 
     def __enter__(self):
-        self.session = self.session_factory()
-        self.products = repository.SqlAlchemyRepository(session=self.session)
+        options = {}
+        if self.reuse_connection:
+            if self._connection is None:
+                self._connection = self.home_session_factory.kw["bind"].connect()
+            options["bind"] = self._connection
+        self.session = self.home_session_factory(**options)
+        self._shards = {}  # type: Dict[str, SqlAlchemyUnitOfWork]
+        self.products = sharding.ShardedRepository(
+            self.ring, self._repository_for, self.session
+        )
         return super().__enter__()
 
     def __exit__(self, *args):
         super().__exit__(*args)
+        for shard_uow in self._shards.values():
+            shard_uow.__exit__(*args)
         self.session.close()
 
     def _commit(self):
+        new_batches = [
+            (obj.reference, obj.sku, shard)
+            for shard, shard_uow in self._shards.items()
+            for obj in shard_uow.session.new
+            if isinstance(obj, model.Batch)
+        ]
+        if new_batches:
+            sharding.add_to_directory(self.session, new_batches)
         self.session.commit()
+        committed = []  # type: List[str]
+        for shard, shard_uow in self._shards.items():
+            try:
+                shard_uow.commit()
+            except Exception as e:
+                if committed:
+                    raise PartiallyCommitted(
+                        f"{shard} failed after {committed} committed: {e}"
+                    ) from e
+                raise
+            committed.append(shard)
 
     def rollback(self):
+        for shard_uow in self._shards.values():
+            shard_uow.rollback()
         self.session.rollback()
+
+    def close(self):
+        for shard_uow in self._shard_uows.values():
+            shard_uow.close()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _repository_for(self, shard: str) -> repository.AbstractProductRepository:
+        if shard not in self._shards:
+            shard_uow = self._shard_uows.get(shard)
+            if shard_uow is None:
+                shard_uow = self._shard_uows[shard] = SqlAlchemyUnitOfWork(
+                    self.shard_session_factories[shard],
+                    loading=self.loading,
+                    reuse_connection=self.reuse_connection,
+                )
+            shard_uow.__enter__()
+            self._shards[shard] = shard_uow
+        return self._shards[shard].products
+
+
+def configured_uow(reuse_connection=False) -> AbstractUnitOfWork:
+    """A unit of work on the configured database, or its shards if any."""
+    store = config.get_product_store_settings()
+    if store["events"] and (SHARD_SESSION_FACTORIES or DEFAULT_AGGREGATE_CACHE):
+        raise ValueError(
+            "PRODUCT_STORE=events can't be combined with DB_SHARDS"
+            " or AGGREGATE_CACHE_SIZE"
+        )
+    if SHARD_SESSION_FACTORIES:
+        return ShardedUnitOfWork(
+            SHARD_SESSION_FACTORIES, reuse_connection=reuse_connection
+        )
+    if store["events"]:
+        return EventSourcedUnitOfWork(
+            snapshot_every=store["snapshot_every"], read_router=DEFAULT_READ_ROUTER
+        )
+    return SqlAlchemyUnitOfWork(
+        reuse_connection=reuse_connection,
+        read_router=DEFAULT_READ_ROUTER,
+        product_cache=DEFAULT_AGGREGATE_CACHE,
+    )
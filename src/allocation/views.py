@@ -1,16 +1,59 @@
+from typing import Dict, Iterator
+
+from sqlalchemy import select
+
+from allocation.adapters import orm, view_cache
 from allocation.service_layer import unit_of_work
 
+EXPORT_CHUNK_SIZE = 1000
+
 
 def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
-    with uow:
+    cache = view_cache.allocations_cache
+    cached = cache.get(orderid)
+    if cached is not None:
+        return cached
+    generation = cache.generation(orderid)
+    with uow.reading(orderid=orderid) as session:
         results = list(
-            uow.session.execute(
-                "SELECT ol.sku, b.reference"
-                " FROM allocations AS a"
-                " JOIN batches AS b ON a.batch_id = b.id"
-                " JOIN order_lines AS  ol ON a.orderline_id = ol.id"
-                " WHERE ol.orderid = :orderid",
+            session.execute(
+                "SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid",
                 dict(orderid=orderid),
             )
         )
-        return [{"sku": sku, "batchref": batchref} for sku, batchref in results]
+        # a lagging replica's answer would outlive the invalidation
+        from_replica = session.info.get("replica", False)
+    result = [{"sku": sku, "batchref": batchref} for sku, batchref in results]
+    if result and not from_replica:  # unknown orders may be allocated soon
+        cache.set(orderid, result, generation=generation)
+    return result
+
+
+def export_allocations(
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    sku: str = None,
+    batchref: str = None,
+    orderid_prefix: str = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> Iterator[Dict]:
+    """
+    Every allocation matching the filters, in orderid order, read through a
+    server-side cursor chunk_size rows at a time, so memory stays flat
+    however many there are. The session is held until the iterator is
+    exhausted or closed.
+    """
+    view = orm.allocations_view
+    query = select(view.c.orderid, view.c.sku, view.c.qty, view.c.batchref)
+    if sku is not None:
+        query = query.where(view.c.sku == sku)
+    if batchref is not None:
+        query = query.where(view.c.batchref == batchref)
+    if orderid_prefix:
+        query = query.where(
+            view.c.orderid.startswith(orderid_prefix, autoescape=True)
+        )
+    query = query.order_by(view.c.orderid, view.c.sku, view.c.batchref)
+    with uow.reading() as session:
+        result = session.execute(query.execution_options(stream_results=True))
+        for row in result.yield_per(chunk_size):
+            yield dict(row._mapping)
@@ -0,0 +1,45 @@
+"""
+Allocation cost against a single batch as the number of lines it holds grows.
+
+    python -m tests.benchmarks.bench_batch_allocation
+
+With a running allocated total the time per allocate should stay flat;
+recomputing the sum on every read makes it grow linearly with the lines.
+"""
+import timeit
+
+from allocation.domain.model import Batch, OrderLine
+
+SKU = "BENCH-SKU"
+LINES_PER_BATCH = [100, 1_000, 10_000, 50_000]
+ALLOCATIONS = 200
+
+
+def make_batch(n_lines):
+    batch = Batch("bench-batch", SKU, qty=n_lines + ALLOCATIONS * 2, eta=None)
+    for i in range(n_lines):
+        batch.allocate(OrderLine(f"existing-{i}", SKU, 1))
+    return batch
+
+
+def time_allocations(batch):
+    lines = [OrderLine(f"new-{i}", SKU, 1) for i in range(ALLOCATIONS)]
+
+    def allocate_all():
+        for line in lines:
+            batch.allocate(line)
+        for line in lines:
+            batch.deallocate(line)
+
+    return min(timeit.repeat(allocate_all, number=1, repeat=5)) / ALLOCATIONS
+
+
+def main():
+    print(f"{'lines in batch':>15} {'us per allocate':>16}")
+    for n_lines in LINES_PER_BATCH:
+        per_call = time_allocations(make_batch(n_lines))
+        print(f"{n_lines:>15} {per_call * 1e6:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
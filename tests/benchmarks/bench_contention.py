@@ -0,0 +1,98 @@
+"""
+Many threads allocating against one sku, reporting throughput and how many
+retries each command needed.
+
+    python -m tests.benchmarks.bench_contention --threads 16 --lines 50 \\
+        --isolation "READ COMMITTED"
+
+Runs against the configured Postgres (see allocation.config).
+"""
+import argparse
+import collections
+import threading
+import time
+import uuid
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation import bootstrap, config
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import handlers, unit_of_work
+
+
+class CountingUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+    def __init__(self, session_factory):
+        super().__init__(session_factory)
+        self.conflicts = 0
+
+    def _commit(self):
+        try:
+            super()._commit()
+        except unit_of_work.ConcurrencyConflict:
+            self.conflicts += 1
+            raise
+
+
+def worker(bus, session_factory, sku, n_lines, retries, failures):
+    for _ in range(n_lines):
+        uow = CountingUnitOfWork(session_factory)
+        try:
+            bus.handle(commands.Allocate(uuid.uuid4().hex, sku, 1), uow)
+        except unit_of_work.ConcurrencyConflict:
+            failures.append(1)
+        retries.append(uow.conflicts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--lines", type=int, default=25, help="per thread")
+    parser.add_argument("--isolation", default="READ COMMITTED")
+    parser.add_argument("--attempts", type=int, default=10)
+    args = parser.parse_args()
+
+    engine = create_engine(
+        config.get_postgres_uri(),
+        isolation_level=args.isolation,
+        pool_size=args.threads,
+    )
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    bus = bootstrap.bootstrap(
+        uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        # measure allocation, not side effects
+        event_handlers={event_type: [] for event_type in handlers.EVENT_HANDLERS},
+        retry_policy=dict(config.get_command_retry_policy(), attempts=args.attempts),
+    )
+
+    sku = f"contended-{uuid.uuid4().hex[:6]}"
+    bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 10 ** 9, None))
+
+    retries, failures = [], []  # type: ignore
+    threads = [
+        threading.Thread(
+            target=worker,
+            args=(bus, session_factory, sku, args.lines, retries, failures),
+        )
+        for _ in range(args.threads)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = args.threads * args.lines
+    print(f"isolation={args.isolation} threads={args.threads} commands={total}")
+    print(f"throughput: {(total - len(failures)) / elapsed:.1f} allocations/s")
+    print(f"gave up after {args.attempts} attempts: {len(failures)}")
+    print("retries per command:")
+    for n_retries, count in sorted(collections.Counter(retries).items()):
+        print(f"  {n_retries:>3}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Memory and time to build, load and allocate against one hot product with
+many allocated lines.
+
+    python -m tests.benchmarks.bench_domain_memory --lines 100000
+
+Loading goes through the ORM from an in-memory sqlite database, so it
+shows what a worker holds per hot product once it has been read.
+
+__slots__ don't help here: classical mapping keeps the instance state and
+the mapped columns in each instance's __dict__, so it has to stay.
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from allocation.adapters import orm, repository
+from allocation.domain import model
+
+SKU = "HOT-LAMP"
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = build()
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size, elapsed
+
+
+def allocated_product(n_lines):
+    product = model.Product(SKU, [model.Batch("hot-batch", SKU, n_lines * 2, None)])
+    for i in range(n_lines):
+        product.allocate(model.OrderLine(f"order-{i}", SKU, 1))
+    product.events.clear()
+    return product
+
+
+def reallocate_all(product):
+    # rehashes every line, as a quantity change or a reload of the set does
+    batch = product.batches[0]
+    batch._allocations = set(batch._allocations)
+    return product
+
+
+def seed(engine, n_lines):
+    with engine.begin() as connection:
+        connection.execute(orm.products.insert(), [dict(sku=SKU, version_number=1)])
+        connection.execute(
+            orm.batches.insert(),
+            [
+                dict(
+                    id=1,
+                    reference="hot-batch",
+                    sku=SKU,
+                    _purchased_quantity=n_lines * 2,
+                    eta=None,
+                )
+            ],
+        )
+        connection.execute(
+            orm.order_lines.insert(),
+            [
+                dict(id=i, orderid=f"order-{i}", sku=SKU, qty=1)
+                for i in range(1, n_lines + 1)
+            ],
+        )
+        connection.execute(
+            orm.allocations.insert(),
+            [dict(orderline_id=i, batch_id=1) for i in range(1, n_lines + 1)],
+        )
+
+
+def load_and_allocate(session_factory, extra):
+    # no unit of work: its rollback on exit would expire what we measure
+    session = session_factory()
+    product = repository.SqlAlchemyRepository(session).get(SKU)
+    for i in range(extra):
+        product.allocate(model.OrderLine(f"extra-{i}", SKU, 1))
+    return session, product
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=100_000)
+    parser.add_argument(
+        "--extra", type=int, default=1000, help="allocations after load"
+    )
+    args = parser.parse_args()
+
+    print(f"{'in memory':<30} {'MiB':>8} {'seconds':>8}")
+    size, elapsed = measure(lambda: allocated_product(args.lines))
+    print(f"{'allocate':<30} {size / 2 ** 20:>8.1f} {elapsed:>8.2f}")
+    product = allocated_product(args.lines)
+    _, elapsed = measure(lambda: reallocate_all(product))
+    print(f"{'rehash':<30} {'':>8} {elapsed:>8.2f}")
+
+    engine = create_engine(
+        "sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False}
+    )
+    orm.metadata.create_all(engine)
+    seed(engine, args.lines)
+    orm.start_mappers()
+    try:
+        size, elapsed = measure(
+            lambda: load_and_allocate(sessionmaker(bind=engine), args.extra)
+        )
+    finally:
+        clear_mappers()
+    print(f"{'ORM load + allocate':<30} {size / 2 ** 20:>8.1f} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
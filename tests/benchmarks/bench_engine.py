@@ -0,0 +1,82 @@
+"""
+Allocations per second on one hot sku, through the message bus (a load and a
+commit per line) and through the in-memory AllocationEngine (one fsync per
+group of waiting commands).
+
+    python -m tests.benchmarks.bench_engine --allocations 2000 --clients 8
+
+Both run against a sqlite file in a temporary directory, with the engine's
+log next to it. The bus runs one client, since sqlite takes one writer at a
+time; the engine also runs --clients, to show group commit.
+"""
+import argparse
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation import bootstrap
+from allocation.adapters import orm, write_ahead_log
+from allocation.domain import commands
+from allocation.service_layer import allocation_engine, unit_of_work
+
+SKU = "FLASH-SALE-LAMP"
+
+
+def run_clients(handle, n_allocations, n_clients):
+    def client(offset):
+        for i in range(offset, n_allocations, n_clients):
+            handle(commands.Allocate(f"order-{i}", SKU, 1))
+
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(n_clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return n_allocations / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--allocations", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = create_engine(f"sqlite:///{directory}/bench.db")
+        orm.metadata.create_all(db)
+        session_factory = sessionmaker(bind=db)
+        bus = bootstrap.bootstrap(
+            uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+            send_mail=lambda *args: None,
+        )
+        try:
+            bus.handle(commands.CreateBatch("bus-batch", SKU, 10 ** 9, None))
+            bus_rate = run_clients(bus.handle, args.allocations, 1)
+
+            print(f"{'path':<28} {'allocations/s':>14} {'fsyncs':>7}")
+            print(f"{'message bus, 1 client':<28} {bus_rate:>14,.0f} {'':>7}")
+            for n_clients in sorted({1, args.clients}):
+                log = write_ahead_log.WriteAheadLog(f"{directory}/wal-{n_clients}")
+                engine = allocation_engine.AllocationEngine(
+                    [SKU],
+                    log,
+                    session_factory=session_factory,
+                    fallback=bus,
+                    name=f"bench-{n_clients}",
+                )
+                engine.start()
+                rate = run_clients(engine.handle, args.allocations, n_clients)
+                syncs = engine.stats()["syncs"]
+                engine.stop()
+                name = f"engine, {n_clients} client{'s' if n_clients > 1 else ''}"
+                print(f"{name:<28} {rate:>14,.0f} {syncs:>7}")
+        finally:
+            clear_mappers()
+
+
+if __name__ == "__main__":
+    main()
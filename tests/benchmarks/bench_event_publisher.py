@@ -0,0 +1,86 @@
+"""
+Events per second published one round trip at a time with asdict, against
+the buffered, pipelined publisher with precomputed encoders.
+
+    python -m tests.benchmarks.bench_event_publisher --rtt-ms 0.2
+
+The stand-in Redis only sleeps for one simulated round trip per request, so
+the numbers show what batching saves on the wire, not Redis' own cost. Pass
+--real to publish to the configured Redis instead.
+"""
+import argparse
+import json
+import time
+from dataclasses import asdict
+
+from allocation.adapters import redis_eventpublisher
+from allocation.domain import events
+
+
+class StandInPipeline:
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.pending = 0
+
+    def publish(self, channel, payload):
+        self.pending += 1
+
+    def execute(self):
+        time.sleep(self.rtt)
+        self.pending = 0
+
+
+class StandInRedis:
+    def __init__(self, rtt):
+        self.rtt = rtt
+
+    def publish(self, channel, payload):
+        time.sleep(self.rtt)
+
+    def pipeline(self, transaction=True):
+        return StandInPipeline(self.rtt)
+
+
+def one_at_a_time(client, batch):
+    for event in batch:
+        client.publish("line_allocated", json.dumps(asdict(event)))
+
+
+def buffered(client, batch, max_batch):
+    publisher = redis_eventpublisher.BufferedPublisher(
+        client, max_batch=max_batch, max_delay=60
+    )
+    for event in batch:
+        publisher.publish("line_allocated", redis_eventpublisher.encode(event))
+    publisher.flush()
+
+
+def events_per_second(publish, batch):
+    start = time.perf_counter()
+    publish(batch)
+    return len(batch) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--rtt-ms", type=float, default=0.2)
+    parser.add_argument("--real", action="store_true")
+    args = parser.parse_args()
+
+    client = redis_eventpublisher.r if args.real else StandInRedis(args.rtt_ms / 1000)
+    batch = [
+        events.Allocated(f"order-{i}", "BENCH-SKU", 1, "bench-batch")
+        for i in range(args.events)
+    ]
+
+    print(f"{'publisher':>22} {'events/s':>12}")
+    rate = events_per_second(lambda b: one_at_a_time(client, b), batch)
+    print(f"{'one at a time':>22} {rate:>12.0f}")
+    for max_batch in (10, 100, 500):
+        rate = events_per_second(lambda b: buffered(client, b, max_batch), batch)
+        print(f"{f'buffered, batch={max_batch}':>22} {rate:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
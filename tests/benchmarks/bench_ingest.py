@@ -0,0 +1,74 @@
+"""
+Batches per second added through the message bus (a CreateBatch, a product
+load and a commit each) and through batch_ingest (a chunk per transaction),
+and the peak memory each ingest of the feed takes.
+
+    python -m tests.benchmarks.bench_ingest --batches 20000 --skus 500
+
+Both run against a sqlite file in a temporary directory; the feed is a CSV
+file written next to it.
+"""
+import argparse
+import csv
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation import bootstrap
+from allocation.adapters import batch_ingest, orm
+from allocation.service_layer import unit_of_work
+
+
+def write_feed(path, n_batches, n_skus, prefix):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ref", "sku", "qty", "eta"])
+        for i in range(n_batches):
+            writer.writerow([f"{prefix}-{i}", f"SKU-{i % n_skus}", 100, ""])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", type=int, default=20000)
+    parser.add_argument("--skus", type=int, default=500)
+    parser.add_argument("--bus-batches", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = create_engine(f"sqlite:///{directory}/bench.db")
+        orm.metadata.create_all(db)
+        session_factory = sessionmaker(bind=db)
+        bus = bootstrap.bootstrap(
+            uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+            send_mail=lambda *args: None,
+        )
+        try:
+            write_feed(f"{directory}/bus.csv", args.bus_batches, args.skus, "bus")
+            start = time.perf_counter()
+            with open(f"{directory}/bus.csv", newline="") as lines:
+                for command in batch_ingest.read_csv(lines):
+                    bus.handle(command)
+            bus_rate = args.bus_batches / (time.perf_counter() - start)
+        finally:
+            clear_mappers()
+
+        print(f"{'path':<24} {'batches':>8} {'batches/s':>10} {'peak MiB':>9}")
+        print(f"{'message bus':<24} {args.bus_batches:>8} {bus_rate:>10,.0f}")
+        for n_batches in (args.batches // 4, args.batches):
+            path = f"{directory}/feed-{n_batches}.csv"
+            write_feed(path, n_batches, args.skus, f"feed-{n_batches}")
+            tracemalloc.start()
+            start = time.perf_counter()
+            with open(path, newline="") as lines:
+                batch_ingest.ingest(db, batch_ingest.read_csv(lines))
+            rate = n_batches / (time.perf_counter() - start)
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+            print(f"{'batch_ingest':<24} {n_batches:>8} {rate:>10,.0f} {peak:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
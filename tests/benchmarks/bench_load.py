@@ -0,0 +1,279 @@
+"""
+Replays a mixed workload through the API and the Redis consumer and reports
+latency percentiles, throughput and SQL statements per operation.
+
+    python -m tests.benchmarks.bench_load --backend sqlite --ops 5000
+    python -m tests.benchmarks.bench_load --backend postgres --clients 8 \\
+        --save results.json --compare baseline.json
+
+Skus are drawn from a Zipf distribution (--zipf-s), so a few hot products
+see most of the traffic. A --read-ratio share of operations are
+GET /allocations for an order we allocated earlier. The rest are
+POST /allocate, with a POST /add_batch every --add-batch-every writes.
+Every --burst-every operations, a burst of --burst-size batch quantity
+changes goes through the Redis consumer's handler. The outbox is then
+relayed to a stand-in Redis that sleeps --rtt-ms per round trip.
+
+The sqlite backend is in-memory, on one shared connection, so it runs a
+single client. The postgres backend uses the configured database.
+
+--compare exits non-zero when any operation's p95, or the throughput, is
+more than --tolerance worse than in the saved run.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+from allocation.adapters import orm, redis_eventpublisher
+from allocation.entrypoints import flask_app, outbox_relay, redis_eventconsumer
+from allocation.service_layer import unit_of_work
+from tests.benchmarks.bench_event_publisher import StandInRedis
+
+BIG = 10 ** 9
+
+
+class ZipfSkus:
+    def __init__(self, skus, s, rng):
+        self.skus = skus
+        self.cum_weights = list(
+            itertools.accumulate(1 / rank ** s for rank in range(1, len(skus) + 1))
+        )
+        self.rng = rng
+
+    def __call__(self):
+        return self.rng.choices(self.skus, cum_weights=self.cum_weights)[0]
+
+
+class Recorder:
+    """Latencies and SQL statements per kind of operation, across threads."""
+
+    def __init__(self, engine):
+        self.latencies = defaultdict(list)
+        self.statements = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        event.listen(engine, "before_cursor_execute", self._statement_executed)
+
+    def _statement_executed(self, *_):
+        self._local.count = self._statements_so_far() + 1
+
+    def _statements_so_far(self):
+        return getattr(self._local, "count", 0)
+
+    @contextlib.contextmanager
+    def timing(self, kind):
+        statements = self._statements_so_far()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies[kind].append(elapsed)
+            self.statements[kind] += self._statements_so_far() - statements
+
+    def summary(self, elapsed):
+        operations = {}
+        for kind, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            operations[kind] = dict(
+                count=len(latencies),
+                p50_ms=percentile(latencies, 50) * 1000,
+                p95_ms=percentile(latencies, 95) * 1000,
+                p99_ms=percentile(latencies, 99) * 1000,
+                statements_per_op=self.statements[kind] / len(latencies),
+            )
+        total = sum(op["count"] for op in operations.values())
+        return dict(throughput=total / elapsed, operations=operations)
+
+
+def percentile(ordered, p):
+    rank = max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class Workload:
+    def __init__(self, skus):
+        self.skus = skus
+        self.batchrefs = {sku: [f"{sku}-batch-0"] for sku in skus}
+        self.orders = []  # type: list
+        self.lock = threading.Lock()
+
+
+def seed(http, workload):
+    for sku in workload.skus:
+        ref = workload.batchrefs[sku][0]
+        post(http, "/add_batch", ref=ref, sku=sku, qty=BIG, eta=None)
+
+
+def post(http, url, **json_body):
+    response = http.post(url, json=json_body)
+    if response.status_code >= 500:
+        raise RuntimeError(f"{url} failed: {response.get_data(as_text=True)}")
+    return response
+
+
+def client(engine, args, n_ops, rng, workload, recorder):
+    http = flask_app.app.test_client()
+    publisher = redis_eventpublisher.BufferedPublisher(
+        StandInRedis(args.rtt_ms / 1000), max_batch=500, max_delay=60
+    )
+    next_sku = ZipfSkus(workload.skus, args.zipf_s, rng)
+    writes = 0
+    for op in range(1, n_ops + 1):
+        if workload.orders and rng.random() < args.read_ratio:
+            orderid = rng.choice(workload.orders)
+            with recorder.timing("GET /allocations"):
+                http.get(f"/allocations/{orderid}")
+        elif writes % args.add_batch_every == args.add_batch_every - 1:
+            writes += 1
+            sku = next_sku()
+            ref = f"{sku}-batch-{uuid.uuid4().hex[:8]}"
+            with recorder.timing("POST /add_batch"):
+                post(http, "/add_batch", ref=ref, sku=sku, qty=BIG, eta=None)
+            with workload.lock:
+                workload.batchrefs[sku].append(ref)
+        else:
+            writes += 1
+            orderid = uuid.uuid4().hex
+            with recorder.timing("POST /allocate"):
+                post(
+                    http,
+                    "/allocate",
+                    orderid=orderid,
+                    sku=next_sku(),
+                    qty=rng.randint(1, 10),
+                )
+            with workload.lock:
+                workload.orders.append(orderid)
+
+        if op % args.burst_every == 0:
+            for _ in range(args.burst_size):
+                ref = rng.choice(workload.batchrefs[next_sku()])
+                message = dict(batchref=ref, qty=BIG - rng.randrange(1000))
+                with recorder.timing("redis change_batch_quantity"):
+                    redis_eventconsumer.handle_change_batch_quantity(
+                        {"data": json.dumps(message)}, flask_app.bus
+                    )
+            with recorder.timing("outbox relay"):
+                outbox_relay.relay_batch(engine, publisher)
+
+
+def configure_backend(backend):
+    if backend == "sqlite":
+        engine = create_engine(
+            "sqlite://",
+            poolclass=StaticPool,
+            connect_args={"check_same_thread": False},
+        )
+        unit_of_work.DEFAULT_SESSION_FACTORY.configure(bind=engine)
+    else:
+        engine = unit_of_work.DEFAULT_SESSION_FACTORY.kw["bind"]
+    orm.metadata.create_all(engine)
+    return engine
+
+
+def print_report(args, result):
+    print(
+        f"backend={args.backend} clients={args.clients} ops={args.ops}"
+        f" skus={args.skus} zipf_s={args.zipf_s} read_ratio={args.read_ratio}"
+    )
+    print(f"throughput: {result['throughput']:.1f} ops/s")
+    print(
+        f"{'operation':<30} {'count':>7} {'p50 ms':>8} {'p95 ms':>8}"
+        f" {'p99 ms':>8} {'stmts/op':>9}"
+    )
+    for kind, op in result["operations"].items():
+        print(
+            f"{kind:<30} {op['count']:>7} {op['p50_ms']:>8.2f} {op['p95_ms']:>8.2f}"
+            f" {op['p99_ms']:>8.2f} {op['statements_per_op']:>9.1f}"
+        )
+
+
+def regressions(result, baseline, tolerance):
+    found = []
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        found.append(
+            f"throughput {result['throughput']:.1f} ops/s"
+            f" < {baseline['throughput']:.1f} ops/s"
+        )
+    for kind, op in result["operations"].items():
+        before = baseline["operations"].get(kind)
+        if before and op["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            found.append(
+                f"{kind} p95 {op['p95_ms']:.2f} ms > {before['p95_ms']:.2f} ms"
+            )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["sqlite", "postgres"], default="sqlite")
+    parser.add_argument("--clients", type=int, default=1)
+    parser.add_argument("--ops", type=int, default=2000, help="per client")
+    parser.add_argument("--skus", type=int, default=200)
+    parser.add_argument("--zipf-s", type=float, default=1.1)
+    parser.add_argument("--read-ratio", type=float, default=0.7)
+    parser.add_argument("--add-batch-every", type=int, default=50)
+    parser.add_argument("--burst-every", type=int, default=500)
+    parser.add_argument("--burst-size", type=int, default=50)
+    parser.add_argument("--rtt-ms", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier --save")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    if args.backend == "sqlite":
+        args.clients = 1
+
+    engine = configure_backend(args.backend)
+    run = uuid.uuid4().hex[:6]
+    workload = Workload([f"bench-{run}-{i}" for i in range(args.skus)])
+    seed(flask_app.app.test_client(), workload)
+    recorder = Recorder(engine)
+
+    threads = [
+        threading.Thread(
+            target=client,
+            args=(
+                engine,
+                args,
+                args.ops,
+                random.Random(args.seed + i),
+                workload,
+                recorder,
+            ),
+        )
+        for i in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = recorder.summary(time.perf_counter() - start)
+    result["args"] = vars(args)
+
+    print_report(args, result)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(result, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"REGRESSION: {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Messages per second through MessageBus, against a copy of the module-level
+dispatch it replaced: isinstance checks, a handler dict lookup per message
+and list.pop(0), with the same logging and instrumentation calls.
+
+    python -m tests.benchmarks.bench_messagebus --messages 100000
+
+Handlers are no-ops and the unit of work is in memory, so the numbers are
+the cost of the bus itself.
+"""
+import argparse
+import logging
+import time
+
+from allocation import bootstrap, instrumentation
+from allocation.adapters import repository
+from allocation.domain import commands, events
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+class NullRepository(repository.AbstractProductRepository):
+    def _add(self, product):
+        pass
+
+    def _get(self, sku):
+        return None
+
+    def _get_by_batchref(self, batchref):
+        return None
+
+
+class NullUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    def __init__(self):
+        self.products = NullRepository()
+
+    def _commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def noop(message, uow=None):
+    return None
+
+
+EVENT_HANDLERS = {events.Allocated: [noop, noop]}
+COMMAND_HANDLERS = {commands.Allocate: noop}
+
+
+def legacy_handle(message, uow):
+    results = []
+    queue = [message]
+    try:
+        while queue:
+            message = queue.pop(0)
+            instrumentation.gauge("bus_queue_depth", len(queue))
+            if isinstance(message, events.Event):
+                for handler in EVENT_HANDLERS[type(message)]:
+                    try:
+                        logger.debug(
+                            "handling event %s with handler %s", message, handler
+                        )
+                        with instrumentation.span(
+                            "handler",
+                            handler=handler.__name__,
+                            message=type(message).__name__,
+                        ):
+                            handler(message, uow=uow)
+                        queue.extend(uow.collect_new_events())
+                    except Exception:
+                        logger.exception("Exception handling event %s", message)
+            elif isinstance(message, commands.Command):
+                logger.debug("handling command %s", message)
+                handler = COMMAND_HANDLERS[type(message)]
+                with instrumentation.span(
+                    "handler",
+                    handler=handler.__name__,
+                    message=type(message).__name__,
+                ):
+                    results.append(handler(message, uow=uow))
+                queue.extend(uow.collect_new_events())
+            else:
+                raise Exception(f"{message} was not an Event or Command")
+    finally:
+        uow.close()
+    return results
+
+
+def messages_per_second(handle, message, n):
+    uow = NullUnitOfWork()
+    start = time.perf_counter()
+    for _ in range(n):
+        handle(message, uow)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100_000)
+    args = parser.parse_args()
+
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=NullUnitOfWork,
+        event_handlers=EVENT_HANDLERS,
+        command_handlers=COMMAND_HANDLERS,
+    )
+    workloads = [
+        ("command", commands.Allocate("o1", "QUICK-LAMP", 1)),
+        ("event, 2 handlers", events.Allocated("o1", "QUICK-LAMP", 1, "b1")),
+    ]
+    print(f"{'message':<20} {'legacy msg/s':>14} {'MessageBus msg/s':>18}")
+    for name, message in workloads:
+        legacy = messages_per_second(legacy_handle, message, args.messages)
+        current = messages_per_second(bus.handle, message, args.messages)
+        print(f"{name:<20} {legacy:>14,.0f} {current:>18,.0f}")
+
+
+if __name__ == "__main__":
+    main()
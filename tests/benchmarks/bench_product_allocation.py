@@ -0,0 +1,59 @@
+"""
+Product.allocate against the old sort-and-scan for products with many batches.
+
+    python -m tests.benchmarks.bench_product_allocation
+
+Every batch but the last is nearly exhausted, so the old approach has to sort
+and then test each one before finding room for the line.
+"""
+import timeit
+from datetime import date, timedelta
+
+from allocation.domain.model import Batch, OrderLine, Product
+
+SKU = "BENCH-SKU"
+BATCH_COUNTS = [10, 100, 1000]
+ALLOCATIONS = 200
+
+
+def make_product(n_batches):
+    start = date(2030, 1, 1)
+    batches = [
+        Batch(f"batch-{i}", SKU, qty=1, eta=start + timedelta(days=i))
+        for i in range(n_batches - 1)
+    ]
+    batches.append(Batch("roomy", SKU, qty=ALLOCATIONS * 10, eta=None))
+    batches.reverse()  # roomy batch first in the list, last once sorted by eta
+    batches[0].eta = start + timedelta(days=n_batches)
+    return Product(SKU, batches)
+
+
+def sort_and_scan(product, line):
+    batch = next(b for b in sorted(product.batches) if b.can_allocate(line))
+    batch.allocate(line)
+    return batch.reference
+
+
+def indexed(product, line):
+    return product.allocate(line)
+
+
+def time_allocations(allocate, n_batches):
+    def run():
+        product = make_product(n_batches)
+        for i in range(ALLOCATIONS):
+            allocate(product, OrderLine(f"order-{i}", SKU, 2))
+
+    return min(timeit.repeat(run, number=1, repeat=5)) / ALLOCATIONS
+
+
+def main():
+    print(f"{'batches':>8} {'sort+scan us':>13} {'indexed us':>11} {'speedup':>8}")
+    for n_batches in BATCH_COUNTS:
+        old = time_allocations(sort_and_scan, n_batches)
+        new = time_allocations(indexed, n_batches)
+        print(f"{n_batches:>8} {old * 1e6:>13.1f} {new * 1e6:>11.1f} {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Query plans and timings for the repository and view queries on a large
+dataset, with and without the schema's indexes.
+
+    python -m tests.benchmarks.bench_schema --rows 1000000
+    python -m tests.benchmarks.bench_schema --rows 1000000 --postgres
+
+rows is the number of order lines (and allocations, and allocations_view
+rows); there are ten lines per batch and ten batches per product. SQLite
+runs in a temporary file. --postgres connects to the configured database
+but creates a new schema, bench_schema_<pid>, puts every table in it by
+search_path and drops the schema at the end; the application's tables in
+public are never touched. It needs the CREATE privilege on the database.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text
+
+from allocation import config
+from allocation.adapters import orm
+
+CHUNK = 50_000
+
+QUERIES = {
+    "repository get": (
+        "SELECT sku, version_number FROM products WHERE sku = :sku",
+        lambda n: dict(sku=f"sku-{n // 200}"),
+    ),
+    "get_by_batchref": (
+        "SELECT sku FROM batches WHERE reference = :ref",
+        lambda n: dict(ref=f"batch-{n // 20}"),
+    ),
+    "load product batches": (
+        "SELECT id, reference, _purchased_quantity, eta FROM batches"
+        " WHERE sku = :sku",
+        lambda n: dict(sku=f"sku-{n // 200}"),
+    ),
+    "load batch allocations": (
+        "SELECT ol.id, ol.sku, ol.qty, ol.orderid FROM order_lines AS ol"
+        " JOIN allocations AS a ON a.orderline_id = ol.id WHERE a.batch_id = :id",
+        lambda n: dict(id=n // 20 + 1),
+    ),
+    "allocations view": (
+        "SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid",
+        lambda n: dict(orderid=f"order-{n // 2}"),
+    ),
+    "allocations join (old view)": (
+        "SELECT ol.sku, b.reference FROM allocations AS a"
+        " JOIN batches AS b ON a.batch_id = b.id"
+        " JOIN order_lines AS ol ON a.orderline_id = ol.id"
+        " WHERE ol.orderid = :orderid",
+        lambda n: dict(orderid=f"order-{n // 2}"),
+    ),
+}
+
+
+def populate(engine, rows):
+    n_batches, n_products = rows // 10, rows // 100
+    with engine.begin() as conn:
+        conn.execute(
+            orm.products.insert(),
+            [dict(sku=f"sku-{i}", version_number=0) for i in range(n_products)],
+        )
+        conn.execute(
+            orm.batches.insert(),
+            [
+                dict(
+                    id=i + 1,
+                    reference=f"batch-{i}",
+                    sku=f"sku-{i // 10}",
+                    _purchased_quantity=100,
+                    eta=None,
+                )
+                for i in range(n_batches)
+            ],
+        )
+    for start in range(0, rows, CHUNK):
+        ids = range(start, min(start + CHUNK, rows))
+        with engine.begin() as conn:
+            conn.execute(
+                orm.order_lines.insert(),
+                [
+                    dict(id=i + 1, sku=f"sku-{i // 100}", qty=1, orderid=f"order-{i // 2}")
+                    for i in ids
+                ],
+            )
+            conn.execute(
+                orm.allocations.insert(),
+                [dict(orderline_id=i + 1, batch_id=i // 10 + 1) for i in ids],
+            )
+            conn.execute(
+                orm.allocations_view.insert(),
+                [
+                    dict(
+                        orderid=f"order-{i // 2}",
+                        sku=f"sku-{i // 100}",
+                        qty=1,
+                        batchref=f"batch-{i // 10}",
+                    )
+                    for i in ids
+                ],
+            )
+
+
+def explain(conn, query, params):
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    rows = conn.execute(text(prefix + query), params).fetchall()
+    return [str(row[-1]) for row in rows]
+
+
+def time_query(conn, query, make_params, rows, repeat):
+    statement = text(query)
+    start = time.perf_counter()
+    for i in range(repeat):
+        conn.execute(statement, make_params((i * 7919) % rows)).fetchall()
+    return (time.perf_counter() - start) / repeat
+
+
+def run(engine, rows, with_indexes, repeat):
+    orm.metadata.drop_all(engine)
+    orm.metadata.create_all(engine)
+    if not with_indexes:
+        for table in orm.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(engine)
+    start = time.perf_counter()
+    populate(engine, rows)
+    print(f"\n== {engine.dialect.name}, {rows} rows, indexes={with_indexes}"
+          f" (loaded in {time.perf_counter() - start:.1f}s)")
+    with engine.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("ANALYZE"))
+        for name, (query, make_params) in QUERIES.items():
+            seconds = time_query(conn, query, make_params, rows, repeat)
+            print(f"{name:<28} {seconds * 1e3:>10.3f} ms")
+            for line in explain(conn, query, make_params(0)):
+                print(f"    {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--postgres", action="store_true")
+    args = parser.parse_args()
+
+    if args.postgres:
+        schema = f"bench_schema_{os.getpid()}"
+        admin = create_engine(config.get_postgres_uri())
+        with admin.begin() as conn:
+            conn.execute(text(f"CREATE SCHEMA {schema}"))  # fails if it exists
+        engine = create_engine(
+            config.get_postgres_uri(),
+            connect_args={"options": f"-csearch_path={schema}"},
+        )
+        try:
+            for with_indexes in (False, True):
+                run(engine, args.rows, with_indexes, args.repeat)
+        finally:
+            engine.dispose()
+            with admin.begin() as conn:
+                conn.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+            admin.dispose()
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        for with_indexes in (False, True):
+            run(engine, args.rows, with_indexes, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,7 @@ from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
 
 from allocation.adapters.orm import metadata, start_mappers
-from allocation import config
+from allocation import bootstrap, config
 
 pytest.register_assert_rewrite("tests.e2e.api_client")
 
@@ -30,12 +30,37 @@ def session_factory(in_memory_db):
     clear_mappers()
 
 
+@pytest.fixture
+def file_session_factory(tmp_path):
+    # a file, so each session gets a connection and transaction of its own
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+    engine.dispose()
+
+
+def rows(session_factory, sql):
+    session = session_factory()
+    try:
+        return list(session.execute(sql))
+    finally:
+        session.close()
+
+
 
 @pytest.fixture
 def session(session_factory):
     return session_factory()
 
 
+@pytest.fixture
+def bus():
+    # tests hand the bus their own unit of work
+    return bootstrap.bootstrap(start_orm=False, send_mail=lambda *args: None)
+
+
 @retry(stop=stop_after_delay(10))
 def wait_for_postgres_to_come_up(engine):
     return engine.connect()
@@ -1,3 +1,4 @@
+import json
 import requests
 from allocation import config
 
@@ -25,6 +26,20 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
+def post_to_allocate_many(lines):
+    url = config.get_api_url()
+    r = requests.post(f"{url}/allocate_many", json={"lines": lines})
+    assert r.status_code == 202
+    return r
+
+
 def get_allocation(orderid):
     url = config.get_api_url()
     return requests.get(f"{url}/allocations/{orderid}")
+
+
+def get_allocations_export(**filters):
+    url = config.get_api_url()
+    r = requests.get(f"{url}/allocations", params=filters, stream=True)
+    assert r.status_code == 200
+    return [json.loads(line) for line in r.iter_lines() if line]
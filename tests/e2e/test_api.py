@@ -1,6 +1,12 @@
 import pytest
 from tests.random_refs import random_sku, random_batchref, random_orderid
-from tests.e2e.api_client import post_to_add_batch, post_to_allocate, get_allocation
+from tests.e2e.api_client import (
+    post_to_add_batch,
+    post_to_allocate,
+    post_to_allocate_many,
+    get_allocation,
+    get_allocations_export,
+)
 
 
 @pytest.mark.usefixtures("postgres_db")
@@ -38,3 +44,39 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = get_allocation(order_id)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+def test_allocate_many_returns_a_result_per_line():
+    orderid = random_orderid()
+    sku, unknown_sku = random_sku(), random_sku("unknown")
+    batch = random_batchref()
+    post_to_add_batch(batch, sku, 10, None)
+
+    response = post_to_allocate_many(
+        [
+            {"orderid": orderid, "sku": sku, "qty": 6},
+            {"orderid": orderid, "sku": unknown_sku, "qty": 1},
+            {"orderid": orderid, "sku": sku, "qty": 6},
+        ]
+    )
+
+    assert response.json() == [
+        {"batchref": batch},
+        {"message": f"Invalid sku {unknown_sku}"},
+        {"message": f"Out of stock for sku {sku}"},
+    ]
+
+
+@pytest.mark.usefixtures("postgres_db")
+def test_export_streams_the_allocations_for_an_order_prefix():
+    sku, batch = random_sku(), random_batchref()
+    prefix = random_orderid()
+    post_to_add_batch(batch, sku, 10, None)
+    for i in range(3):
+        post_to_allocate(f"{prefix}-{i}", sku, 1)
+
+    assert get_allocations_export(orderid_prefix=prefix, sku=sku) == [
+        {"orderid": f"{prefix}-{i}", "sku": sku, "qty": 1, "batchref": batch}
+        for i in range(3)
+    ]
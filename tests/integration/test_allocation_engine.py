@@ -0,0 +1,226 @@
+import os
+import threading
+
+import pytest
+
+from allocation.adapters import view_cache, write_ahead_log
+from allocation.domain import commands, events, model
+from allocation.service_layer import allocation_engine, handlers
+from tests.conftest import rows
+
+
+class FakeBus:
+    def __init__(self):
+        self.handled = []
+
+    def handle(self, message, uow=None):
+        self.handled.append(message)
+        if isinstance(message, commands.AllocateMany):
+            return [["from the bus"] * len(message.lines)]
+        return ["from the bus"]
+
+
+def start_engine(session_factory, log_dir, fallback=None):
+    # no periodic checkpoints: tests flush with checkpoint() or stop()
+    engine = allocation_engine.AllocationEngine(
+        ["HOT-LAMP"],
+        write_ahead_log.WriteAheadLog(str(log_dir)),
+        session_factory=session_factory,
+        fallback=fallback or FakeBus(),
+        flush_interval=3600,
+    )
+    engine.start()
+    return engine
+
+
+def test_allocates_in_memory_and_flushes_on_checkpoint(
+    file_session_factory, tmp_path
+):
+    engine = start_engine(file_session_factory, tmp_path / "wal")
+    engine.handle(commands.CreateBatch("b1", "HOT-LAMP", 100, None))
+
+    assert engine.handle(commands.Allocate("o1", "HOT-LAMP", 10)) == ["b1"]
+    assert rows(file_session_factory, "SELECT * FROM batches") == []
+
+    engine.checkpoint()
+
+    assert rows(
+        file_session_factory, "SELECT sku, version_number FROM products"
+    ) == [("HOT-LAMP", 2)]
+    assert rows(
+        file_session_factory,
+        "SELECT orderid, sku, qty, batchref FROM allocations_view",
+    ) == [("o1", "HOT-LAMP", 10, "b1")]
+    assert rows(file_session_factory, "SELECT channel FROM outbox") == [
+        ("batch_created",),
+        ("line_allocated",),
+    ]
+    assert rows(file_session_factory, "SELECT name, lsn FROM engine_checkpoints") == [
+        ("allocation", 2)
+    ]
+    engine.stop()
+
+
+def test_rebuilds_from_the_log_after_a_crash(file_session_factory, tmp_path):
+    crashed = start_engine(file_session_factory, tmp_path / "wal")
+    crashed.handle(commands.CreateBatch("b1", "HOT-LAMP", 20, None))
+    crashed.handle(commands.Allocate("o1", "HOT-LAMP", 15))
+    # never stopped, so nothing reached the database
+
+    engine = start_engine(file_session_factory, tmp_path / "wal")
+
+    assert engine.handle(commands.Allocate("o2", "HOT-LAMP", 10)) == [None]
+    assert engine.handle(commands.Allocate("o3", "HOT-LAMP", 5)) == ["b1"]
+    engine.stop()
+    assert rows(file_session_factory, "SELECT orderid FROM allocations_view") == [
+        ("o1",),
+        ("o3",),
+    ]
+
+
+def test_rebuilds_from_the_checkpoint_plus_the_log_tail(
+    file_session_factory, tmp_path
+):
+    log_dir = tmp_path / "wal"
+    crashed = start_engine(file_session_factory, log_dir)
+    crashed.handle(commands.CreateBatch("b1", "HOT-LAMP", 20, None))
+    crashed.handle(commands.Allocate("o1", "HOT-LAMP", 5))
+    crashed.checkpoint()
+    crashed.handle(commands.ChangeBatchQuantity("b1", 12))
+    crashed.handle(commands.Allocate("o2", "HOT-LAMP", 5))
+
+    # only the segment written after the checkpoint is left
+    assert len(os.listdir(log_dir)) == 1
+    engine = start_engine(file_session_factory, log_dir)
+
+    assert engine.handle(commands.Allocate("o3", "HOT-LAMP", 3)) == [None]
+    assert engine.handle(commands.Allocate("o4", "HOT-LAMP", 2)) == ["b1"]
+    engine.stop()
+    [(qty, version)] = rows(
+        file_session_factory,
+        "SELECT _purchased_quantity, version_number FROM batches"
+        " JOIN products ON products.sku = batches.sku",
+    )
+    assert (qty, version) == (12, 5)
+
+
+def test_commits_waiting_commands_together(file_session_factory, tmp_path):
+    engine = start_engine(file_session_factory, tmp_path / "wal")
+    engine.handle(commands.CreateBatch("b1", "HOT-LAMP", 100, None))
+    engine.stop()
+
+    engine = allocation_engine.AllocationEngine(
+        ["HOT-LAMP"],
+        write_ahead_log.WriteAheadLog(str(tmp_path / "wal")),
+        session_factory=file_session_factory,
+        flush_interval=3600,
+    )
+    clients = [
+        threading.Thread(
+            target=engine.handle, args=(commands.Allocate(f"o{i}", "HOT-LAMP", 1),)
+        )
+        for i in range(20)
+    ]
+    for client in clients:
+        client.start()
+    while engine.stats()["queued"] < 20:
+        pass
+    engine.start()
+    for client in clients:
+        client.join()
+
+    assert engine.stats()["syncs"] == 1
+    assert engine.stats()["commands"] == 20
+    engine.stop()
+
+
+def test_other_skus_and_out_of_stock_go_to_the_fallback(
+    file_session_factory, tmp_path
+):
+    fallback = FakeBus()
+    engine = start_engine(file_session_factory, tmp_path / "wal", fallback=fallback)
+    engine.handle(commands.CreateBatch("b1", "HOT-LAMP", 1, None))
+
+    assert engine.handle(commands.Allocate("o1", "COLD-LAMP", 1)) == ["from the bus"]
+    engine.handle(commands.Allocate("o2", "HOT-LAMP", 5))
+    engine.stop()
+
+    assert fallback.handled == [
+        commands.Allocate("o1", "COLD-LAMP", 1),
+        events.OutOfStock("HOT-LAMP"),
+    ]
+
+
+def test_unknown_owned_sku_is_invalid(file_session_factory, tmp_path):
+    engine = start_engine(file_session_factory, tmp_path / "wal")
+    with pytest.raises(handlers.InvalidSku):
+        engine.handle(commands.Allocate("o1", "HOT-LAMP", 1))
+    engine.stop()
+
+
+def test_numbering_continues_after_a_clean_stop_emptied_the_log(
+    file_session_factory, tmp_path
+):
+    engine = start_engine(file_session_factory, tmp_path / "wal")
+    engine.handle(commands.CreateBatch("b1", "HOT-LAMP", 20, None))
+    engine.handle(commands.Allocate("o1", "HOT-LAMP", 5))
+    engine.stop()
+    assert os.listdir(tmp_path / "wal") == []
+
+    crashed = start_engine(file_session_factory, tmp_path / "wal")
+    crashed.handle(commands.Allocate("o2", "HOT-LAMP", 7))
+    # never stopped, so o2 is only in the log
+
+    engine = start_engine(file_session_factory, tmp_path / "wal")
+    assert engine.handle(commands.Allocate("o3", "HOT-LAMP", 9)) == [None]
+    assert engine.handle(commands.Allocate("o4", "HOT-LAMP", 8)) == ["b1"]
+    engine.stop()
+
+
+def test_flushing_invalidates_the_cached_views_of_touched_orders(
+    file_session_factory, tmp_path
+):
+    cache = view_cache.LocalViewCache()
+    cache.set("o1", [{"sku": "HOT-LAMP", "batchref": "stale"}])
+    engine = allocation_engine.AllocationEngine(
+        ["HOT-LAMP"],
+        write_ahead_log.WriteAheadLog(str(tmp_path / "wal")),
+        session_factory=file_session_factory,
+        flush_interval=3600,
+        cache=cache,
+    )
+    engine.start()
+    engine.handle(commands.CreateBatch("b1", "HOT-LAMP", 20, None))
+    engine.handle(commands.Allocate("o1", "HOT-LAMP", 5))
+
+    engine.checkpoint()
+
+    assert cache.get("o1") is None
+    engine.stop()
+
+
+def test_allocate_many_sends_only_the_other_skus_lines_to_the_bus(
+    file_session_factory, tmp_path
+):
+    bus = FakeBus()
+    engine = start_engine(file_session_factory, tmp_path / "wal", fallback=bus)
+    engine.handle(commands.CreateBatch("b1", "HOT-LAMP", 10, None))
+    lines = [
+        commands.Allocate("o1", "HOT-LAMP", 10),
+        commands.Allocate("o2", "COLD-LAMP", 1),
+        commands.Allocate("o3", "HOT-LAMP", 1),
+    ]
+
+    [results] = engine.handle(commands.AllocateMany(lines))
+
+    assert results[:2] == ["b1", "from the bus"]
+    assert isinstance(results[2], model.OutOfStock)
+    assert bus.handled == [commands.AllocateMany([lines[1]])]
+    engine.stop()
+
+
+def test_engine_skus_are_refused_with_shards_or_events(monkeypatch):
+    monkeypatch.setenv("ENGINE_SKUS", "HOT-LAMP")
+    monkeypatch.setenv("PRODUCT_STORE", "events")
+    with pytest.raises(ValueError):
+        allocation_engine.configured_engine(FakeBus())
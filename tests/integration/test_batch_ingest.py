@@ -0,0 +1,107 @@
+import io
+
+import pytest
+
+from allocation.adapters import batch_ingest
+from allocation.adapters.aggregate_cache import AggregateCache
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from tests.conftest import rows
+
+FEED = """ref,sku,qty,eta
+b1,RED-CHAIR,10,
+b2,RED-CHAIR,20,2011-01-02
+b3,BLUE-LAMP,5,
+"""
+
+
+def test_ingests_a_feed_in_chunks_with_an_event_per_batch(file_session_factory):
+    engine = file_session_factory.kw["bind"]
+    feed = batch_ingest.read_csv(io.StringIO(FEED))
+
+    counts = batch_ingest.ingest(engine, feed, chunk_size=2)
+
+    assert counts == dict(
+        batches=3, skipped=0, handed_over=0, rejected=0, chunks=2
+    )
+    assert rows(
+        file_session_factory,
+        "SELECT reference, sku, _purchased_quantity FROM batches",
+    ) == [("b1", "RED-CHAIR", 10), ("b2", "RED-CHAIR", 20), ("b3", "BLUE-LAMP", 5)]
+    assert rows(
+        file_session_factory, "SELECT sku, version_number FROM products ORDER BY sku"
+    ) == [("BLUE-LAMP", 1), ("RED-CHAIR", 1)]
+    assert rows(file_session_factory, "SELECT channel FROM outbox") == [
+        ("batch_created",)
+    ] * 3
+    with unit_of_work.SqlAlchemyUnitOfWork(file_session_factory) as uow:
+        product = uow.products.get("RED-CHAIR")
+        assert [str(b.eta) for b in product.batches] == ["None", "2011-01-02"]
+
+
+def test_sending_a_feed_again_skips_the_batches_already_in(file_session_factory):
+    engine = file_session_factory.kw["bind"]
+    batch_ingest.ingest(engine, batch_ingest.read_csv(io.StringIO(FEED)))
+    ndjson = '{"ref": "b3", "sku": "BLUE-LAMP", "qty": 5}\n\n'
+    ndjson += '{"ref": "b4", "sku": "BLUE-LAMP", "qty": 7, "eta": null}\n'
+    feed = batch_ingest.read_ndjson(io.StringIO(ndjson))
+
+    counts = batch_ingest.ingest(engine, feed)
+
+    assert counts == dict(
+        batches=1, skipped=1, handed_over=0, rejected=0, chunks=1
+    )
+    assert rows(
+        file_session_factory, "SELECT sku, version_number FROM products ORDER BY sku"
+    ) == [("BLUE-LAMP", 2), ("RED-CHAIR", 1)]
+
+
+def test_cached_products_see_the_ingested_stock(bus, file_session_factory):
+    cache = AggregateCache()
+
+    def cached_uow():
+        return unit_of_work.SqlAlchemyUnitOfWork(
+            file_session_factory, product_cache=cache
+        )
+
+    bus.handle(commands.CreateBatch("b0", "RED-CHAIR", 5, None), cached_uow())
+    bus.handle(commands.Allocate("o1", "RED-CHAIR", 5), cached_uow())
+    batch_ingest.ingest(
+        file_session_factory.kw["bind"], batch_ingest.read_csv(io.StringIO(FEED))
+    )
+
+    [batchref] = bus.handle(commands.Allocate("o2", "RED-CHAIR", 10), cached_uow())
+    assert batchref == "b1"
+    assert cache.stats()["stale"] == 1
+
+
+def test_a_bad_row_names_its_line():
+    feed = batch_ingest.read_csv(io.StringIO("ref,sku,qty,eta\nb1,RED-CHAIR,ten,\n"))
+    with pytest.raises(batch_ingest.InvalidFeed, match="line 2"):
+        list(feed)
+
+
+def test_batches_for_engine_skus_are_handed_over_or_rejected(file_session_factory):
+    engine = file_session_factory.kw["bind"]
+    handed_over = []
+
+    counts = batch_ingest.ingest(
+        engine,
+        batch_ingest.read_csv(io.StringIO(FEED)),
+        held_skus={"BLUE-LAMP"},
+        hand_over=handed_over.append,
+    )
+
+    assert (counts["batches"], counts["handed_over"]) == (2, 1)
+    assert handed_over == [commands.CreateBatch("b3", "BLUE-LAMP", 5, None)]
+    assert rows(file_session_factory, "SELECT sku FROM products") == [("RED-CHAIR",)]
+    feed = batch_ingest.read_csv(io.StringIO(FEED))
+    counts = batch_ingest.ingest(engine, feed, held_skus={"BLUE-LAMP"})
+    assert (counts["skipped"], counts["rejected"]) == (2, 1)
+
+
+def test_a_bad_row_reports_what_was_committed_before_it(file_session_factory):
+    feed = batch_ingest.read_csv(io.StringIO(FEED + "b4,RED-CHAIR,ten,\n"))
+    with pytest.raises(batch_ingest.InvalidFeed) as raised:
+        batch_ingest.ingest(file_session_factory.kw["bind"], feed, chunk_size=2)
+    assert raised.value.counts["batches"] == 2
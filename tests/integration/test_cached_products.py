@@ -0,0 +1,76 @@
+import pytest
+
+from allocation.adapters.aggregate_cache import AggregateCache
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+
+
+def cached_uow(session_factory, cache):
+    return unit_of_work.SqlAlchemyUnitOfWork(session_factory, product_cache=cache)
+
+
+def test_a_committed_product_is_reused_after_a_version_probe(
+    bus, file_session_factory
+):
+    cache = AggregateCache()
+    bus.handle(
+        commands.CreateBatch("b1", "HOT-LAMP", 100, None),
+        cached_uow(file_session_factory, cache),
+    )
+    bus.handle(
+        commands.Allocate("o1", "HOT-LAMP", 10),
+        cached_uow(file_session_factory, cache),
+    )
+
+    uow = cached_uow(file_session_factory, cache)
+    with uow:
+        product = uow.products.get("HOT-LAMP")
+        assert uow.statement_count == 1
+        assert product.batches[0].available_quantity == 90
+    assert cache.stats()["hits"] == 2
+
+
+def test_a_product_changed_elsewhere_is_reloaded(bus, file_session_factory):
+    cache = AggregateCache()
+    bus.handle(
+        commands.CreateBatch("b1", "HOT-LAMP", 100, None),
+        cached_uow(file_session_factory, cache),
+    )
+    bus.handle(
+        commands.Allocate("o1", "HOT-LAMP", 30),
+        unit_of_work.SqlAlchemyUnitOfWork(file_session_factory),
+    )
+
+    uow = cached_uow(file_session_factory, cache)
+    with uow:
+        product = uow.products.get("HOT-LAMP")
+        assert product.batches[0].available_quantity == 70
+    assert cache.stats()["stale"] == 1
+
+
+def test_a_cached_product_cannot_oversell(bus, file_session_factory):
+    cache = AggregateCache()
+    bus.handle(
+        commands.CreateBatch("b1", "HOT-LAMP", 10, None),
+        cached_uow(file_session_factory, cache),
+    )
+
+    uow = cached_uow(file_session_factory, cache)
+    with uow:
+        product = uow.products.get("HOT-LAMP")
+        assert cache.stats()["hits"] == 1
+        # someone else takes the whole batch after our version probe
+        handlers.allocate(
+            commands.Allocate("o1", "HOT-LAMP", 10),
+            unit_of_work.SqlAlchemyUnitOfWork(file_session_factory),
+        )
+        product.allocate(model.OrderLine("o2", "HOT-LAMP", 10))
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            uow.commit()
+    uow.close()
+
+    uow = cached_uow(file_session_factory, cache)
+    with uow:
+        [batch] = uow.products.get("HOT-LAMP").batches
+        assert batch.available_quantity == 0
+        assert {line.orderid for line in batch._allocations} == {"o1"}
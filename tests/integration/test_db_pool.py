@@ -0,0 +1,70 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, clear_mappers
+
+from allocation.adapters import db_pool
+from allocation.adapters.orm import metadata, start_mappers
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def pooled_session_factory(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=db_pool.InstrumentedQueuePool,
+        pool_size=2,
+        max_overflow=0,
+    )
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+    engine.dispose()
+
+
+def test_pool_counts_checkouts_and_checked_out(pooled_session_factory):
+    pool = pooled_session_factory.kw["bind"].pool
+    before = pool.metrics()["checkouts"]
+
+    connection = pooled_session_factory.kw["bind"].connect()
+    assert pool.metrics()["checked_out"] == 1
+    connection.close()
+
+    metrics = pool.metrics()
+    assert metrics["checked_out"] == 0
+    assert metrics["checkouts"] == before + 1
+    assert metrics["overflow"] == 0
+    assert metrics["wait_seconds_max"] >= 0
+
+
+def test_reused_connection_is_checked_out_once_per_bus_run(
+    bus, pooled_session_factory
+):
+    pool = pooled_session_factory.kw["bind"].pool
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        pooled_session_factory, reuse_connection=True
+    )
+    bus.handle(commands.CreateBatch("b1", "POOLED-LAMP", 100, None), uow)
+    before = pool.metrics()["checkouts"]
+
+    results = bus.handle(commands.Allocate("o1", "POOLED-LAMP", 10), uow)
+
+    assert results == ["b1"]
+    assert pool.metrics()["checkouts"] == before + 1
+    assert pool.metrics()["checked_out"] == 0
+
+
+def test_statements_on_a_reused_connection_are_counted_once(pooled_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        pooled_session_factory, reuse_connection=True
+    )
+    with uow:
+        uow.session.execute("SELECT 1")
+        uow.commit()
+    with uow:
+        uow.session.execute("SELECT 1")
+        uow.commit()
+    uow.close()
+
+    assert uow.statement_count == 2
@@ -0,0 +1,117 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+from tests.conftest import rows
+
+
+def test_products_are_stored_as_events_and_rebuilt(bus, file_session_factory):
+    def uow():
+        return unit_of_work.EventSourcedUnitOfWork(file_session_factory)
+
+    bus.handle(commands.CreateBatch("b1", "RED-CHAIR", 20, None), uow())
+    bus.handle(commands.CreateBatch("b2", "RED-CHAIR", 20, None), uow())
+    bus.handle(commands.Allocate("o1", "RED-CHAIR", 15), uow())
+    bus.handle(commands.ChangeBatchQuantity("b1", 10), uow())
+
+    assert rows(file_session_factory, "SELECT type FROM product_events") == [
+        ("BatchCreated",),
+        ("BatchCreated",),
+        ("Allocated",),
+        ("BatchQuantityChanged",),
+        ("Allocated",),
+    ]
+    assert rows(file_session_factory, "SELECT * FROM batches") == []
+    assert rows(
+        file_session_factory, "SELECT orderid, batchref FROM allocations_view"
+    ) == [("o1", "b2")]
+    with uow() as loaded:
+        product = loaded.products.get("RED-CHAIR")
+        assert product.version_number == 5
+        assert [b.available_quantity for b in product.batches] == [10, 5]
+
+
+def test_loads_from_the_latest_snapshot_plus_the_tail(bus, file_session_factory):
+    def uow():
+        return unit_of_work.EventSourcedUnitOfWork(
+            file_session_factory, snapshot_every=3
+        )
+
+    bus.handle(commands.CreateBatch("b1", "RED-CHAIR", 100, None), uow())
+    for i in range(4):
+        bus.handle(commands.Allocate(f"o{i}", "RED-CHAIR", 10), uow())
+
+    assert rows(file_session_factory, "SELECT sku, seq FROM product_snapshots") == [
+        ("RED-CHAIR", 3)
+    ]
+    session = file_session_factory()
+    session.execute("DELETE FROM product_events WHERE seq <= 3")
+    session.commit()
+    with uow() as loaded:
+        product = loaded.products.get("RED-CHAIR")
+        assert product.version_number == 5
+        assert product.batches[0].available_quantity == 60
+        assert loaded.products.get("RED-CHAIR") is product
+
+
+def test_concurrent_appends_to_one_product_conflict(file_session_factory):
+    first = unit_of_work.EventSourcedUnitOfWork(file_session_factory)
+    with first:
+        product = model.Product("RED-CHAIR", batches=[])
+        first.products.add(product)
+        product.add_batch(model.Batch("b1", "RED-CHAIR", 10, None))
+        first.commit()
+
+    first = unit_of_work.EventSourcedUnitOfWork(file_session_factory)
+    second = unit_of_work.EventSourcedUnitOfWork(file_session_factory)
+    with first, second:
+        for uow, orderid in [(first, "o1"), (second, "o2")]:
+            product = uow.products.get("RED-CHAIR")
+            product.allocate(model.OrderLine(orderid, "RED-CHAIR", 10))
+        first.commit()
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            second.commit()
+
+
+def test_the_read_model_is_rebuilt_from_the_events(bus, file_session_factory):
+    def uow():
+        return unit_of_work.EventSourcedUnitOfWork(
+            file_session_factory, snapshot_every=2
+        )
+
+    bus.handle(commands.CreateBatch("b1", "RED-CHAIR", 20, None), uow())
+    bus.handle(commands.CreateBatch("b2", "BLUE-LAMP", 20, None), uow())
+    bus.handle(commands.Allocate("o1", "RED-CHAIR", 5), uow())
+    bus.handle(commands.Allocate("o2", "BLUE-LAMP", 5), uow())
+    bus.handle(commands.Allocate("o3", "RED-CHAIR", 5), uow())
+    session = file_session_factory()
+    session.execute("DELETE FROM allocations_view")
+    session.commit()
+
+    bus.handle(commands.RebuildAllocationsView(), uow())
+
+    assert rows(
+        file_session_factory,
+        "SELECT orderid, sku, batchref FROM allocations_view ORDER BY orderid",
+    ) == [
+        ("o1", "RED-CHAIR", "b1"),
+        ("o2", "BLUE-LAMP", "b2"),
+        ("o3", "RED-CHAIR", "b1"),
+    ]
+
+
+def test_events_mode_is_refused_with_shards(monkeypatch):
+    monkeypatch.setenv("PRODUCT_STORE", "events")
+    monkeypatch.setattr(
+        unit_of_work, "SHARD_SESSION_FACTORIES", {"shard-a": sessionmaker()}
+    )
+    with pytest.raises(ValueError):
+        unit_of_work.configured_uow()
+
+
+def test_events_mode_keeps_the_read_router(monkeypatch):
+    monkeypatch.setenv("PRODUCT_STORE", "events")
+    uow = unit_of_work.configured_uow()
+    assert isinstance(uow, unit_of_work.EventSourcedUnitOfWork)
+    assert uow.read_router is unit_of_work.DEFAULT_READ_ROUTER
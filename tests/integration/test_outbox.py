@@ -0,0 +1,101 @@
+import json
+from datetime import timedelta
+
+from sqlalchemy import create_engine
+
+from allocation.domain import commands, model
+from allocation.entrypoints import outbox_relay
+from allocation.service_layer import unit_of_work
+
+
+class FakePublisher:
+    def __init__(self):
+        self.buffer = []
+        self.flushed = []
+
+    def publish(self, channel, payload):
+        self.buffer.append((channel, payload))
+
+    def flush(self):
+        self.flushed.append(self.buffer)
+        self.buffer = []
+
+
+def unsent_messages(session):
+    return list(
+        session.execute("SELECT channel, payload FROM outbox WHERE sent_at IS NULL")
+    )
+
+
+def test_allocated_event_is_written_to_outbox_with_the_allocation(
+    bus, session_factory
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus.handle(commands.CreateBatch("batch1", "PLUSH-CUSHION", 100, None), uow)
+    bus.handle(commands.Allocate("o1", "PLUSH-CUSHION", 10), uow)
+
+    [created, (channel, payload)] = unsent_messages(session_factory())
+    assert created.channel == "batch_created"
+    assert channel == "line_allocated"
+    assert json.loads(payload) == {
+        "orderid": "o1",
+        "sku": "PLUSH-CUSHION",
+        "qty": 10,
+        "batchref": "batch1",
+    }
+
+
+def test_nothing_reaches_the_outbox_if_the_allocation_rolls_back(
+    bus, session_factory
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus.handle(commands.CreateBatch("batch1", "PLUSH-CUSHION", 100, None), uow)
+    with uow:
+        product = uow.products.get(sku="PLUSH-CUSHION")
+        product.allocate(model.OrderLine("o1", "PLUSH-CUSHION", 10))
+
+    [(channel, _)] = unsent_messages(session_factory())
+    assert channel == "batch_created"
+
+
+def test_relay_publishes_pending_messages_in_one_batch(bus, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus.handle(commands.CreateBatch("batch1", "PLUSH-CUSHION", 100, None), uow)
+    bus.handle(commands.Allocate("o1", "PLUSH-CUSHION", 10), uow)
+    bus.handle(commands.Allocate("o2", "PLUSH-CUSHION", 10), uow)
+    publisher = FakePublisher()
+
+    engine = session_factory.kw["bind"]
+    assert outbox_relay.relay_batch(engine, publisher) == 3
+    assert outbox_relay.relay_batch(engine, publisher) == 0
+
+    [batch] = publisher.flushed
+    assert [json.loads(payload).get("orderid") for _, payload in batch] == [
+        None,
+        "o1",
+        "o2",
+    ]
+    assert unsent_messages(session_factory()) == []
+
+
+def test_relay_reports_a_missing_outbox_table_instead_of_raising():
+    engine = create_engine("sqlite://")  # nothing has created the tables yet
+
+    relayed = outbox_relay.try_relay(
+        outbox_relay.relay_all, [engine], FakePublisher()
+    )
+
+    assert relayed is None
+
+
+def test_pruning_deletes_only_rows_sent_long_enough_ago(bus, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus.handle(commands.CreateBatch("batch1", "PLUSH-CUSHION", 100, None), uow)
+    engine = session_factory.kw["bind"]
+    outbox_relay.relay_batch(engine, FakePublisher())
+    bus.handle(commands.Allocate("o1", "PLUSH-CUSHION", 10), uow)
+
+    assert outbox_relay.prune_all([engine]) == 0
+    assert outbox_relay.prune_all([engine], keep_sent_for=timedelta(0)) == 1
+    [(channel, _)] = session_factory().execute("SELECT channel, payload FROM outbox")
+    assert channel == "line_allocated"
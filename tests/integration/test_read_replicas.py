@@ -0,0 +1,138 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, clear_mappers
+
+from allocation import views
+from allocation.adapters import read_replicas, view_cache
+from allocation.adapters.orm import metadata, start_mappers
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    view_cache.allocations_cache.clear()
+
+
+@pytest.fixture
+def primary_and_replica(tmp_path):
+    engines = [
+        create_engine(f"sqlite:///{tmp_path / name}.db")
+        for name in ("primary", "replica")
+    ]
+    for engine in engines:
+        metadata.create_all(engine)
+    start_mappers()
+    yield [sessionmaker(bind=engine) for engine in engines]
+    clear_mappers()
+
+
+def replicate(primary, replica, tables=("products", "allocations_view")):
+    """Copy what the replica needs for the view, as streaming replication would."""
+    with primary() as source, replica() as target:
+        for table in tables:
+            target.execute(f"DELETE FROM {table}")
+            for row in source.execute(f"SELECT * FROM {table}"):
+                columns = ", ".join(row.keys())
+                params = ", ".join(f":{key}" for key in row.keys())
+                target.execute(
+                    f"INSERT INTO {table} ({columns}) VALUES ({params})",
+                    dict(row._mapping),
+                )
+        target.commit()
+
+
+def allocate_through(bus, router, primary):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(primary, read_router=router)
+    bus.handle(commands.CreateBatch("b1", "RAG-RUG", 100, None), uow)
+    bus.handle(commands.Allocate("o1", "RAG-RUG", 10), uow)
+    return uow
+
+
+def test_replica_policy_reads_from_the_replica(bus, primary_and_replica):
+    primary, replica = primary_and_replica
+    router = read_replicas.ReadRouter(primary, [replica], policy="replica")
+    uow = allocate_through(bus, router, primary)
+
+    assert views.allocations("o1", uow) == []
+    replicate(primary, replica)
+    assert views.allocations("o1", uow) == [{"sku": "RAG-RUG", "batchref": "b1"}]
+    assert router.stats() == {"replica": 2}
+
+
+def test_rows_read_from_a_replica_are_not_cached(bus, primary_and_replica):
+    primary, replica = primary_and_replica
+    router = read_replicas.ReadRouter(primary, [replica], policy="replica")
+    uow = allocate_through(bus, router, primary)
+    replicate(primary, replica)
+
+    views.allocations("o1", uow)
+    views.allocations("o1", uow)
+
+    assert view_cache.allocations_cache.get("o1") is None
+    assert router.stats() == {"replica": 2}
+
+
+def test_read_your_writes_waits_for_the_replica_to_catch_up(bus, primary_and_replica):
+    primary, replica = primary_and_replica
+    router = read_replicas.ReadRouter(primary, [replica], policy="read_your_writes")
+    uow = allocate_through(bus, router, primary)
+
+    assert views.allocations("o1", uow) == [{"sku": "RAG-RUG", "batchref": "b1"}]
+    assert router.stats() == {"fallback_stale": 1}
+
+    view_cache.allocations_cache.clear()
+    replicate(primary, replica)
+    assert views.allocations("o1", uow) == [{"sku": "RAG-RUG", "batchref": "b1"}]
+    assert router.stats() == {"fallback_stale": 1, "replica_checked": 1}
+
+
+def test_orders_we_did_not_write_go_straight_to_the_replica(bus, primary_and_replica):
+    primary, replica = primary_and_replica
+    router = read_replicas.ReadRouter(primary, [replica], policy="read_your_writes")
+    uow = allocate_through(bus, router, primary)
+
+    views.allocations("someone-elses-order", uow)
+
+    assert router.stats() == {"replica": 1}
+
+
+def test_primary_policy_never_uses_replicas(bus, primary_and_replica):
+    primary, replica = primary_and_replica
+    router = read_replicas.ReadRouter(primary, [replica], policy="primary")
+    uow = allocate_through(bus, router, primary)
+
+    assert views.allocations("o1", uow) == [{"sku": "RAG-RUG", "batchref": "b1"}]
+    assert router.stats() == {"primary": 1}
+
+
+def test_unreachable_replica_falls_back_to_primary(
+    bus, primary_and_replica, tmp_path
+):
+    primary, _ = primary_and_replica
+    missing = sessionmaker(
+        bind=create_engine(f"sqlite:///{tmp_path / 'no-such-dir' / 'replica.db'}")
+    )
+    router = read_replicas.ReadRouter(primary, [missing], policy="replica")
+    uow = allocate_through(bus, router, primary)
+
+    assert views.allocations("o1", uow) == [{"sku": "RAG-RUG", "batchref": "b1"}]
+    assert router.stats() == {"fallback_error": 1}
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        read_replicas.ReadRouter(None, policy="whenever")
+
+
+def test_read_your_writes_waits_for_the_view_row_not_just_the_product(
+    bus, primary_and_replica
+):
+    primary, replica = primary_and_replica
+    router = read_replicas.ReadRouter(primary, [replica], policy="read_your_writes")
+    uow = allocate_through(bus, router, primary)
+    # the product's commit has replicated, the view handler's hasn't yet
+    replicate(primary, replica, tables=("products",))
+
+    assert views.allocations("o1", uow) == [{"sku": "RAG-RUG", "batchref": "b1"}]
+    assert router.stats() == {"fallback_stale": 1}
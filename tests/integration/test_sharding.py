@@ -0,0 +1,250 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, clear_mappers
+
+from allocation.adapters import sharding
+from allocation.adapters.orm import metadata, start_mappers
+from allocation.domain import commands
+from allocation.entrypoints import outbox_relay
+from allocation.service_layer import handlers, unit_of_work
+
+SHARDS = ["shard-a", "shard-b", "shard-c"]
+
+
+@pytest.fixture
+def engines(tmp_path):
+    """A home database plus one SQLite file per shard."""
+    engines = {
+        name: create_engine(f"sqlite:///{tmp_path / name}.db")
+        for name in ["home"] + SHARDS + ["shard-d"]
+    }
+    for engine in engines.values():
+        metadata.create_all(engine)
+    start_mappers()
+    yield engines
+    clear_mappers()
+    for engine in engines.values():
+        engine.dispose()
+
+
+def sharded_uow(engines, shards=SHARDS):
+    return unit_of_work.ShardedUnitOfWork(
+        {name: sessionmaker(bind=engines[name]) for name in shards},
+        sessionmaker(bind=engines["home"]),
+    )
+
+
+def skus_on(engine):
+    return {sku for [sku] in engine.execute("SELECT sku FROM products")}
+
+
+def allocated_batch(engine, orderid):
+    return engine.execute(
+        "SELECT b.reference FROM allocations AS a"
+        " JOIN batches AS b ON a.batch_id = b.id"
+        " JOIN order_lines AS ol ON a.orderline_id = ol.id"
+        " WHERE ol.orderid = :orderid",
+        dict(orderid=orderid),
+    ).scalar()
+
+
+def test_products_are_stored_on_the_shard_their_sku_hashes_to(bus, engines):
+    ring = sharding.HashRing(SHARDS)
+    skus = [f"LAMP-{i}" for i in range(12)]
+    for sku in skus:
+        bus.handle(
+            commands.CreateBatch(f"b-{sku}", sku, 100, None), sharded_uow(engines)
+        )
+
+    for shard in SHARDS:
+        expected = {sku for sku in skus if ring.shard_for(sku) == shard}
+        assert skus_on(engines[shard]) == expected
+    assert len({ring.shard_for(sku) for sku in skus}) > 1
+    assert skus_on(engines["home"]) == set()
+
+
+def test_batchrefs_are_resolved_through_the_directory(bus, engines):
+    ring = sharding.HashRing(SHARDS)
+    bus.handle(
+        commands.CreateBatch("b1", "SHARDED-SOFA", 10, None), sharded_uow(engines)
+    )
+    bus.handle(
+        commands.Allocate("o1", "SHARDED-SOFA", 10), sharded_uow(engines)
+    )
+    [[shard]] = engines["home"].execute(
+        "SELECT shard FROM batch_shards WHERE reference = 'b1'"
+    )
+    assert shard == ring.shard_for("SHARDED-SOFA")
+
+    bus.handle(commands.ChangeBatchQuantity("b1", 5), sharded_uow(engines))
+
+    assert allocated_batch(engines[shard], "o1") is None
+
+
+def test_read_model_lives_on_the_home_database(bus, engines):
+    uow = sharded_uow(engines)
+    bus.handle(commands.CreateBatch("b1", "SHARDED-RUG", 10, None), uow)
+    bus.handle(commands.Allocate("o1", "SHARDED-RUG", 2), uow)
+
+    [[batchref]] = engines["home"].execute(
+        "SELECT batchref FROM allocations_view WHERE orderid = 'o1'"
+    )
+    assert batchref == "b1"
+
+
+def test_rebalance_moves_products_with_their_allocations(bus, engines):
+    skus = [f"DESK-{i}" for i in range(20)]
+    for sku in skus:
+        bus.handle(
+            commands.CreateBatch(f"b-{sku}", sku, 10, None), sharded_uow(engines)
+        )
+        bus.handle(
+            commands.Allocate(f"o-{sku}", sku, 3), sharded_uow(engines)
+        )
+
+    grown = SHARDS + ["shard-d"]
+    ring = sharding.HashRing(grown)
+    moves = sharding.rebalance(
+        ring, {name: engines[name] for name in grown}, engines["home"]
+    )
+
+    assert moves
+    assert all(to == "shard-d" for _, _, to in moves)
+    assert skus_on(engines["shard-d"]) == {sku for sku, _, _ in moves}
+    for sku, source, _ in moves:
+        assert sku not in skus_on(engines[source])
+        assert allocated_batch(engines["shard-d"], f"o-{sku}") == f"b-{sku}"
+
+    sku = moves[0][0]
+    bus.handle(
+        commands.ChangeBatchQuantity(f"b-{sku}", 2), sharded_uow(engines, grown)
+    )
+    assert allocated_batch(engines["shard-d"], f"o-{sku}") is None
+
+
+def test_an_interrupted_move_can_be_repeated(bus, engines):
+    ring = sharding.HashRing(SHARDS)
+    sku = "MOVING-BOX"
+    source = ring.shard_for(sku)
+    target = next(shard for shard in SHARDS if shard != source)
+    bus.handle(commands.CreateBatch("b1", sku, 10, None), sharded_uow(engines))
+    bus.handle(commands.Allocate("o1", sku, 3), sharded_uow(engines))
+
+    args = (sku, engines[source], engines[target], engines["home"], target)
+    sharding.move_product(*args)
+    sharding.move_product(*args)
+
+    assert sku in skus_on(engines[target])
+    assert sku not in skus_on(engines[source])
+    assert allocated_batch(engines[target], "o1") == "b1"
+
+
+class FakePublisher:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, payload):
+        self.published.append(channel)
+
+    def flush(self):
+        pass
+
+
+def test_outbox_rows_on_every_shard_are_relayed(bus, engines):
+    for sku in [f"LAMP-{i}" for i in range(6)]:
+        bus.handle(
+            commands.CreateBatch(f"b-{sku}", sku, 10, None), sharded_uow(engines)
+        )
+        bus.handle(commands.Allocate(f"o-{sku}", sku, 1), sharded_uow(engines))
+    publisher = FakePublisher()
+
+    databases = [engines[name] for name in ["home"] + SHARDS]
+    relayed = outbox_relay.relay_all(databases, publisher)
+
+    assert relayed == 12
+    assert publisher.published.count("line_allocated") == 6
+
+
+def test_a_directory_row_left_by_a_failed_shard_commit_is_tolerated(bus, engines):
+    shard = sharding.HashRing(SHARDS).shard_for("ORPHAN-LAMP")
+    engines["home"].execute(
+        "INSERT INTO batch_shards (reference, sku, shard)"
+        f" VALUES ('b1', 'ORPHAN-LAMP', '{shard}')"
+    )
+
+    with pytest.raises(handlers.InvalidBatchref):
+        bus.handle(commands.ChangeBatchQuantity("b1", 5), sharded_uow(engines))
+
+    bus.handle(
+        commands.CreateBatch("b1", "ORPHAN-LAMP", 10, None), sharded_uow(engines)
+    )
+    bus.handle(commands.ChangeBatchQuantity("b1", 5), sharded_uow(engines))
+    assert skus_on(engines[shard]) == {"ORPHAN-LAMP"}
+
+
+def test_reused_connections_last_until_close(bus, engines):
+    uow = unit_of_work.ShardedUnitOfWork(
+        {name: sessionmaker(bind=engines[name]) for name in SHARDS},
+        sessionmaker(bind=engines["home"]),
+        reuse_connection=True,
+    )
+    bus.handle(commands.CreateBatch("b1", "REUSED-RUG", 10, None), uow)
+    with uow:
+        uow.products.get("REUSED-RUG")
+        [shard_uow] = uow._shard_uows.values()
+        connection = shard_uow._connection
+    with uow:
+        uow.products.get("REUSED-RUG")
+        assert shard_uow.session.get_bind() is connection
+
+    uow.close()
+    assert shard_uow._connection is None and uow._connection is None
+
+
+def skus_on_two_shards():
+    ring = sharding.HashRing(SHARDS)
+    by_shard = {}
+    for i in range(50):
+        by_shard.setdefault(ring.shard_for(f"LAMP-{i}"), f"LAMP-{i}")
+    return list(by_shard.values())[:2]
+
+
+def test_a_conflict_after_one_shard_committed_is_not_retried(
+    bus, engines, monkeypatch
+):
+    skus = skus_on_two_shards()
+    for sku in skus:
+        bus.handle(
+            commands.CreateBatch(f"b-{sku}", sku, 10, None), sharded_uow(engines)
+        )
+    commit, commits = unit_of_work.SqlAlchemyUnitOfWork.commit, []
+
+    def second_commit_conflicts(uow):
+        commits.append(uow)
+        if len(commits) == 2:
+            raise unit_of_work.ConcurrencyConflict("version changed")
+        commit(uow)
+
+    monkeypatch.setattr(
+        unit_of_work.SqlAlchemyUnitOfWork, "commit", second_commit_conflicts
+    )
+    lines = [commands.Allocate("o1", sku, 1) for sku in skus]
+
+    with pytest.raises(unit_of_work.PartiallyCommitted):
+        bus.handle(commands.AllocateMany(lines), sharded_uow(engines))
+    assert len(commits) == 2
+
+
+def test_rebuilding_the_view_reads_the_allocations_on_every_shard(bus, engines):
+    skus = skus_on_two_shards()
+    for sku in skus:
+        bus.handle(
+            commands.CreateBatch(f"b-{sku}", sku, 10, None), sharded_uow(engines)
+        )
+        bus.handle(commands.Allocate(f"o-{sku}", sku, 1), sharded_uow(engines))
+
+    bus.handle(commands.RebuildAllocationsView(), sharded_uow(engines))
+
+    assert sorted(
+        engines["home"].execute("SELECT orderid, batchref FROM allocations_view")
+    ) == [(f"o-{sku}", f"b-{sku}") for sku in sorted(skus)]
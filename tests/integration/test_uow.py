@@ -2,9 +2,12 @@
 import threading
 import time
 import traceback
+from datetime import date
 from typing import List
 import pytest
-from allocation.domain import model
+from sqlalchemy.orm import sessionmaker
+from allocation import instrumentation
+from allocation.domain import commands, model
 from allocation.service_layer import unit_of_work
 from tests.random_refs import random_sku, random_batchref, random_orderid
 
@@ -50,6 +53,112 @@ def test_uow_can_retrieve_a_batch_and_allocate_to_it(session_factory):
     assert batchref == "batch1"
 
 
+def test_allocated_quantity_is_recomputed_for_loaded_batches(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "LOFTY-LANTERN", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku="LOFTY-LANTERN")
+        product.allocate(model.OrderLine("o1", "LOFTY-LANTERN", 10))
+        product.allocate(model.OrderLine("o2", "LOFTY-LANTERN", 20))
+        uow.commit()
+        [batch] = product.batches
+        assert batch.available_quantity == 70
+
+    with uow:
+        [batch] = uow.products.get(sku="LOFTY-LANTERN").batches
+        assert batch.allocated_quantity == 30
+        batch.deallocate(model.OrderLine("o1", "LOFTY-LANTERN", 10))
+        assert batch.available_quantity == 80
+
+
+def insert_product_with_allocated_batches(session, sku, n_batches):
+    session.execute(
+        "INSERT INTO products (sku, version_number) VALUES (:sku, 1)", dict(sku=sku)
+    )
+    for i in range(n_batches):
+        session.execute(
+            "INSERT INTO batches (id, reference, sku, _purchased_quantity, eta)"
+            " VALUES (:id, :ref, :sku, 100, NULL)",
+            dict(id=i + 1, ref=f"batch{i}", sku=sku),
+        )
+        session.execute(
+            "INSERT INTO order_lines (id, sku, qty, orderid)"
+            " VALUES (:id, :sku, 10, :orderid)",
+            dict(id=i + 1, sku=sku, orderid=f"order{i}"),
+        )
+        session.execute(
+            "INSERT INTO allocations (orderline_id, batch_id) VALUES (:id, :id)",
+            dict(id=i + 1),
+        )
+
+
+@pytest.mark.parametrize(
+    "loading, max_statements",
+    [("selectin", 3), ("joined", 1), ("single_query", 1)],
+)
+def test_eager_loading_fetches_aggregate_in_few_statements(
+    session_factory, loading, max_statements
+):
+    session = session_factory()
+    insert_product_with_allocated_batches(session, "BUSY-SOFA", 200)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, loading=loading)
+    with uow:
+        product = uow.products.get(sku="BUSY-SOFA")
+        assert len(product.batches) == 200
+        assert sum(b.allocated_quantity for b in product.batches) == 2000
+        assert uow.statement_count <= max_statements
+
+
+def test_lazy_loading_issues_a_query_per_batch(session_factory):
+    session = session_factory()
+    insert_product_with_allocated_batches(session, "BUSY-SOFA", 20)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, loading="lazy")
+    with uow:
+        product = uow.products.get(sku="BUSY-SOFA")
+        sum(b.allocated_quantity for b in product.batches)
+        assert uow.statement_count == 1 + 1 + 20
+
+
+def test_get_by_batchref_loads_all_the_products_batches(session_factory):
+    session = session_factory()
+    insert_product_with_allocated_batches(session, "BUSY-SOFA", 3)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, loading="single_query")
+    with uow:
+        product = uow.products.get_by_batchref(batchref="batch1")
+        assert {b.reference for b in product.batches} == {"batch0", "batch1", "batch2"}
+
+
+def test_shrinking_a_batch_reallocates_in_the_same_transaction(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "LONG-BENCH", 20, None)
+    session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+        " VALUES ('batch2', 'LONG-BENCH', 20, '2031-01-01')"
+    )
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku="LONG-BENCH")
+        product.allocate(model.OrderLine("o1", "LONG-BENCH", 15))
+        uow.commit()
+    with uow:
+        product = uow.products.get_by_batchref(batchref="batch1")
+        product.change_batch_quantity("batch1", 10)
+        uow.commit()
+
+    assert get_allocated_batch_ref(session, "o1", "LONG-BENCH") == "batch2"
+
+
 def test_rolls_back_uncommitted_work_by_default(session_factory):
     uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
     with uow:
@@ -75,10 +184,40 @@ def test_rolls_back_on_error(session_factory):
     assert rows == []
 
 
-def try_to_allocate(orderid, sku, exceptions):
+def test_stale_version_raises_concurrency_conflict(session_factory):
+    session = session_factory()
+    insert_batch(session, "batch1", "CREAKY-DOOR", 100, None, product_version=1)
+    session.commit()
+
+    stale_uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with stale_uow:
+        stale_product = stale_uow.products.get(sku="CREAKY-DOOR")
+
+        with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+            uow.products.get(sku="CREAKY-DOOR").allocate(
+                model.OrderLine("o1", "CREAKY-DOOR", 10)
+            )
+            uow.commit()
+
+        stale_product.allocate(model.OrderLine("o2", "CREAKY-DOOR", 10))
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            stale_uow.commit()
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='CREAKY-DOOR'"
+    )
+    assert version == 2
+
+
+def try_to_allocate(orderid, sku, exceptions, session_factory=None):
     line = model.OrderLine(orderid, sku, 10)
+    uow = (
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        if session_factory
+        else unit_of_work.SqlAlchemyUnitOfWork()
+    )
     try:
-        with unit_of_work.SqlAlchemyUnitOfWork() as uow:
+        with uow:
             product = uow.products.get(sku=sku)
             product.allocate(line)
             time.sleep(0.2)
@@ -123,3 +262,91 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     assert orders.rowcount == 1
     with unit_of_work.SqlAlchemyUnitOfWork() as uow:
         uow.session.execute("select 1")
+
+
+@pytest.mark.usefixtures("postgres_session_factory")
+def test_version_check_prevents_lost_updates_at_read_committed(postgres_db):
+    sku, batch = random_sku(), random_batchref()
+    session_factory = sessionmaker(
+        bind=postgres_db.execution_options(isolation_level="READ COMMITTED")
+    )
+    session = session_factory()
+    insert_batch(session, batch, sku, 100, eta=None, product_version=1)
+    session.commit()
+
+    exceptions = []  # type: List[Exception]
+    threads = [
+        threading.Thread(
+            target=try_to_allocate,
+            args=(random_orderid(i), sku, exceptions, session_factory),
+        )
+        for i in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku=:sku", dict(sku=sku)
+    )
+    assert version == 2
+    [exception] = exceptions
+    assert isinstance(exception, unit_of_work.ConcurrencyConflict)
+
+
+def test_hot_path_is_instrumented(bus, session_factory):
+    recorder = instrumentation.SpanRecorder()
+    instrumentation.configure(recorder)
+    try:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+        bus.handle(commands.CreateBatch("b1", "TIMED-TABLE", 10, None), uow)
+        bus.handle(commands.Allocate("o1", "TIMED-TABLE", 1), uow)
+    finally:
+        instrumentation.configure(instrumentation.Instrumentation())
+
+    names = [(s["name"], s["attributes"].get("handler")) for s in recorder.finished]
+    assert ("handler", "allocate") in names
+    assert ("handler", "add_allocation_to_read_model") in names
+    assert ("repository_get", None) in names
+    assert ("uow_enter", None) in names
+    assert ("uow_commit", None) in names
+    assert ("uow_rollback", None) in names
+
+
+class ConflictOnceOverBlueLamps(unit_of_work.SqlAlchemyUnitOfWork):
+    conflicts = 1
+
+    def _commit(self):
+        if self.conflicts and "BLUE-LAMP" in {p.sku for p in self.products.seen}:
+            self.conflicts -= 1
+            raise unit_of_work.ConcurrencyConflict()
+        super()._commit()
+
+
+def test_allocate_many_retried_after_a_conflict_allocates_each_line_once(
+    bus, session_factory
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus.handle(commands.CreateBatch("b1", "RED-CHAIR", 4, None), uow)
+    bus.handle(commands.CreateBatch("b1-later", "RED-CHAIR", 10, date.today()), uow)
+    bus.handle(commands.CreateBatch("b2", "BLUE-LAMP", 10, None), uow)
+    lines = [
+        commands.Allocate("o1", "RED-CHAIR", 4),
+        commands.Allocate("o1", "BLUE-LAMP", 4),
+    ]
+
+    [results] = bus.handle(
+        commands.AllocateMany(lines), ConflictOnceOverBlueLamps(session_factory)
+    )
+
+    assert results == ["b1", "b2"]
+    session = session_factory()
+    assert sorted(session.execute("SELECT orderid, sku FROM order_lines")) == [
+        ("o1", "BLUE-LAMP"),
+        ("o1", "RED-CHAIR"),
+    ]
+    assert sorted(session.execute("SELECT sku FROM allocations_view")) == [
+        ("BLUE-LAMP",),
+        ("RED-CHAIR",),
+    ]
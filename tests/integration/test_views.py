@@ -0,0 +1,94 @@
+from datetime import date
+
+import pytest
+
+from allocation import views
+from allocation.adapters import view_cache
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+today = date.today()
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    view_cache.allocations_cache.clear()
+
+
+def test_allocations_view(bus, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None), uow)
+    bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, today), uow)
+    bus.handle(commands.Allocate("order1", "sku1", 20), uow)
+    bus.handle(commands.Allocate("order1", "sku2", 20), uow)
+    # add a spurious batch and order to make sure we're getting the right ones
+    bus.handle(commands.CreateBatch("sku1batch-later", "sku1", 50, today), uow)
+    bus.handle(commands.Allocate("otherorder", "sku1", 30), uow)
+    bus.handle(commands.Allocate("otherorder", "sku2", 10), uow)
+
+    assert views.allocations("order1", uow) == [
+        {"sku": "sku1", "batchref": "sku1batch"},
+        {"sku": "sku2", "batchref": "sku2batch"},
+    ]
+
+
+def test_deallocation(bus, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None), uow)
+    bus.handle(commands.CreateBatch("b2", "sku1", 50, today), uow)
+    bus.handle(commands.Allocate("o1", "sku1", 40), uow)
+    bus.handle(commands.ChangeBatchQuantity("b1", 10), uow)
+
+    assert views.allocations("o1", uow) == [
+        {"sku": "sku1", "batchref": "b2"},
+    ]
+
+
+def test_rebuild_repopulates_from_the_write_model(bus, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None), uow)
+    bus.handle(commands.Allocate("o1", "sku1", 20), uow)
+    session = session_factory()
+    session.execute("DELETE FROM allocations_view")
+    session.commit()
+    assert views.allocations("o1", uow) == []
+
+    bus.handle(commands.RebuildAllocationsView(), uow)
+
+    assert views.allocations("o1", uow) == [{"sku": "sku1", "batchref": "b1"}]
+
+
+def test_cached_view_is_invalidated_by_reallocation(bus, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None), uow)
+    bus.handle(commands.CreateBatch("b2", "sku1", 50, today), uow)
+    bus.handle(commands.Allocate("o1", "sku1", 40), uow)
+    assert views.allocations("o1", uow) == [{"sku": "sku1", "batchref": "b1"}]
+    hits = view_cache.allocations_cache.hits
+    assert views.allocations("o1", uow) == [{"sku": "sku1", "batchref": "b1"}]
+    assert view_cache.allocations_cache.hits == hits + 1
+
+    bus.handle(commands.ChangeBatchQuantity("b1", 10), uow)
+
+    assert views.allocations("o1", uow) == [{"sku": "sku1", "batchref": "b2"}]
+
+
+def test_export_filters_by_sku_batchref_and_orderid_prefix(bus, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None), uow)
+    bus.handle(commands.CreateBatch("b2", "sku2", 50, None), uow)
+    for orderid in ["2024_1", "2024-2", "2025_1"]:
+        bus.handle(commands.Allocate(orderid, "sku1", 1), uow)
+        bus.handle(commands.Allocate(orderid, "sku2", 1), uow)
+
+    exported = views.export_allocations(uow, orderid_prefix="2024_", chunk_size=1)
+    assert list(exported) == [
+        {"orderid": "2024_1", "sku": "sku1", "qty": 1, "batchref": "b1"},
+        {"orderid": "2024_1", "sku": "sku2", "qty": 1, "batchref": "b2"},
+    ]
+    assert [row["orderid"] for row in views.export_allocations(uow, sku="sku2")] == [
+        "2024-2",
+        "2024_1",
+        "2025_1",
+    ]
+    assert list(views.export_allocations(uow, sku="sku1", batchref="b2")) == []
@@ -0,0 +1,31 @@
+from allocation.adapters.aggregate_cache import AggregateCache
+from allocation.domain.model import Product
+
+
+def test_hands_out_a_product_once_while_its_version_matches():
+    cache = AggregateCache(maxsize=10)
+    product = Product("SOFT-RUG", batches=[], version_number=3)
+    cache.put(product)
+
+    assert cache.take("SOFT-RUG", lambda: 3) is product
+    assert cache.take("SOFT-RUG", lambda: 3) is None
+    assert cache.stats() == dict(hits=1, misses=1, size=0)
+
+
+def test_drops_a_product_changed_elsewhere():
+    cache = AggregateCache(maxsize=10)
+    cache.put(Product("SOFT-RUG", batches=[], version_number=3))
+
+    assert cache.take("SOFT-RUG", lambda: 4) is None
+    assert cache.take("SOFT-RUG", lambda: 4) is None
+    assert cache.stats() == dict(stale=1, misses=1, size=0)
+
+
+def test_evicts_the_least_recently_committed_product():
+    cache = AggregateCache(maxsize=2)
+    for sku in ["RUG-1", "RUG-2", "RUG-3"]:
+        cache.put(Product(sku, batches=[]))
+
+    assert cache.take("RUG-1", lambda: 0) is None
+    assert cache.take("RUG-3", lambda: 0) is not None
+    assert cache.stats()["evictions"] == 1
@@ -50,3 +50,31 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+
+def test_deallocating_returns_quantity_to_the_batch():
+    batch, line = make_batch_and_line("STURDY-SHELF", 20, 2)
+    batch.allocate(line)
+    batch.deallocate(line)
+    assert batch.allocated_quantity == 0
+    assert batch.available_quantity == 20
+
+
+def test_deallocate_one_keeps_allocated_quantity_in_step():
+    batch = Batch("batch-001", "WOBBLY-STOOL", qty=20, eta=None)
+    batch.allocate(OrderLine("order-1", "WOBBLY-STOOL", 2))
+    batch.allocate(OrderLine("order-2", "WOBBLY-STOOL", 5))
+
+    line = batch.deallocate_one()
+
+    assert batch.allocated_quantity == 7 - line.qty
+    assert batch.available_quantity == 13 + line.qty
+
+
+def test_equal_lines_hash_alike():
+    line = OrderLine("order-1", "TALL-VASE", 2)
+    same = OrderLine("order-1", "TALL-VASE", 2)
+
+    assert line == same
+    assert hash(line) == hash(same)
+    assert len({line, same, OrderLine("order-1", "TALL-VASE", 3)}) == 2
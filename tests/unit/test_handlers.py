@@ -1,8 +1,12 @@
+import threading
+import time
+
 import pytest
 
+from allocation import bootstrap
 from allocation.adapters import repository
-from allocation.service_layer import unit_of_work, messagebus, handlers
-from allocation.domain import commands
+from allocation.service_layer import concurrent_messagebus, unit_of_work, handlers
+from allocation.domain import commands, events, model
 from datetime import date
 
 
@@ -36,55 +40,84 @@ class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
         pass
 
 
-def test_for_new_product():
+class ConflictingUnitOfWork(FakeUnitOfWork):
+    def __init__(self, conflicts):
+        super().__init__()
+        self.conflicts = conflicts
+        self.commits_attempted = 0
+
+    def _commit(self):
+        self.commits_attempted += 1
+        if self.commits_attempted <= self.conflicts:
+            raise unit_of_work.ConcurrencyConflict()
+        super()._commit()
+
+
+def bootstrap_test_app(**overrides):
+    dependencies = dict(
+        start_orm=False,
+        uow_factory=FakeUnitOfWork,
+        send_mail=lambda *args: None,
+        retry_policy=dict(attempts=3, base_delay=0),
+    )
+    dependencies.update(overrides)
+    return bootstrap.bootstrap(**dependencies)
+
+
+@pytest.fixture
+def bus():
+    return bootstrap_test_app()
+
+
+def test_for_new_product(bus):
     uow = FakeUnitOfWork()
-    messagebus.handle(commands.CreateBatch("b1", "CRUNCHY-ARMCHAIR", 100, None), uow)
+    bus.handle(commands.CreateBatch("b1", "CRUNCHY-ARMCHAIR", 100, None), uow)
     assert uow.products.get("CRUNCHY-ARMCHAIR") is not None
     assert uow.committed
 
 
-def test_add_batch_for_existing_product():
+def test_add_batch_for_existing_product(bus):
     uow = FakeUnitOfWork()
-    messagebus.handle(commands.CreateBatch("b1", "GARISH-RUG", 100, None), uow)
-    messagebus.handle(commands.CreateBatch("b2", "GARISH-RUG", 99, None), uow)
+    bus.handle(commands.CreateBatch("b1", "GARISH-RUG", 100, None), uow)
+    bus.handle(commands.CreateBatch("b2", "GARISH-RUG", 99, None), uow)
     assert "b2" in [b.reference for b in uow.products.get("GARISH-RUG").batches]
 
 
-def test_returns_allocation():
+def test_returns_allocation(bus):
     uow = FakeUnitOfWork()
-    messagebus.handle(
+    bus.handle(
         commands.CreateBatch("batch1", "COMPLICATED-LAMP", 100, None), uow
     )
-    result = messagebus.handle(commands.Allocate("o1", "COMPLICATED-LAMP", 10), uow)
+    result = bus.handle(commands.Allocate("o1", "COMPLICATED-LAMP", 10), uow)
     assert result[0] == "batch1"
 
 
-def test_allocate_errors_for_invalid_sku():
+def test_allocate_errors_for_invalid_sku(bus):
     uow = FakeUnitOfWork()
-    messagebus.handle(commands.CreateBatch("b1", "AREALSKU", 100, None), uow)
+    bus.handle(commands.CreateBatch("b1", "AREALSKU", 100, None), uow)
 
     with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
-        messagebus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10), uow)
+        bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10), uow)
 
 
-def test_allocate_commits():
+def test_allocate_commits(bus):
     uow = FakeUnitOfWork()
-    messagebus.handle(commands.CreateBatch("b1", "OMINOUS-MIRROR", 100, None), uow)
-    messagebus.handle(commands.Allocate("o1", "OMINOUS-MIRROR", 10), uow)
+    bus.handle(commands.CreateBatch("b1", "OMINOUS-MIRROR", 100, None), uow)
+    bus.handle(commands.Allocate("o1", "OMINOUS-MIRROR", 10), uow)
     assert uow.committed
 
 
-def test_changes_available_quantity():
+def test_changes_available_quantity(bus):
     uow = FakeUnitOfWork()
-    messagebus.handle(commands.CreateBatch("batch1", "ADORABLE-SETTEE", 100, None), uow)
+    bus.handle(commands.CreateBatch("batch1", "ADORABLE-SETTEE", 100, None), uow)
     [batch] = uow.products.get(sku="ADORABLE-SETTEE").batches
     assert batch.available_quantity == 100
 
-    messagebus.handle(commands.ChangeBatchQuantity("batch1", 50), uow)
+    bus.handle(commands.ChangeBatchQuantity("batch1", 50), uow)
     assert batch.available_quantity == 50
 
 
-def test_reallocates_if_necessary():
+def test_reallocates_if_necessary(bus):
     uow = FakeUnitOfWork()
     event_history = [
         commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
@@ -93,14 +126,171 @@ def test_reallocates_if_necessary():
         commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
     ]
     for e in event_history:
-        messagebus.handle(e, uow)
+        bus.handle(e, uow)
     [batch1, batch2] = uow.products.get(sku="INDIFFERENT-TABLE").batches
     assert batch1.available_quantity == 10
     assert batch2.available_quantity == 50
 
-    messagebus.handle(commands.ChangeBatchQuantity("batch1", 25), uow)
+    bus.handle(commands.ChangeBatchQuantity("batch1", 25), uow)
 
     # order1 or order2 will be deallocated, so we'll have 25 - 20
     assert batch1.available_quantity == 5
     # and 20 will be reallocated to the next batch
     assert batch2.available_quantity == 30
+
+
+def test_allocate_many_returns_results_in_input_order(bus):
+    uow = FakeUnitOfWork()
+    bus.handle(commands.CreateBatch("lamp-batch", "SHINY-LAMP", 100, None), uow)
+    bus.handle(commands.CreateBatch("rug-batch", "SHAGGY-RUG", 10, None), uow)
+
+    [results] = bus.handle(
+        commands.AllocateMany(
+            [
+                commands.Allocate("o1", "SHINY-LAMP", 10),
+                commands.Allocate("o1", "SHAGGY-RUG", 10),
+                commands.Allocate("o2", "SHINY-LAMP", 10),
+                commands.Allocate("o2", "SHAGGY-RUG", 1),
+            ]
+        ),
+        uow,
+    )
+
+    assert results[0] == "lamp-batch"
+    assert results[1] == "rug-batch"
+    assert results[2] == "lamp-batch"
+    assert isinstance(results[3], model.OutOfStock)
+    assert uow.committed
+
+
+def test_allocate_many_reports_invalid_skus_per_line(bus):
+    uow = FakeUnitOfWork()
+    bus.handle(commands.CreateBatch("b1", "REAL-CHAIR", 100, None), uow)
+
+    [results] = bus.handle(
+        commands.AllocateMany(
+            [
+                commands.Allocate("o1", "IMAGINARY-CHAIR", 10),
+                commands.Allocate("o1", "REAL-CHAIR", 10),
+            ]
+        ),
+        uow,
+    )
+
+    assert isinstance(results[0], handlers.InvalidSku)
+    assert results[1] == "b1"
+
+
+def test_sends_email_on_out_of_stock_error():
+    sent = []
+    bus = bootstrap_test_app(send_mail=lambda *args: sent.append(args))
+    uow = FakeUnitOfWork()
+    bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None), uow)
+    bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10), uow)
+    assert sent == [("stock@made.com", "Out of stock for POPULAR-CURTAINS")]
+
+
+def test_uses_a_fresh_unit_of_work_when_none_is_given():
+    bus = bootstrap_test_app()
+    bus.handle(commands.CreateBatch("b1", "LONELY-LAMP", 10, None))
+    with pytest.raises(handlers.InvalidSku):
+        bus.handle(commands.Allocate("o1", "LONELY-LAMP", 1))
+
+
+def test_retries_commands_that_hit_a_concurrency_conflict(bus):
+    uow = ConflictingUnitOfWork(conflicts=2)
+    bus.handle(commands.CreateBatch("b1", "BUSY-CLOCK", 100, None), uow)
+    assert uow.commits_attempted == 3
+    assert uow.committed
+
+
+def test_gives_up_once_the_retry_budget_is_spent(bus):
+    uow = ConflictingUnitOfWork(conflicts=3)
+    with pytest.raises(unit_of_work.ConcurrencyConflict):
+        bus.handle(commands.CreateBatch("b1", "BUSY-CLOCK", 100, None), uow)
+    assert uow.commits_attempted == 3
+    assert not uow.committed
+
+
+@pytest.fixture
+def concurrent_bus():
+    bus = concurrent_messagebus.ConcurrentMessageBus(
+        bootstrap_test_app(), lanes=4, event_workers=2, max_pending_events=10
+    )
+    yield bus
+    bus.close()
+
+
+def test_concurrent_bus_returns_command_results(concurrent_bus):
+    uow = FakeUnitOfWork()
+    concurrent_bus.handle(commands.CreateBatch("b1", "TIDY-DRAWER", 100, None), uow)
+    results = concurrent_bus.handle(commands.Allocate("o1", "TIDY-DRAWER", 10), uow)
+    assert results == ["b1"]
+
+
+def test_concurrent_bus_serializes_commands_for_one_sku():
+    running, overlaps = set(), []
+
+    def slow_handler(cmd, uow):
+        if cmd.sku in running:
+            overlaps.append(cmd.sku)
+        running.add(cmd.sku)
+        time.sleep(0.01)
+        running.discard(cmd.sku)
+        return cmd.sku
+
+    concurrent_bus = concurrent_messagebus.ConcurrentMessageBus(
+        bootstrap_test_app(command_handlers={commands.Allocate: slow_handler}),
+        lanes=4,
+    )
+    callers = [
+        threading.Thread(
+            target=concurrent_bus.handle,
+            args=(commands.Allocate(f"o{i}", f"SKU-{i % 2}", 1),),
+        )
+        for i in range(8)
+    ]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    concurrent_bus.close()
+
+    assert overlaps == []
+
+
+def test_concurrent_bus_dispatches_events_to_workers():
+    handled = []
+
+    def record(event):
+        handled.append((event, threading.current_thread().name))
+
+    concurrent_bus = concurrent_messagebus.ConcurrentMessageBus(
+        bootstrap_test_app(event_handlers={events.OutOfStock: [record]}),
+        event_workers=2,
+    )
+
+    concurrent_bus.handle(events.OutOfStock("EMPTY-CUPBOARD"))
+    concurrent_bus.close()
+
+    [(event, thread_name)] = handled
+    assert event == events.OutOfStock("EMPTY-CUPBOARD")
+    assert thread_name.startswith("bus-events")
+
+
+def test_concurrent_bus_handles_the_events_of_one_sku_in_order():
+    handled = []
+
+    def record(event):
+        time.sleep(0.01 if event.qty == 0 else 0)  # the first is the slowest
+        handled.append(event.qty)
+
+    concurrent_bus = concurrent_messagebus.ConcurrentMessageBus(
+        bootstrap_test_app(event_handlers={events.BatchCreated: [record]}),
+        event_workers=4,
+    )
+    for qty in range(8):
+        concurrent_bus.handle(events.BatchCreated(f"b{qty}", "TIDY-DRAWER", qty))
+    concurrent_bus.close()
+
+    assert handled == list(range(8))
@@ -0,0 +1,32 @@
+from collections import Counter
+
+import pytest
+
+from allocation.adapters.sharding import HashRing
+
+SKUS = [f"SKU-{i}" for i in range(4000)]
+
+
+def test_a_sku_always_hashes_to_the_same_shard():
+    assert HashRing(["a", "b", "c"]).shard_for("RED-CHAIR") == HashRing(
+        ["c", "b", "a"]
+    ).shard_for("RED-CHAIR")
+
+
+def test_skus_are_spread_over_all_shards():
+    counts = Counter(HashRing(["a", "b", "c", "d"]).shard_for(sku) for sku in SKUS)
+    assert set(counts) == {"a", "b", "c", "d"}
+    assert min(counts.values()) > len(SKUS) / 4 * 0.7
+
+
+def test_adding_a_shard_only_moves_skus_onto_it():
+    before = HashRing(["a", "b", "c"])
+    after = HashRing(["a", "b", "c", "d"])
+    moved = [sku for sku in SKUS if before.shard_for(sku) != after.shard_for(sku)]
+    assert all(after.shard_for(sku) == "d" for sku in moved)
+    assert len(moved) < len(SKUS) / 4 * 1.3
+
+
+def test_a_ring_needs_shards():
+    with pytest.raises(ValueError):
+        HashRing([])
@@ -0,0 +1,83 @@
+import pytest
+
+from allocation import instrumentation
+
+
+@pytest.fixture
+def installed():
+    def install(target):
+        instrumentation.configure(target)
+        return target
+
+    yield install
+    instrumentation.configure(instrumentation.Instrumentation())
+
+
+def test_default_is_a_no_op():
+    with instrumentation.span("handler", handler="allocate") as span:
+        instrumentation.increment("command_retries")
+        instrumentation.gauge("bus_queue_depth", 3)
+    assert span is instrumentation.NULL_SPAN
+    assert instrumentation.active().prometheus_text() == ""
+
+
+def test_prometheus_text_has_histograms_counters_and_gauges(installed):
+    metrics = installed(instrumentation.PrometheusInstrumentation(buckets=(0.5, 1)))
+    with instrumentation.span("handler", handler="allocate"):
+        pass
+    instrumentation.increment("command_retries", message="Allocate")
+    instrumentation.increment("command_retries", message="Allocate")
+    instrumentation.gauge("bus_queue_depth", 3)
+
+    text = metrics.prometheus_text().splitlines()
+
+    assert "# TYPE allocation_command_retries_total counter" in text
+    assert 'allocation_command_retries_total{message="Allocate"} 2.0' in text
+    assert "allocation_bus_queue_depth 3" in text
+    assert "# TYPE allocation_handler_seconds histogram" in text
+    assert 'allocation_handler_seconds_bucket{handler="allocate",le="0.5"} 1' in text
+    assert 'allocation_handler_seconds_bucket{handler="allocate",le="+Inf"} 1' in text
+    assert 'allocation_handler_seconds_count{handler="allocate"} 1' in text
+
+
+def test_slow_observations_only_land_in_the_inf_bucket():
+    metrics = instrumentation.PrometheusInstrumentation(buckets=(0.5,))
+    metrics._observe(("handler", ()), 2.0)
+    text = metrics.prometheus_text().splitlines()
+    assert 'allocation_handler_seconds_bucket{le="0.5"} 0' in text
+    assert 'allocation_handler_seconds_bucket{le="+Inf"} 1' in text
+    assert "allocation_handler_seconds_sum 2.0" in text
+
+
+def test_spans_nest_and_record_errors(installed):
+    exported = []
+    recorder = installed(instrumentation.SpanRecorder(export=exported.append))
+    with instrumentation.span("handler", handler="allocate"):
+        with instrumentation.span("uow_commit"):
+            pass
+        with pytest.raises(ValueError):
+            with instrumentation.span("repository_get", by="sku"):
+                raise ValueError("boom")
+
+    commit, get, handler = exported
+    assert [s["name"] for s in recorder.finished] == [
+        "uow_commit",
+        "repository_get",
+        "handler",
+    ]
+    assert handler["parent_span_id"] is None
+    assert commit["parent_span_id"] == handler["span_id"]
+    assert commit["trace_id"] == get["trace_id"] == handler["trace_id"]
+    assert get["status"] == "ERROR"
+    assert get["attributes"]["exception"] == "ValueError('boom')"
+    assert handler["end_time_unix_nano"] >= handler["start_time_unix_nano"]
+
+
+def test_fanout_feeds_every_target(installed):
+    metrics = instrumentation.PrometheusInstrumentation()
+    recorder = instrumentation.SpanRecorder()
+    installed(instrumentation.Fanout(metrics, recorder))
+    with instrumentation.span("uow_commit"):
+        pass
+    assert "allocation_uow_commit_seconds_count 1" in metrics.prometheus_text()
+    assert [s["name"] for s in recorder.finished] == ["uow_commit"]
@@ -1,5 +1,15 @@
 from datetime import date, timedelta
-from allocation.domain.model import Product, OrderLine, Batch, OutOfStock
+
+import pytest
+
+from allocation.domain.model import (
+    Product,
+    OrderLine,
+    Batch,
+    CannotReplay,
+    OutOfStock,
+    SMALLEST_FIRST,
+)
 from allocation.domain import events
 
 
@@ -61,3 +71,152 @@ def test_records_out_of_stock_event_if_cannot_allocate():
     allocation = product.allocate(OrderLine("order2", "SMALL-FORK", 1))
     assert product.events[-1] == events.OutOfStock(sku="SMALL-FORK")
     assert allocation is None
+
+
+def test_skips_batches_too_small_for_the_line():
+    nearly_full = Batch("nearly-full", "TALL-VASE", 5, eta=None)
+    early = Batch("early-batch", "TALL-VASE", 8, eta=today)
+    roomy = Batch("roomy-batch", "TALL-VASE", 100, eta=later)
+    product = Product(sku="TALL-VASE", batches=[roomy, early, nearly_full])
+
+    allocation = product.allocate(OrderLine("order1", "TALL-VASE", 10))
+
+    assert allocation == "roomy-batch"
+    assert nearly_full.available_quantity == 5
+    assert early.available_quantity == 8
+
+
+def test_batches_added_later_take_their_place_in_eta_order():
+    shipment = Batch("shipment-batch", "QUIET-FAN", 100, eta=later)
+    product = Product(sku="QUIET-FAN", batches=[shipment])
+    product.allocate(OrderLine("order1", "QUIET-FAN", 10))
+
+    product.add_batch(Batch("earlier-batch", "QUIET-FAN", 100, eta=tomorrow))
+    product.add_batch(Batch("in-stock-batch", "QUIET-FAN", 100, eta=None))
+
+    assert product.allocate(OrderLine("order2", "QUIET-FAN", 10)) == "in-stock-batch"
+
+
+def test_allocation_sees_quantity_changes():
+    in_stock_batch = Batch("in-stock-batch", "LOUD-BELL", 20, eta=None)
+    shipment_batch = Batch("shipment-batch", "LOUD-BELL", 100, eta=tomorrow)
+    product = Product(sku="LOUD-BELL", batches=[in_stock_batch, shipment_batch])
+    product.allocate(OrderLine("order1", "LOUD-BELL", 10))
+
+    product.change_batch_quantity("in-stock-batch", 50)
+
+    assert product.allocate(OrderLine("order2", "LOUD-BELL", 30)) == "in-stock-batch"
+
+
+def test_changing_batch_quantity_increments_version_number():
+    product = Product(
+        sku="SCANDI-PEN", batches=[Batch("b1", "SCANDI-PEN", 100, eta=None)]
+    )
+    product.version_number = 3
+    product.change_batch_quantity("b1", 50)
+    assert product.version_number == 4
+
+
+def test_adding_a_batch_increments_version_number():
+    product = Product(sku="SCANDI-PEN", batches=[], version_number=3)
+    product.add_batch(Batch("b1", "SCANDI-PEN", 100, eta=None))
+    assert product.version_number == 4
+
+
+def test_shrinking_a_batch_records_a_summary_of_deallocations():
+    batch = Batch("batch1", "TINY-TRAY", 20, eta=None)
+    product = Product(sku="TINY-TRAY", batches=[batch])
+    product.allocate(OrderLine("order1", "TINY-TRAY", 15))
+
+    product.change_batch_quantity("batch1", 10)
+
+    assert events.BatchQuantityChanged(
+        batchref="batch1",
+        sku="TINY-TRAY",
+        qty=10,
+        deallocated=[events.Deallocated("order1", "TINY-TRAY", 15, "batch1")],
+    ) in product.events
+
+
+def test_shrinking_a_batch_reallocates_evicted_lines_within_the_product():
+    batch1 = Batch("batch1", "TALL-LAMP", 50, eta=None)
+    batch2 = Batch("batch2", "TALL-LAMP", 50, eta=tomorrow)
+    product = Product(sku="TALL-LAMP", batches=[batch1, batch2])
+    product.allocate(OrderLine("order1", "TALL-LAMP", 20))
+    product.allocate(OrderLine("order2", "TALL-LAMP", 20))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 25)
+
+    assert batch1.available_quantity == 5
+    assert batch2.available_quantity == 30
+    [summary, reallocated] = product.events
+    assert isinstance(summary, events.BatchQuantityChanged)
+    assert reallocated == events.Allocated(
+        summary.deallocated[0].orderid, "TALL-LAMP", 20, "batch2"
+    )
+
+
+def test_largest_first_eviction_evicts_the_fewest_lines():
+    batch = Batch("batch1", "SMALL-PLATE", 100, eta=None)
+    product = Product(sku="SMALL-PLATE", batches=[batch])
+    for i, qty in enumerate([5, 5, 5, 30]):
+        product.allocate(OrderLine(f"order{i}", "SMALL-PLATE", qty))
+
+    product.change_batch_quantity("batch1", 20)
+
+    [summary] = [e for e in product.events if isinstance(e, events.BatchQuantityChanged)]
+    assert [line.qty for line in summary.deallocated] == [30]
+    assert batch.available_quantity == 5
+
+
+def test_smallest_first_eviction_can_be_chosen():
+    batch = Batch("batch1", "SMALL-PLATE", 100, eta=None)
+    product = Product(sku="SMALL-PLATE", batches=[batch])
+    for i, qty in enumerate([5, 5, 5, 30]):
+        product.allocate(OrderLine(f"order{i}", "SMALL-PLATE", qty))
+
+    product.change_batch_quantity("batch1", 40, evict=SMALLEST_FIRST)
+
+    [summary] = [e for e in product.events if isinstance(e, events.BatchQuantityChanged)]
+    assert [line.qty for line in summary.deallocated] == [5]
+    assert batch.available_quantity == 0
+
+
+def test_evicted_lines_with_nowhere_to_go_are_out_of_stock():
+    batch = Batch("batch1", "RARE-VASE", 10, eta=None)
+    product = Product(sku="RARE-VASE", batches=[batch])
+    product.allocate(OrderLine("order1", "RARE-VASE", 10))
+
+    product.change_batch_quantity("batch1", 5)
+
+    assert product.events[-1] == events.OutOfStock(sku="RARE-VASE")
+    assert batch.available_quantity == 5
+
+
+def test_replaying_its_events_rebuilds_a_product():
+    product = Product(sku="TALL-LAMP", batches=[])
+    product.add_batch(Batch("b1", "TALL-LAMP", 20, eta=None))
+    product.add_batch(Batch("b2", "TALL-LAMP", 20, eta=tomorrow))
+    product.allocate(OrderLine("o1", "TALL-LAMP", 15))
+    product.allocate(OrderLine("o2", "TALL-LAMP", 5))
+    product.change_batch_quantity("b1", 10)
+
+    rebuilt = Product(sku="TALL-LAMP", batches=[])
+    for event in product.events:
+        rebuilt.replay(event)
+
+    assert rebuilt.events == []
+    assert rebuilt.version_number == product.version_number
+    assert [
+        (b.reference, b.available_quantity, b._allocations) for b in rebuilt.batches
+    ] == [(b.reference, b.available_quantity, b._allocations) for b in product.batches]
+
+
+def test_replaying_an_allocation_that_no_longer_fits_raises():
+    product = Product(sku="TALL-LAMP", batches=[Batch("b1", "TALL-LAMP", 10, None)])
+    product.allocate(OrderLine("someone-else", "TALL-LAMP", 8))
+
+    with pytest.raises(CannotReplay):
+        product.replay(events.Allocated("o1", "TALL-LAMP", 5, "b1"))
+    product.replay(events.Allocated("someone-else", "TALL-LAMP", 8, "b1"))
@@ -0,0 +1,152 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+
+
+class FakeStreamClient:
+    def __init__(self):
+        self.acked = []
+        self.values = {}
+        self.expiries = {}
+        self.trimmed_to = None
+
+    def xack(self, stream, group, *ids):
+        self.acked.extend(ids)
+
+    def xtrim(self, stream, minid, approximate):
+        self.trimmed_to = minid
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex):
+        self.values[key] = value
+        self.expiries[key] = ex
+
+
+class FakeBus:
+    def __init__(self, failing_refs=()):
+        self.handled = []
+        self.failing_refs = failing_refs
+
+    def handle(self, message, uow=None):
+        if message.ref in self.failing_refs:
+            raise Exception("oops")
+        self.handled.append(message)
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        yield executor
+
+
+def test_coalesce_keeps_the_latest_quantity_per_batchref():
+    entries = [
+        ("1-0", {"batchref": "b1", "qty": "10"}),
+        ("2-0", {"batchref": "b2", "qty": "20"}),
+        ("3-0", {"batchref": "b1", "qty": "5"}),
+    ]
+    assert redis_eventconsumer.coalesce(entries) == {
+        "b1": (5, ["1-0", "3-0"]),
+        "b2": (20, ["2-0"]),
+    }
+
+
+def test_applies_one_command_per_batchref_and_acks_after(executor):
+    bus = FakeBus()
+    client = FakeStreamClient()
+    entries = [
+        ("1-0", {"batchref": "b1", "qty": "10"}),
+        ("2-0", {"batchref": "b1", "qty": "5"}),
+    ]
+
+    redis_eventconsumer.handle_stream_entries(client, entries, executor, bus)
+
+    assert bus.handled == [commands.ChangeBatchQuantity(ref="b1", qty=5)]
+    assert client.acked == ["1-0", "2-0"]
+
+
+def test_does_not_ack_entries_whose_command_failed(executor):
+    bus = FakeBus(failing_refs=["b1"])
+    client = FakeStreamClient()
+    entries = [
+        ("1-0", {"batchref": "b1", "qty": "10"}),
+        ("2-0", {"batchref": "b2", "qty": "5"}),
+    ]
+
+    failed = redis_eventconsumer.handle_stream_entries(client, entries, executor, bus)
+
+    assert failed == 1
+    assert client.acked == ["2-0"]
+
+
+def test_a_retried_entry_older_than_one_applied_is_dropped(executor):
+    bus = FakeBus(failing_refs=["b1"])
+    client = FakeStreamClient()
+    redis_eventconsumer.handle_stream_entries(
+        client, [("9-0", {"batchref": "b1", "qty": "10"})], executor, bus
+    )
+    bus.failing_refs = []
+    redis_eventconsumer.handle_stream_entries(
+        client, [("10-0", {"batchref": "b1", "qty": "5"})], executor, bus
+    )
+
+    redis_eventconsumer.handle_stream_entries(
+        client, [("9-0", {"batchref": "b1", "qty": "10"})], executor, bus
+    )
+
+    assert bus.handled == [commands.ChangeBatchQuantity(ref="b1", qty=5)]
+    assert client.acked == ["10-0", "9-0"]
+
+
+def test_changes_to_engine_batches_are_acked_without_being_applied(
+    executor, monkeypatch
+):
+    monkeypatch.setattr(
+        redis_eventconsumer, "held_by_engine", lambda batchref: batchref == "hot"
+    )
+    bus = FakeBus()
+    client = FakeStreamClient()
+    entries = [
+        ("1-0", {"batchref": "hot", "qty": "10"}),
+        ("2-0", {"batchref": "b2", "qty": "5"}),
+    ]
+
+    failed = redis_eventconsumer.handle_stream_entries(client, entries, executor, bus)
+
+    assert failed == 0
+    assert bus.handled == [commands.ChangeBatchQuantity(ref="b2", qty=5)]
+    assert sorted(client.acked) == ["1-0", "2-0"]
+
+
+def test_applied_records_expire_after_the_entries_they_are_checked_against(
+    executor, monkeypatch
+):
+    monkeypatch.setattr(redis_eventconsumer.time, "time", lambda: 100000.5)
+    client = FakeStreamClient()
+    redis_eventconsumer.handle_stream_entries(
+        client, [("1-0", {"batchref": "b1", "qty": "10"})], executor, FakeBus()
+    )
+
+    redis_eventconsumer.trim_stream(client)
+
+    assert client.values == {"change_batch_quantity:applied:b1": "1-0"}
+    expiry = client.expiries["change_batch_quantity:applied:b1"]
+    assert expiry > redis_eventconsumer.RETENTION
+    assert client.trimmed_to == f"{(100000 - redis_eventconsumer.RETENTION) * 1000}-0"
+
+
+def test_pending_entries_trimmed_from_the_stream_are_acked(executor):
+    bus = FakeBus()
+    client = FakeStreamClient()
+    entries = [("1-0", {}), ("2-0", {"batchref": "b1", "qty": "5"})]
+
+    failed = redis_eventconsumer.handle_stream_entries(client, entries, executor, bus)
+
+    assert failed == 0
+    assert bus.handled == [commands.ChangeBatchQuantity(ref="b1", qty=5)]
+    assert client.acked == ["1-0", "2-0"]
@@ -0,0 +1,161 @@
+import json
+import threading
+import time
+from dataclasses import asdict
+
+import pytest
+
+from allocation.adapters import redis_eventpublisher
+from allocation.domain import events
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def publish(self, channel, payload):
+        self.commands.append((channel, payload))
+
+    def execute(self):
+        if self.client.failures:
+            self.client.failures -= 1
+            raise ConnectionError("redis went away")
+        self.client.round_trips.append(self.commands)
+
+
+class FakeRedis:
+    def __init__(self, failures=0):
+        self.round_trips = []
+        self.failures = failures
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+def test_encode_matches_asdict():
+    event = events.Allocated("o1", "SHINY-LAMP", 10, "b1")
+    assert json.loads(redis_eventpublisher.encode(event)) == asdict(event)
+
+
+def test_buffers_until_max_batch_then_sends_one_pipeline():
+    client = FakeRedis()
+    publisher = redis_eventpublisher.BufferedPublisher(client, max_batch=3, max_delay=60)
+
+    publisher.publish("line_allocated", "1")
+    publisher.publish("line_allocated", "2")
+    assert client.round_trips == []
+
+    publisher.publish("line_allocated", "3")
+    assert client.round_trips == [
+        [("line_allocated", "1"), ("line_allocated", "2"), ("line_allocated", "3")]
+    ]
+
+
+def test_flushes_once_the_oldest_message_is_too_old():
+    client = FakeRedis()
+    publisher = redis_eventpublisher.BufferedPublisher(client, max_batch=100, max_delay=0)
+
+    publisher.publish("line_allocated", "1")
+
+    assert client.round_trips == [[("line_allocated", "1")]]
+
+
+def test_flush_sends_whatever_is_buffered():
+    client = FakeRedis()
+    publisher = redis_eventpublisher.BufferedPublisher(client, max_batch=100, max_delay=60)
+    publisher.flush()
+    publisher.publish("line_allocated", "1")
+    publisher.flush()
+
+    assert client.round_trips == [[("line_allocated", "1")]]
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_the_flusher_sends_a_message_left_waiting_max_delay():
+    client = FakeRedis()
+    publisher = redis_eventpublisher.BufferedPublisher(
+        client, max_batch=100, max_delay=0.05
+    )
+
+    publisher.publish("line_allocated", "1")
+    wait_for(lambda: client.round_trips)
+
+    assert client.round_trips == [[("line_allocated", "1")]]
+    publisher.close()
+
+
+def test_a_failed_flush_raises_and_drops_the_batch():
+    client = FakeRedis(failures=1)
+    publisher = redis_eventpublisher.BufferedPublisher(
+        client, max_batch=100, max_delay=60
+    )
+    publisher.publish("line_allocated", "1")
+
+    with pytest.raises(ConnectionError):
+        publisher.flush()
+    publisher.publish("line_allocated", "2")
+    publisher.flush()
+
+    assert client.round_trips == [[("line_allocated", "2")]]
+
+
+def test_a_failure_on_the_flusher_is_raised_by_the_next_flush():
+    client = FakeRedis(failures=1)
+    publisher = redis_eventpublisher.BufferedPublisher(
+        client, max_batch=100, max_delay=0.05
+    )
+    publisher.publish("line_allocated", "1")
+    wait_for(lambda: publisher._failure is not None)
+
+    with pytest.raises(ConnectionError):
+        publisher.flush()
+    publisher.flush()
+    publisher.close()
+
+
+class StuckThenFailingRedis(FakeRedis):
+    def __init__(self):
+        super().__init__()
+        self.executing = threading.Event()
+        self.release = threading.Event()
+
+    def pipeline(self, transaction=True):
+        pipe = FakePipeline(self)
+
+        def execute():
+            self.executing.set()
+            self.release.wait()
+            raise ConnectionError("redis went away")
+
+        pipe.execute = execute
+        return pipe
+
+
+def test_a_flush_waiting_on_a_failing_flusher_raises():
+    client = StuckThenFailingRedis()
+    publisher = redis_eventpublisher.BufferedPublisher(
+        client, max_batch=100, max_delay=0.01
+    )
+    publisher.publish("line_allocated", "1")
+    assert client.executing.wait(2)
+    raised = []
+
+    def flush():
+        try:
+            publisher.flush()
+        except ConnectionError as e:
+            raised.append(e)
+
+    flusher = threading.Thread(target=flush)
+    flusher.start()
+    time.sleep(0.05)  # flush() is now waiting for the stuck round trip
+    client.release.set()
+    flusher.join(2)
+
+    assert len(raised) == 1
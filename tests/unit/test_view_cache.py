@@ -0,0 +1,151 @@
+import fnmatch
+
+import redis
+
+from allocation.adapters.view_cache import LocalViewCache, RedisViewCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """Just the commands RedisViewCache uses; expiry is ignored."""
+
+    def __init__(self):
+        self.data = {}
+        self.writes = {}  # key -> how many times it was written, for WATCH
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, *keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, px=None):
+        self._write(key, value)
+
+    def incr(self, key):
+        self._write(key, str(int(self.data.get(key) or 0) + 1))
+
+    def delete(self, key):
+        self._write(key, None)
+
+    def pexpire(self, key, ms):
+        pass
+
+    def scan_iter(self, match):
+        return [key for key in list(self.data) if fnmatch.fnmatch(key, match)]
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def _write(self, key, value):
+        self.writes[key] = self.writes.get(key, 0) + 1
+        if value is None:
+            self.data.pop(key, None)
+        else:
+            self.data[key] = value
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.watched = {}
+        self.queued = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def watch(self, *keys):
+        self.watched = {key: self.client.writes.get(key, 0) for key in keys}
+
+    def multi(self):
+        pass
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def mget(self, *keys):
+        return self.client.mget(*keys)
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.queued.append((name, args, kwargs))
+
+    def execute(self):
+        if any(self.client.writes.get(k, 0) != n for k, n in self.watched.items()):
+            raise redis.WatchError()
+        for name, args, kwargs in self.queued:
+            getattr(self.client, name)(*args, **kwargs)
+
+
+def test_returns_what_was_set_and_counts_hits_and_misses():
+    cache = LocalViewCache(maxsize=10, ttl=60)
+    assert cache.get("o1") is None
+    cache.set("o1", [{"sku": "sku1", "batchref": "b1"}])
+    assert cache.get("o1") == [{"sku": "sku1", "batchref": "b1"}]
+    assert cache.stats() == dict(hits=1, misses=1, evictions=0, size=1)
+
+
+def test_evicts_the_least_recently_used_entry():
+    cache = LocalViewCache(maxsize=2, ttl=60)
+    cache.set("o1", ["one"])
+    cache.set("o2", ["two"])
+    cache.get("o1")
+    cache.set("o3", ["three"])
+
+    assert cache.get("o2") is None
+    assert cache.get("o1") == ["one"]
+    assert cache.evictions == 1
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = LocalViewCache(maxsize=10, ttl=5, clock=clock)
+    cache.set("o1", ["one"])
+    clock.now = 4.9
+    assert cache.get("o1") == ["one"]
+    clock.now = 5
+    assert cache.get("o1") is None
+
+
+def test_invalidate_removes_an_entry():
+    cache = LocalViewCache(maxsize=10, ttl=60)
+    cache.set("o1", ["one"])
+    cache.invalidate("o1")
+    cache.invalidate("never-cached")
+    assert cache.get("o1") is None
+
+
+def test_a_set_from_before_an_invalidation_is_not_stored():
+    cache = LocalViewCache(maxsize=10, ttl=60)
+    generation = cache.generation("o1")
+    cache.invalidate("o1")  # the order changed while we were reading it
+    cache.set("o1", ["stale"], generation=generation)
+    assert cache.get("o1") is None
+
+    cache.set("o1", ["fresh"], generation=cache.generation("o1"))
+    assert cache.get("o1") == ["fresh"]
+
+
+def test_redis_ignores_a_set_from_before_an_invalidation_or_a_clear():
+    cache = RedisViewCache(FakeRedis())
+    generation = cache.generation("o1")
+    cache.clear()  # a rebuild of the view
+    cache.set("o1", ["stale"], generation=generation)
+    assert cache.get("o1") is None
+
+    generation = cache.generation("o1")
+    cache.invalidate("o1")
+    cache.set("o1", ["stale"], generation=generation)
+    assert cache.get("o1") is None
+
+    cache.set("o1", ["fresh"], generation=cache.generation("o1"))
+    assert cache.get("o1") == ["fresh"]